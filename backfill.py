@@ -0,0 +1,23 @@
+from py_scripts.database import get_config, get_etl_settings
+from py_scripts.fraud_backfill import backfill_frauds, SHARD_SIZES
+from datetime import datetime
+import argparse
+
+
+# Пересчет поиска мошеннических операций за период, например:
+# python backfill.py "2021-03-01 00:00:00" "2021-04-01 00:00:00" --shard day --processes 8
+if __name__ == '__main__':
+	settings = get_etl_settings()
+
+	parser = argparse.ArgumentParser(description='Параллельный пересчет поиска мошеннических операций за период')
+	parser.add_argument('start_dt', type=datetime.fromisoformat, help='начало периода (включительно)')
+	parser.add_argument('end_dt', type=datetime.fromisoformat, help='конец периода (не включительно)')
+	parser.add_argument('--shard', choices=SHARD_SIZES, default='day', help='размер промежутка')
+	parser.add_argument('--processes', type=int, default=4, help='количество процессов')
+	parser.add_argument('--engine', default=settings['fraud_engine'], help='способ поиска (см. fraud_engine)')
+	args = parser.parse_args()
+
+	backfill_frauds(
+		get_config(), 'bank', args.start_dt, args.end_dt,
+		shard=args.shard, processes=args.processes, engine=args.engine
+	)
@@ -1,4 +1,4 @@
-from py_scripts.database import get_config, get_connection, close
+from py_scripts.database import get_config, get_etl_settings, get_connection, close, close_pool
 from py_scripts.test_data import recreate_test_data
 from py_scripts.dwh_data_update import update_from_files
 from py_scripts.file_processing import show_latest_errors
@@ -10,16 +10,17 @@ START_TIMESTAMP = datetime.now()
 
 # Подключиться к БД
 config = get_config()
-connection = get_connection(config)
-cursor = connection.cursor()
+settings = get_etl_settings()
 schema_name = 'bank'
+connection = get_connection(config, schema_name)
+cursor = connection.cursor()
 
 # Создать/установить схему и создать все основные таблицы, если их еще нет
 # Установить replace=True, чтобы дропнуть схему и пересоздать всё с нуля
 recreate_test_data(connection, cursor, schema_name, replace=False)
 
 print('>>> ОБРАБОТКА ФАЙЛОВ')
-update_from_files(connection, cursor, config, schema_name)
+update_from_files(connection, cursor, config, schema_name, settings)
 print()
 print('Обработка файлов завершена')
 
@@ -28,9 +29,11 @@ show_latest_errors(cursor, start_dt=START_TIMESTAMP)
 print()
 
 print('>>> ПОСТРОЕНИЕ ОТЧЕТА')
-update_rep_fraud(connection, cursor)
+update_rep_fraud(connection, cursor, 
+	engine=settings['fraud_engine'], mode=settings['fraud_search_mode'], shards=int(settings['fraud_shards']))
 print(f"Данные REP_FRAUD обновлены")
 
 # закрыть подключение
 close(connection, cursor)
+close_pool()
 
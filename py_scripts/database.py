@@ -1,9 +1,18 @@
+from sqlalchemy import create_engine
+from contextlib import contextmanager
 import json
 import psycopg2
 import pandas as pd
 import sys
 
 
+# Общий пул соединений с БД для всего процесса (см. get_engine)
+_engine = None
+
+# Открытые единицы работы: {id соединения: действия, выполняемые после COMMIT} (см. unit_of_work)
+_units = {}
+
+
 def get_config(path='db_config.json'):
 	"""Чтение файла с параметрами подключения к базе данных"""
 	try:
@@ -14,33 +23,155 @@ def get_config(path='db_config.json'):
 		sys.exit()
 
 
-def get_connection(config):
-	"""Подключение к базе данных"""
+def get_etl_settings(path='etl_settings.json'):
+	"""
+	Чтение файла с настройками ETL-процесса.
+	Если файл отсутствует или в нем нет какого-либо параметра, используется значение по умолчанию.
+	"""
+	settings = {
+		'chunk_rows': '0',
+		'chunk_bytes': '0',
+		'workers': '1',
+		'fraud_engine': 'queries',
+		'fraud_search_mode': 'period',
+		'fraud_shards': '1',
+		'poll_interval': '1',
+		'settle_interval': '2',
+		'max_batch_retries': '3'
+	}
+	try:
+		with open(path, 'r') as f:
+			settings.update(json.load(f))
+	except FileNotFoundError:
+		pass
+	return settings
+
+
+def get_connection_params(config, schema_name=None):
+	"""
+	Параметры подключения к БД для psycopg2 без настроек пула соединений.
+	Если задана схема schema_name, она устанавливается как схема по умолчанию для каждого соединения.
+	"""
+	params = {key: value for key, value in config.items() if key != 'pool'}
+	if schema_name:
+		params['options'] = f'-c search_path={schema_name}'
+	return params
+
+
+def get_engine(config, schema_name=None):
+	"""
+	Возвращает общий для всего процесса SQLAlchemy engine.
+	Пул соединений engine используется и для курсоров psycopg2 (см. get_connection), и для pandas.
+	Размер пула задается в разделе pool файла db_config.json (size, max_overflow).
+	"""
+	global _engine
+	if _engine is None:
+		params = get_connection_params(config, schema_name)
+		pool = config.get('pool', {})
+		_engine = create_engine(
+			'postgresql+psycopg2://',
+			creator=lambda: psycopg2.connect(**params),
+			pool_size=int(pool.get('size', 5)),
+			max_overflow=int(pool.get('max_overflow', 5)),
+			pool_pre_ping=True
+		)
+	return _engine
+
+
+def get_connection(config=None, schema_name=None):
+	"""
+	Получение соединения с базой данных из общего пула.
+	После close() соединение возвращается в пул и может быть использовано повторно.
+	Если пул уже создан, config и schema_name можно не указывать.
+	"""
 	try: 
-		return psycopg2.connect(**config)
+		return get_engine(config, schema_name).raw_connection()
 	except:
 		print('ОШИБКА: Не удалось подключиться к базе данных')
 		sys.exit()
 
 
 def close(connection=None, cursor=None):
-	"""Закрытие подключения к базе данных"""
+	"""Закрытие подключения к базе данных (возврат соединения в пул)"""
 	if cursor:
 		cursor.close()
 	if connection:
 		connection.close()
 
 
+def close_pool():
+	"""Закрытие всех соединений общего пула"""
+	global _engine
+	if _engine is not None:
+		_engine.dispose()
+		_engine = None
+
+
+@contextmanager
+def unit_of_work(connection):
+	"""
+	Единица работы: все изменения в блоке with фиксируются одним COMMIT при выходе из блока
+	или полностью откатываются (ROLLBACK), если в блоке возникло исключение.
+
+	Примечание: 
+		-- функции-помощники сами COMMIT не выполняют, границы транзакций задает вызывающий код;
+		-- вложенный unit_of_work для того же соединения входит во внешнюю единицу работы;
+		-- действия вне БД (например, перемещение файла в архив) регистрируются через after_commit 
+		и выполняются только после успешного COMMIT.
+	"""
+	if id(connection) in _units:
+		yield
+		return
+
+	actions = _units[id(connection)] = []
+	try:
+		yield
+		connection.commit()
+	except BaseException:
+		connection.rollback()
+		raise
+	finally:
+		del _units[id(connection)]
+
+	for action in actions:
+		action()
+
+
+@contextmanager
+def savepoint(cursor, name='sp'):
+	"""
+	Точка сохранения внутри текущей транзакции: если в блоке with возникло исключение, 
+	откатываются только изменения блока (ROLLBACK TO SAVEPOINT), а остальные изменения 
+	единицы работы сохраняются. Исключение передается дальше.
+	"""
+	cursor.execute(f"""SAVEPOINT {name};""")
+	try:
+		yield
+	except BaseException:
+		cursor.execute(f"""ROLLBACK TO SAVEPOINT {name};""")
+		raise
+	cursor.execute(f"""RELEASE SAVEPOINT {name};""")
+
+
+def after_commit(connection, action):
+	"""
+	Выполнение action() после COMMIT текущей единицы работы соединения connection.
+	Если единица работы не открыта, action() выполняется сразу.
+	"""
+	if id(connection) in _units:
+		_units[id(connection)].append(action)
+	else:
+		action()
+
+
 def drop_table(connection, cursor, table_name):
 	"""Удаление таблицы table_name в текущей схеме"""
 	cursor.execute(f"""DROP TABLE IF EXISTS {table_name};""")
-	connection.commit()
 
 
 def drop_schema(connection, cursor, schema_name):
 	"""Удаление схемы schema_name"""
 	cursor.execute(f"""DROP SCHEMA IF EXISTS {schema_name} CASCADE;""")
-	connection.commit()
 
 
 def create_and_set_schema(connection, cursor, schema_name, replace=False):
@@ -55,7 +186,6 @@ def create_and_set_schema(connection, cursor, schema_name, replace=False):
 		drop_schema(connection, cursor, schema_name)
 	cursor.execute(f"CREATE SCHEMA IF NOT EXISTS {schema_name};")
 	cursor.execute(f"SET SEARCH_PATH TO {schema_name};")
-	connection.commit()
 
 
 def check_if_empty_table(cursor, table_name):
@@ -1,208 +1,298 @@
 from py_scripts.database import *
 from py_scripts.file_processing import *
+from py_scripts.file_scheduler import process_files_parallel, process_files_pipelined
+from py_scripts.dwh_schema import add_dwh_partitions, register_keys_committed
+from py_scripts.fraud_search import lower_fraud_watermarks, lower_card_profile_watermark
+from py_scripts.fraud_offline import read_sql_copy
 from datetime import datetime
+import numpy as np
 
 
-def update_passport_blacklist(connection, cursor):
-	"""Обновленые данных о 'черном списке'"""
-	cursor.execute("""
+# Маска названий файлов для обработки: (тип данных)_(дата DDMMYYYY).(формат)
+FILE_MASK = r'(transactions|passport_blacklist|terminals)_(\d{8})\.(txt|csv|xlsx)'
+
+# Формат номера паспорта, который можно без потерь представить целым числом (10 цифр)
+PASSPORT_PATTERN = r'\d{4} \d{6}'
+
+
+def update_passport_blacklist(connection, cursor, table_name='STG_TMP_LOADED'):
+	"""
+	Обновленые данных о 'черном списке'.
+	Если в таблице есть паспорта с датой внесения раньше границы обновления профилей карт, 
+	граница сдвигается назад (см. fraud_search.lower_card_profile_watermark).
+	"""
+	cursor.execute(f"""
 		INSERT INTO DWH_FACT_PASSPORT_BLACKLIST (passport_num, entry_dt)
 		SELECT 
-			t1.passport::VARCHAR, 
-			t1.date::DATE
-		FROM STG_TMP_LOADED t1
-		LEFT JOIN DWH_FACT_PASSPORT_BLACKLIST t2
-			ON t1.passport::VARCHAR = t2.passport_num
-		WHERE t2.passport_num IS NULL;
+			t1.passport, 
+			t1.date
+		FROM {table_name} t1
+		ON CONFLICT (passport_num) DO NOTHING;
 	""")
-	connection.commit()
+	cursor.execute(f"""SELECT MIN(t1.date) FROM {table_name} t1;""")
+	entry_dt = cursor.fetchone()[0]
+	if entry_dt:
+		lower_card_profile_watermark(connection, cursor, 'DWH_FACT_PASSPORT_BLACKLIST', entry_dt)
 
 
-def update_transactions(connection, cursor):
-	"""Обновленые данных о транзакциях"""
-	cursor.execute("""
-		INSERT INTO DWH_FACT_TRANSACTIONS (trans_id, trans_date, card_num, oper_type, amt, oper_result, terminal)
-		SELECT 
-			t1.transaction_id::VARCHAR, 
-			t1.transaction_date::TIMESTAMP, 
-			t1.card_num::VARCHAR, 
-			t1.oper_type::VARCHAR, 
-			replace(t1.amount, ',', '.')::NUMERIC, 
-			t1.oper_result::VARCHAR, 
-			t1.terminal::VARCHAR
-		FROM STG_TMP_LOADED t1
-		LEFT JOIN DWH_FACT_TRANSACTIONS t2
-			ON t1.transaction_id::VARCHAR = t2.trans_id
-		WHERE t2.trans_id IS NULL;
-	""")
-	connection.commit()
+def get_passport_keys(passports):
+	"""
+	Представление номеров паспортов (Series) целыми числами int64: '1234 567890' -> 1234567890.
+	Возвращает массив ключей и признак того, что номер соответствует PASSPORT_PATTERN 
+	(для остальных номеров ключ не определен и равен 0).
+	"""
+	passports = passports.astype(str)
+	is_key = passports.str.fullmatch(PASSPORT_PATTERN).to_numpy()
+	keys = np.zeros(len(passports), dtype=np.int64)
+	keys[is_key] = passports[is_key].str.replace(' ', '', regex=False).astype(np.int64).to_numpy()
+	return keys, is_key
 
 
-def get_new_terminals(connection, cursor):
+def get_blacklist_keys(cursor):
 	"""
-	Поиск информации о новых терминалах по следующим условиям:
-		-- terminal_id есть в STG_TMP_LOADED;
-		-- terminal_id отсутствует в DWH_DIM_TERMINALS_HIST
+	Множество паспортов из DWH_FACT_PASSPORT_BLACKLIST в виде отсортированного массива int64 (8 байт на паспорт).
+	Номера преобразуются в числа на стороне БД, поэтому по сети передаются только цифры.
 	"""
-	drop_table(connection, cursor, 'STG_TMP_NEW_TERMINALS')
-	cursor.execute("""
-		CREATE TABLE STG_TMP_NEW_TERMINALS AS
-			SELECT 
-				t1.terminal_id::VARCHAR, 
-				t1.terminal_type::VARCHAR,
-				t1.terminal_city::VARCHAR,
-				t1.terminal_address::VARCHAR
-			FROM STG_TMP_LOADED t1
-			LEFT JOIN DWH_DIM_TERMINALS_HIST t2
-				ON t1.terminal_id::VARCHAR = t2.terminal_id
-			WHERE t2.terminal_id IS NULL;
-	""")
-	connection.commit()
+	keys = read_sql_copy(cursor, f"""
+		SELECT replace(passport_num, ' ', '')::BIGINT passport_key
+		FROM DWH_FACT_PASSPORT_BLACKLIST
+		WHERE passport_num ~ '^{PASSPORT_PATTERN}$'
+	""", dtype={'passport_key': np.int64})['passport_key'].to_numpy()
+	keys.sort()
+	return keys
 
 
-def get_updated_terminals(connection, cursor):
+def get_blacklist_delta(cursor, df):
 	"""
-	Поиск терминалов, информация о которых изменилась по следующим условиям:
-		-- terminal_id есть в STG_TMP_LOADED;
-		-- terminal_id есть в DWH_DIM_TERMINALS_HIST, при этом: 
-			-- effective_to = '2999-12-31 23:59:59';
-			-- хотя бы одно из бизнес-полей поменяло значение 
-				ИЛИ актуальная запись имеет deleted_flg = 1
+	Отбор из файла с 'черным списком' (df) только паспортов, которых еще нет в DWH_FACT_PASSPORT_BLACKLIST.
+	Файл накапливается с начала месяца, поэтому обычно в БД передаются только записи за последний день.
+
+	Примечание: номера, не соответствующие PASSPORT_PATTERN, передаются всегда - 
+	повторы отбрасываются при вставке по первичному ключу (см. update_passport_blacklist).
 	"""
-	drop_table(connection, cursor, 'STG_TMP_UPDATED_TERMINALS')
-	cursor.execute("""
-		CREATE TABLE STG_TMP_UPDATED_TERMINALS AS
-			SELECT 
-				t1.terminal_id::VARCHAR, 
-				t1.terminal_type::VARCHAR,
-				t1.terminal_city::VARCHAR,
-				t1.terminal_address::VARCHAR
-			FROM STG_TMP_LOADED t1
-			INNER JOIN DWH_DIM_TERMINALS_HIST t2
-				ON t1.terminal_id::VARCHAR = t2.terminal_id
-			WHERE t2.effective_to = '2999-12-31 23:59:59'
-				AND (
-					t1.terminal_type::VARCHAR <> t2.terminal_type
-					OR t1.terminal_city::VARCHAR <> t2.terminal_city
-					OR t1.terminal_address::VARCHAR <> t2.terminal_address
-					OR t2.deleted_flg = 1
-				);
-	""")
-	connection.commit()
+	keys, is_key = get_passport_keys(df['passport'])
+	is_new = ~is_key | ~np.isin(keys, get_blacklist_keys(cursor))
+	print(f"Новых паспортов в 'черном списке': {int(is_new.sum())} из {len(df)}")
+	return df[is_new]
 
 
-def get_deleted_terminals(connection, cursor):
+def update_transactions(connection, cursor, table_name='STG_TMP_LOADED'):
 	"""
-	Поиск информации об удаленных терминалах по следующим условиям:
-		-- terminal_id отсутствует в STG_TMP_LOADED;
-		-- terminal_id есть в DWH_DIM_TERMINALS_HIST, при этом:
-			-- effective_to = '2999-12-31 23:59:59';
-			-- актуальная запись имеет deleted_flg = 0
+	Обновленые данных о транзакциях.
+	Перед записью создаются недостающие секции DWH_FACT_TRANSACTIONS и DWH_DIM_FRAUD 
+	по диапазону дат операций во временной таблице table_name.
+	Если в таблице есть операции раньше границ инкрементального поиска, границы сдвигаются назад 
+	(см. fraud_search.lower_fraud_watermarks). Обычно границы уже сдвинуты по датам файлов до обработки 
+	(см. prepare_partitions), и строки META_FRAUD_WATERMARK здесь не изменяются и не блокируются.
+	Операции записываются вместе с суррогатными ключами карты и терминала (новые карты и терминалы 
+	регистрируются в справочниках DWH_DIM_CARD_KEYS, DWH_DIM_TERMINAL_KEYS отдельной короткой транзакцией, 
+	см. dwh_schema.register_keys_committed).
 	"""
-	drop_table(connection, cursor, 'STG_TMP_DELETED_TERMINALS')
-	cursor.execute("""
-		CREATE TABLE STG_TMP_DELETED_TERMINALS AS
-			SELECT 
-				t1.terminal_id, 
-				t1.terminal_type,
-				t1.terminal_city,
-				t1.terminal_address
-			FROM DWH_DIM_TERMINALS_HIST t1
-			LEFT JOIN STG_TMP_LOADED t2
-				ON t1.terminal_id = t2.terminal_id::VARCHAR
-			WHERE t1.effective_to = '2999-12-31 23:59:59'
-				AND t1.deleted_flg = 0
-				AND t2.terminal_id IS NULL;
+	cursor.execute(f"""
+		SELECT 
+			MIN(t1.transaction_date), 
+			MAX(t1.transaction_date)
+		FROM {table_name} t1;
+	""")
+	start_dt, end_dt = cursor.fetchone()
+	if start_dt:
+		add_dwh_partitions(connection, cursor, start_dt, end_dt)
+		lower_fraud_watermarks(connection, cursor, start_dt)
+
+	register_keys_committed(connection, cursor, 'DWH_DIM_CARD_KEYS', table_name, 'card_num')
+	register_keys_committed(connection, cursor, 'DWH_DIM_TERMINAL_KEYS', table_name, 'terminal')
+	cursor.execute(f"""
+		INSERT INTO DWH_FACT_TRANSACTIONS (trans_id, trans_date, card_num, oper_type, amt, oper_result, terminal, card_key, terminal_key)
+		SELECT 
+			t1.transaction_id, 
+			t1.transaction_date, 
+			t1.card_num, 
+			t1.oper_type, 
+			t1.amount, 
+			t1.oper_result, 
+			t1.terminal,
+			k1.card_key,
+			k2.terminal_key
+		FROM {table_name} t1
+		LEFT JOIN DWH_DIM_CARD_KEYS k1 ON t1.card_num = k1.card_num
+		LEFT JOIN DWH_DIM_TERMINAL_KEYS k2 ON t1.terminal = k2.terminal_id
+		ON CONFLICT (trans_id, trans_date) DO NOTHING;
 	""")
-	connection.commit()
 
 
-def add_terminals_records(connection, cursor, file_date, source_table_name, deleted_flg=0):
+def update_terminals(connection, cursor, file_date, table_name='STG_TMP_LOADED'):
 	"""
-	Добавление новых строк в DWH_DIM_TERMINALS_HIST из таблицы source_table_name.
-	Дата effective_from проставляется исходя из даты файла file_date.
+	Обновленые данных о терминалах (SCD2) одним запросом в одной транзакции.
+	Изменения определяются сравнением актуальных записей DWH_DIM_TERMINALS_HIST 
+	(effective_to = '2999-12-31 23:59:59') с временной таблицей table_name:
+		-- новые: terminal_id отсутствует среди актуальных записей;
+		-- измененные: отличается хотя бы одно из бизнес-полей (terminal_type, terminal_city, terminal_address)
+			ИЛИ актуальная запись имеет deleted_flg = 1 (как и прежде, сравнение через <>: 
+			изменение значения на пустое или с пустого новую версию не открывает);
+		-- удаленные: terminal_id отсутствует в table_name, актуальная запись имеет deleted_flg = 0.
+	Актуальные записи измененных и удаленных терминалов закрываются датой file_date - 1 секунда,
+	для всех изменений добавляются новые записи с effective_from = file_date
+	(для удаленных терминалов - копия последней записи с deleted_flg = 1).
+	Новые записи получают суррогатный ключ терминала (новые терминалы регистрируются в DWH_DIM_TERMINAL_KEYS 
+	отдельной короткой транзакцией, см. dwh_schema.register_keys_committed).
 	"""
+	register_keys_committed(connection, cursor, 'DWH_DIM_TERMINAL_KEYS', table_name, 'terminal_id')
 	cursor.execute(f"""
+		WITH stg AS (
+			SELECT 
+				t.terminal_id, 
+				t.terminal_type,
+				t.terminal_city,
+				t.terminal_address
+			FROM {table_name} t
+		), 
+		actual AS (
+			SELECT 
+				t.terminal_id, 
+				t.terminal_type,
+				t.terminal_city,
+				t.terminal_address,
+				t.deleted_flg
+			FROM DWH_DIM_TERMINALS_HIST t
+			WHERE t.effective_to = '2999-12-31 23:59:59'
+		), 
+		changes AS (
+			SELECT 
+				t1.terminal_id, 
+				t1.terminal_type,
+				t1.terminal_city,
+				t1.terminal_address,
+				0 deleted_flg,
+				t2.terminal_id IS NOT NULL is_actual_exists
+			FROM stg t1
+			LEFT JOIN actual t2 ON t1.terminal_id = t2.terminal_id
+			WHERE t2.terminal_id IS NULL
+				OR t1.terminal_type <> t2.terminal_type
+				OR t1.terminal_city <> t2.terminal_city
+				OR t1.terminal_address <> t2.terminal_address
+				OR t2.deleted_flg = 1
+			UNION ALL
+			SELECT 
+				t1.terminal_id, 
+				t1.terminal_type,
+				t1.terminal_city,
+				t1.terminal_address,
+				1 deleted_flg,
+				TRUE is_actual_exists
+			FROM actual t1
+			LEFT JOIN stg t2 ON t1.terminal_id = t2.terminal_id
+			WHERE t2.terminal_id IS NULL
+				AND t1.deleted_flg = 0
+		), 
+		closed AS (
+			UPDATE DWH_DIM_TERMINALS_HIST t
+			SET effective_to = %(file_date)s::TIMESTAMP - INTERVAL '1 second'
+			FROM changes c
+			WHERE t.terminal_id = c.terminal_id
+				AND c.is_actual_exists
+				AND t.effective_to = '2999-12-31 23:59:59'
+		)
 		INSERT INTO DWH_DIM_TERMINALS_HIST (
 			terminal_id, 
 			terminal_type, 
 			terminal_city, 
 			terminal_address, 
 			effective_from, 
-			deleted_flg)
+			deleted_flg,
+			terminal_key)
 		SELECT 
-			terminal_id, 
-			terminal_type, 
-			terminal_city, 
-			terminal_address, 
-			'{file_date.strftime('%Y-%m-%d')}'::TIMESTAMP, 
-			{deleted_flg}
-		FROM {source_table_name};
-	""")
-	connection.commit()
+			c.terminal_id, 
+			c.terminal_type, 
+			c.terminal_city, 
+			c.terminal_address, 
+			%(file_date)s::TIMESTAMP, 
+			c.deleted_flg,
+			k.terminal_key
+		FROM changes c
+		LEFT JOIN DWH_DIM_TERMINAL_KEYS k ON c.terminal_id = k.terminal_id;
+	""", {'file_date': file_date.strftime('%Y-%m-%d')})
 
 
-def set_terminals_effective_to(connection, cursor, file_date, source_table_name):
+def update_dwh_table_from_tmp(connection, cursor, file_info, table_name='stg_tmp_loaded'):
 	"""
-	Проставление даты effective_to строкам таблицы DWH_DIM_TERMINALS_HIST.
-	Выбор строк происходит по terminal_id из таблицы source_table_name.
+	Обновление рабочих таблиц на основе временной таблицы table_name (по умолчанию stg_tmp_loaded), 
+	в которую помещается информация из обрабатываемого на данный момент файла.
 	"""
-	cursor.execute(f"""
-		UPDATE DWH_DIM_TERMINALS_HIST
-		SET effective_to = '{file_date.strftime('%Y-%m-%d')}'::TIMESTAMP - INTERVAL '1 second'
-		WHERE effective_to = '2999-12-31 23:59:59'
-			AND terminal_id in (SELECT terminal_id FROM {source_table_name});
-	""")
-	connection.commit()
+	if file_info['info_type'] == 'passport_blacklist':
+		update_passport_blacklist(connection, cursor, table_name)
 
+	elif file_info['info_type'] == 'transactions':
+		update_transactions(connection, cursor, table_name)
 
-def update_terminals(connection, cursor, file_date):
-	"""Обновленые данных о терминалах"""
+	elif file_info['info_type'] == 'terminals':
+		update_terminals(connection, cursor, file_date=file_info['file_date'], table_name=table_name)
 
-	# Выбор данных: новые, измененные, удаленные
-	get_new_terminals(connection, cursor)
-	get_updated_terminals(connection, cursor)
-	get_deleted_terminals(connection, cursor)
+	finish_file_processing(connection, cursor, file_info, table_name)
 
-	# Добавление новых записей в таблицу DWH_DIM_TERMINALS_HIST
-	add_terminals_records(connection, cursor, file_date, source_table_name='STG_TMP_NEW_TERMINALS')
 
-	# Обновление измененных записей в таблице DWH_DIM_TERMINALS_HIST
-	set_terminals_effective_to(connection, cursor, file_date, source_table_name='STG_TMP_UPDATED_TERMINALS')
-	add_terminals_records(connection, cursor, file_date, source_table_name='STG_TMP_UPDATED_TERMINALS')
+def finish_file_processing(connection, cursor, file_info, table_name='stg_tmp_loaded'):
+	"""
+	Фиксирование факта обработки файла в META_FILE_PROCESSING_LOG, 
+	перемещение файла в архив (после COMMIT единицы работы, см. database.after_commit).
+	"""
+	print(f'Файл {file_info['file_name']} обработан')
 
-	# Удаление записей из таблицы DWH_DIM_TERMINALS_HIST
-	set_terminals_effective_to(connection, cursor, file_date, source_table_name='STG_TMP_DELETED_TERMINALS')
-	add_terminals_records(connection, cursor, file_date, source_table_name='STG_TMP_DELETED_TERMINALS', deleted_flg=1)
-	
-	# Удаление временных таблиц
-	drop_table(connection, cursor, 'STG_TMP_NEW_TERMINALS')
-	drop_table(connection, cursor, 'STG_TMP_UPDATED_TERMINALS')
-	drop_table(connection, cursor, 'STG_TMP_DELETED_TERMINALS')
+	set_processing_dt(connection, cursor, entity_id=file_info['id'], rejected_rows=file_info.get('rejected_rows', 0))
+	drop_table(connection, cursor, table_name)
+	after_commit(connection, lambda: move_to_archive(file_info['file_name']))
 
 
-def update_dwh_table_from_tmp(connection, cursor, file_info):
+def process_file(connection, cursor, file_info, settings, table_name='stg_tmp_loaded', prefetched=None):
 	"""
-	Обновление рабочих таблиц на основе временной таблицы stg_tmp_loaded, 
-	в которую помещается информация из обрабатываемого на данный момент файла.
+	Обработка файла-кандидата: сохранение данных во временную таблицу table_name 
+	и обновление соответствующей таблицы.
+
+	Примечание: 
+		-- загрузка во временную таблицу, обновление рабочей таблицы и META_FILE_PROCESSING_LOG 
+		выполняются одной транзакцией (см. database.unit_of_work), файл перемещается в архив после COMMIT;
+		-- если в settings задан chunk_rows или chunk_bytes, файл с транзакциями обрабатывается порциями:
+		каждая порция сразу переносится в DWH_FACT_TRANSACTIONS в рамках той же транзакции;
+		-- из xlsx с 'черным списком' во временную таблицу загружаются только новые паспорта (см. get_blacklist_delta);
+		-- файлы csv/txt других типов читаются теми же порциями, но загружаются во временную таблицу целиком;
+		-- prefetched - данные файла, прочитанные заранее (см. file_processing.prefetch_data).
 	"""
-	if file_info['info_type'] == 'passport_blacklist':
-		update_passport_blacklist(connection, cursor)
+	chunk_rows = int(settings['chunk_rows'])
+	chunk_bytes = int(settings['chunk_bytes'])
 
-	elif file_info['info_type'] == 'transactions':
-		update_transactions(connection, cursor)
+	with unit_of_work(connection):
+		if file_info['info_type'] == 'transactions' and (chunk_rows or chunk_bytes):
+			if data2sql(connection, cursor, file_info, table_name=table_name, 
+					on_chunk=lambda: update_transactions(connection, cursor, table_name), 
+					chunk_rows=chunk_rows, chunk_bytes=chunk_bytes, prefetched=prefetched):
+				finish_file_processing(connection, cursor, file_info, table_name)
 
-	elif file_info['info_type'] == 'terminals':
-		update_terminals(connection, cursor, file_date=file_info['file_date'])
+		elif file_info['info_type'] == 'passport_blacklist':
+			if data2sql(connection, cursor, file_info, table_name=table_name, 
+					transform=lambda df: get_blacklist_delta(cursor, df), 
+					chunk_rows=chunk_rows, chunk_bytes=chunk_bytes, prefetched=prefetched):
+				update_dwh_table_from_tmp(connection, cursor, file_info, table_name)
 
-	print(f'Файл {file_info['file_name']} обработан')
+		elif data2sql(connection, cursor, file_info, table_name=table_name, 
+				chunk_rows=chunk_rows, chunk_bytes=chunk_bytes, prefetched=prefetched):
+			update_dwh_table_from_tmp(connection, cursor, file_info, table_name)
 
-	set_processing_dt(connection, cursor, entity_id=file_info['id'])
-	move_to_archive(file_info['file_name'])
-	drop_table(connection, cursor, 'stg_tmp_loaded')
+
+def prepare_partitions(connection, cursor, candidates):
+	"""
+	Создание секций DWH_FACT_TRANSACTIONS и DWH_DIM_FRAUD заранее - на даты всех файлов с транзакциями 
+	из списка кандидатов на обработку (candidates), и сдвиг границ инкрементального поиска назад 
+	до начала самой ранней даты файла (см. fraud_search.lower_fraud_watermarks). 
+	Так секции создаются, а строки META_FRAUD_WATERMARK изменяются до начала (параллельной) обработки файлов 
+	одной короткой транзакцией, и обработчики файлов не ждут друг друга на этих строках.
+	"""
+	file_dates = [file_info['file_date'] for file_info in candidates if file_info['info_type'] == 'transactions']
+	if file_dates:
+		with unit_of_work(connection):
+			add_dwh_partitions(connection, cursor, min(file_dates), max(file_dates))
+			lower_fraud_watermarks(connection, cursor, min(file_dates))
 
 
-def update_from_files(connection, cursor, config, schema_name):
+def update_from_files(connection, cursor, config, schema_name, settings, file_names=None):
 	"""
 	Обработка новых файлов:
 		-- Фиксирование кандидатов на обработку в таблицу META_FILE_PROCESSING_LOG
@@ -210,15 +300,33 @@ def update_from_files(connection, cursor, config, schema_name):
 			-- Получение информации о кандидате для обработки из таблицы META_FILE_PROCESSING_LOG
 			-- Сохранение данных из файла во временную таблицу
 			-- Обновление соответствующей таблицы
+
+	Примечание: 
+		-- если в settings задано workers > 1, независимые файлы обрабатываются параллельно
+		(см. file_scheduler.process_files_parallel), каждый - в своей временной таблице и своем соединении;
+		-- секции таблиц с транзакциями создаются заранее на даты всех файлов (см. prepare_partitions);
+		-- если задан список file_names, обрабатываются только эти файлы из папки data (см. ingest_service);
+		-- при последовательной обработке (workers = 1) следующие файлы xlsx (и первые порции csv/txt) 
+		разбираются в фоновом потоке, пока текущий файл применяется в БД (см. file_scheduler.process_files_pipelined).
 	"""
-	file_mask = r'(transactions|passport_blacklist|terminals)_(\d{8})\.(txt|csv|xlsx)'
-	find_files_to_process(connection, cursor, file_mask=file_mask)
+	find_files_to_process(connection, cursor, file_mask=FILE_MASK, file_names=file_names)
+	candidates = get_candidates_to_process(cursor)
+	prepare_partitions(connection, cursor, candidates)
 
-	while True:
-		file_info = get_candidate_to_process(cursor)
-		if file_info:
-			data2sql(connection, cursor, file_info, config, table_name='stg_tmp_loaded', schema_name=schema_name)
-			update_dwh_table_from_tmp(connection, cursor, file_info)
-		else:
-			break
+	workers = int(settings['workers'])
+	if workers > 1:
+		process_files_parallel(
+			config, schema_name, 
+			candidates=candidates, 
+			process=lambda connection, cursor, file_info: process_file(
+				connection, cursor, file_info, settings, table_name=f'stg_tmp_loaded_{file_info['id']}'),
+			workers=workers
+		)
+		return
 
+	process_files_pipelined(
+		candidates,
+		prefetch=lambda file_info: prefetch_data(
+			file_info, chunk_rows=int(settings['chunk_rows']), chunk_bytes=int(settings['chunk_bytes'])),
+		process=lambda file_info, prefetched: process_file(connection, cursor, file_info, settings, prefetched=prefetched)
+	)
@@ -0,0 +1,373 @@
+from py_scripts.database import *
+from psycopg2.extras import execute_values
+from datetime import date, timedelta
+
+
+# Первичные ключи таблиц хранилища: {таблица: поля ключа}
+DWH_PRIMARY_KEYS = {
+	'DWH_FACT_TRANSACTIONS': ('trans_id', 'trans_date'),
+	'DWH_FACT_PASSPORT_BLACKLIST': ('passport_num',),
+	'DWH_DIM_TERMINALS_HIST': ('terminal_id', 'effective_from'),
+	'DWH_DIM_FRAUD': ('trans_id', 'trans_date', 'fraud_type_id')
+}
+
+# Таблицы хранилища, секционированные по диапазонам (по месяцам): {таблица: поле секционирования}
+# Поле секционирования входит в первичный ключ таблицы (требование PostgreSQL)
+DWH_PARTITIONED_TABLES = {
+	'DWH_FACT_TRANSACTIONS': 'trans_date',
+	'DWH_DIM_FRAUD': 'trans_date'
+}
+
+# Индексы таблиц хранилища: {индекс: (таблица, поля индекса)}
+DWH_INDEXES = {
+	'IDX_DWH_FACT_TRANSACTIONS_TRANS_DATE': ('DWH_FACT_TRANSACTIONS', ('trans_date',)),
+	'IDX_DWH_FACT_TRANSACTIONS_CARD_KEY': ('DWH_FACT_TRANSACTIONS', ('card_key',)),
+	'IDX_DWH_DIM_TERMINALS_HIST_TERMINAL_ID_EFFECTIVE_TO': ('DWH_DIM_TERMINALS_HIST', ('terminal_id', 'effective_to')),
+	'IDX_DWH_DIM_TERMINALS_HIST_TERMINAL_KEY_EFFECTIVE_TO': ('DWH_DIM_TERMINALS_HIST', ('terminal_key', 'effective_to'))
+}
+
+# Индексы предыдущих версий, которые больше не используются (удаляются при запуске)
+DWH_OBSOLETE_INDEXES = ('IDX_DWH_FACT_TRANSACTIONS_CARD_NUM',)
+
+# Справочники целочисленных суррогатных ключей: {справочник: (поле ключа, поле исходного значения)}
+DWH_KEY_MAPS = {
+	'DWH_DIM_CARD_KEYS': ('card_key', 'card_num'),
+	'DWH_DIM_ACCOUNT_KEYS': ('account_key', 'account'),
+	'DWH_DIM_CLIENT_KEYS': ('client_key', 'client_id'),
+	'DWH_DIM_TERMINAL_KEYS': ('terminal_key', 'terminal_id')
+}
+
+# Поля с суррогатными ключами: {таблица: ((поле ключа, поле исходного значения, справочник), ...)}
+# Новые значения регистрируются в справочниках в порядке DWH_KEY_MAPS, поэтому параллельные транзакции 
+# не блокируют друг друга взаимно
+DWH_KEY_COLUMNS = {
+	'STG_CARDS': (('card_key', 'card_num', 'DWH_DIM_CARD_KEYS'), ('account_key', 'account', 'DWH_DIM_ACCOUNT_KEYS')),
+	'STG_ACCOUNTS': (('account_key', 'account', 'DWH_DIM_ACCOUNT_KEYS'), ('client_key', 'client', 'DWH_DIM_CLIENT_KEYS')),
+	'STG_CLIENTS': (('client_key', 'client_id', 'DWH_DIM_CLIENT_KEYS'),),
+	'DWH_FACT_TRANSACTIONS': (('card_key', 'card_num', 'DWH_DIM_CARD_KEYS'), ('terminal_key', 'terminal', 'DWH_DIM_TERMINAL_KEYS')),
+	'DWH_DIM_TERMINALS_HIST': (('terminal_key', 'terminal_id', 'DWH_DIM_TERMINAL_KEYS'),)
+}
+
+
+def check_if_primary_key_exists(cursor, table_name):
+	"""
+	Проверить, есть ли у таблицы table_name первичный ключ.
+	Возвращает True, если есть; иначе - False.
+	"""
+	cursor.execute("""
+		SELECT 1
+		FROM pg_constraint
+		WHERE conrelid = to_regclass(%s)
+			AND contype = 'p';
+	""", [table_name])
+	return cursor.fetchone() is not None
+
+
+def delete_duplicates(connection, cursor, table_name, columns):
+	"""Удаление из таблицы table_name дублей по полям columns (остается одна строка из дублей)"""
+	condition = ' AND '.join(f't1.{column} = t2.{column}' for column in columns)
+	cursor.execute(f"""
+		DELETE FROM {table_name} t1
+		USING {table_name} t2
+		WHERE {condition}
+			AND t1.ctid > t2.ctid;
+	""")
+
+
+def add_primary_key(connection, cursor, table_name, columns):
+	"""
+	Добавление первичного ключа по полям columns в таблицу table_name, если его еще нет.
+	Если таблица уже заполнена, предварительно удаляются дубли по полям ключа.
+	"""
+	if check_if_primary_key_exists(cursor, table_name):
+		return
+	delete_duplicates(connection, cursor, table_name, columns)
+	cursor.execute(f"""
+		ALTER TABLE {table_name} 
+		ADD CONSTRAINT PK_{table_name} PRIMARY KEY ({', '.join(columns)});
+	""")
+
+
+def add_index(connection, cursor, index_name, table_name, columns, unique=False):
+	"""Создание индекса index_name (unique=True - уникального) по полям columns таблицы table_name, если его еще нет"""
+	cursor.execute(f"""
+		CREATE {'UNIQUE ' if unique else ''}INDEX IF NOT EXISTS {index_name} 
+		ON {table_name} ({', '.join(columns)});
+	""")
+
+
+def check_if_column_exists(cursor, table_name, column):
+	"""
+	Проверить, есть ли в таблице table_name поле column.
+	Возвращает True, если есть; иначе - False.
+	"""
+	cursor.execute("""
+		SELECT 1
+		FROM pg_attribute
+		WHERE attrelid = to_regclass(%s)
+			AND attname = %s
+			AND NOT attisdropped;
+	""", [table_name, column.lower()])
+	return cursor.fetchone() is not None
+
+
+def add_fraud_ids(connection, cursor):
+	"""
+	Добавление ключа fraud_id в DWH_DIM_FRAUD (BIGSERIAL) и в REP_FRAUD (уникальный индекс), если его еще нет.
+	По fraud_id определяется, какие факты мошенничества уже попали в отчет (см. fraud_search.add_rep_fraud_records).
+
+	Примечание: если REP_FRAUD уже заполнена, ее записи сопоставляются с DWH_DIM_FRAUD 
+	по времени операции, паспорту и типу мошенничества (один к одному), 
+	записям без пары fraud_id не проставляется.
+	"""
+	if not check_if_column_exists(cursor, 'DWH_DIM_FRAUD', 'fraud_id'):
+		cursor.execute("""ALTER TABLE DWH_DIM_FRAUD ADD COLUMN fraud_id BIGSERIAL;""")
+
+	if not check_if_column_exists(cursor, 'REP_FRAUD', 'fraud_id'):
+		cursor.execute("""ALTER TABLE REP_FRAUD ADD COLUMN fraud_id BIGINT;""")
+		cursor.execute("""
+			WITH rep AS (
+				SELECT 
+					ctid row_id, 
+					event_dt, 
+					passport, 
+					event_type, 
+					ROW_NUMBER() OVER (PARTITION BY event_dt, passport, event_type ORDER BY ctid) rn
+				FROM REP_FRAUD
+			),
+			fraud AS (
+				SELECT 
+					t0.fraud_id, 
+					t1.trans_date, 
+					t4.passport_num, 
+					t5.fraud_type, 
+					ROW_NUMBER() OVER (PARTITION BY t1.trans_date, t4.passport_num, t5.fraud_type ORDER BY t0.fraud_id) rn
+				FROM DWH_DIM_FRAUD t0
+				INNER JOIN DWH_FACT_TRANSACTIONS t1 ON t0.trans_id = t1.trans_id AND t0.trans_date = t1.trans_date
+				INNER JOIN STG_CARDS t2 ON t1.card_num = t2.card_num
+				INNER JOIN STG_ACCOUNTS t3 ON t2.account = t3.account
+				INNER JOIN STG_CLIENTS t4 ON t3.client = t4.client_id
+				INNER JOIN META_FRAUD_TYPES t5 ON t0.fraud_type_id = t5.fraud_type_id
+			)
+			UPDATE REP_FRAUD t
+			SET fraud_id = f.fraud_id
+			FROM rep r
+			INNER JOIN fraud f 
+				ON r.event_dt = f.trans_date 
+				AND r.passport = f.passport_num 
+				AND r.event_type = f.fraud_type 
+				AND r.rn = f.rn
+			WHERE t.ctid = r.row_id;
+		""")
+
+	add_index(connection, cursor, 'IDX_REP_FRAUD_FRAUD_ID', 'REP_FRAUD', ('fraud_id',), unique=True)
+
+
+def register_keys(connection, cursor, key_map, table_name, column):
+	"""
+	Регистрация в справочнике key_map (см. DWH_KEY_MAPS) значений поля column таблицы table_name, 
+	которым еще не назначен суррогатный ключ.
+	Уже зарегистрированные значения отбрасываются до вставки, поэтому строки справочника блокируются 
+	только для действительно новых значений.
+	"""
+	key_column, value_column = DWH_KEY_MAPS[key_map]
+	cursor.execute(f"""
+		INSERT INTO {key_map} ({value_column})
+		SELECT DISTINCT t.{column}
+		FROM {table_name} t
+		WHERE t.{column} IS NOT NULL
+			AND NOT EXISTS (
+				SELECT 1 
+				FROM {key_map} k 
+				WHERE k.{value_column} = t.{column}
+			)
+		ORDER BY t.{column}
+		ON CONFLICT ({value_column}) DO NOTHING;
+	""")
+
+
+def register_keys_committed(connection, cursor, key_map, table_name, column):
+	"""
+	Регистрация в справочнике key_map новых значений поля column таблицы table_name (см. register_keys) 
+	отдельной короткой транзакцией в другом соединении из общего пула.
+	Используется при параллельной обработке файлов: справочники общие для всех обработчиков, 
+	и вставка внутри длинной транзакции файла заставляла бы остальные обработчики ждать ее COMMIT 
+	на тех же значениях. Новые значения отбираются в текущей транзакции (table_name видна только в ней) 
+	и вставляются по возрастанию, поэтому короткие транзакции не блокируют друг друга взаимно.
+	Зарегистрированные ключи сразу видны следующим запросам текущей транзакции (READ COMMITTED).
+	"""
+	key_column, value_column = DWH_KEY_MAPS[key_map]
+	cursor.execute(f"""
+		SELECT DISTINCT t.{column}
+		FROM {table_name} t
+		WHERE t.{column} IS NOT NULL
+			AND NOT EXISTS (
+				SELECT 1 
+				FROM {key_map} k 
+				WHERE k.{value_column} = t.{column}
+			)
+		ORDER BY t.{column};
+	""")
+	values = cursor.fetchall()
+	if not values:
+		return
+
+	key_connection = get_connection()
+	key_cursor = key_connection.cursor()
+	try:
+		with unit_of_work(key_connection):
+			execute_values(key_cursor, f"""
+				INSERT INTO {key_map} ({value_column}) 
+				VALUES %s
+				ON CONFLICT ({value_column}) DO NOTHING;
+			""", values, page_size=10000)
+	finally:
+		close(key_connection, key_cursor)
+
+
+def fill_keys(connection, cursor, table_name):
+	"""
+	Заполнение полей с суррогатными ключами таблицы table_name (см. DWH_KEY_COLUMNS): 
+	новые значения регистрируются в справочниках, ключи обновляются только в строках, 
+	где они не проставлены или не соответствуют исходному значению (например, у карты сменился счет).
+	"""
+	for key_column, column, key_map in DWH_KEY_COLUMNS[table_name]:
+		register_keys(connection, cursor, key_map, table_name, column)
+		value_column = DWH_KEY_MAPS[key_map][1]
+		cursor.execute(f"""
+			UPDATE {table_name} t
+			SET {key_column} = k.{key_column}
+			FROM {key_map} k
+			WHERE k.{value_column} = t.{column}
+				AND t.{key_column} IS DISTINCT FROM k.{key_column};
+		""")
+		cursor.execute(f"""
+			UPDATE {table_name}
+			SET {key_column} = NULL
+			WHERE {column} IS NULL
+				AND {key_column} IS NOT NULL;
+		""")
+
+
+def update_stg_keys(connection, cursor):
+	"""
+	Актуализация суррогатных ключей карт, счетов и клиентов в таблицах STG_CARDS, STG_ACCOUNTS, STG_CLIENTS.
+	Вызывается перед поиском мошеннических операций: правила соединяют таблицы по ключам (см. fraud_search).
+	"""
+	for table_name in ('STG_CARDS', 'STG_ACCOUNTS', 'STG_CLIENTS'):
+		fill_keys(connection, cursor, table_name)
+
+
+def add_key_columns(connection, cursor):
+	"""
+	Добавление полей с суррогатными ключами (DWH_KEY_COLUMNS) в таблицы, созданные предыдущей версией программы.
+	Если поле добавлено в уже заполненную таблицу, ключи проставляются всем ее строкам (один раз).
+	"""
+	for table_name, key_columns in DWH_KEY_COLUMNS.items():
+		added = False
+		for key_column, _, _ in key_columns:
+			if not check_if_column_exists(cursor, table_name, key_column):
+				cursor.execute(f"""ALTER TABLE {table_name} ADD COLUMN {key_column} INT;""")
+				added = True
+		if added:
+			fill_keys(connection, cursor, table_name)
+
+
+def check_if_partitioned_table(cursor, table_name):
+	"""
+	Проверить, является ли таблица table_name секционированной.
+	Возвращает True, если является; иначе - False.
+	"""
+	cursor.execute("""
+		SELECT 1
+		FROM pg_partitioned_table
+		WHERE partrelid = to_regclass(%s);
+	""", [table_name])
+	return cursor.fetchone() is not None
+
+
+def get_months(start_dt, end_dt):
+	"""Первые числа всех месяцев из промежутка [start_dt, end_dt] (включая месяцы start_dt и end_dt)"""
+	month = date(start_dt.year, start_dt.month, 1)
+	while month <= date(end_dt.year, end_dt.month, 1):
+		yield month
+		month = (month + timedelta(days=32)).replace(day=1)
+
+
+def add_partitions(connection, cursor, table_name, start_dt, end_dt):
+	"""
+	Создание секций таблицы table_name за каждый месяц из промежутка [start_dt, end_dt], если их еще нет.
+	Секция за месяц называется {table_name}_ГГГГММ.
+
+	Примечание: наличие секции сначала проверяется по каталогу, поэтому для уже существующих секций 
+	блокировка на таблицу table_name не берется.
+	"""
+	for month in get_months(start_dt, end_dt):
+		partition_name = f'{table_name}_{month:%Y%m}'
+		cursor.execute("""SELECT to_regclass(%s);""", [partition_name])
+		if cursor.fetchone()[0] is None:
+			next_month = (month + timedelta(days=32)).replace(day=1)
+			cursor.execute(f"""
+				CREATE TABLE IF NOT EXISTS {partition_name} 
+				PARTITION OF {table_name} 
+				FOR VALUES FROM ('{month}') TO ('{next_month}');
+			""")
+
+
+def add_dwh_partitions(connection, cursor, start_dt, end_dt):
+	"""Создание секций всех секционированных таблиц хранилища (DWH_PARTITIONED_TABLES) за промежуток [start_dt, end_dt]"""
+	for table_name in DWH_PARTITIONED_TABLES:
+		add_partitions(connection, cursor, table_name, start_dt, end_dt)
+
+
+def partition_table(connection, cursor, table_name, column):
+	"""
+	Преобразование обычной таблицы table_name в таблицу, секционированную по месяцам по полю column.
+	Данные переносятся в новую таблицу с той же структурой, секции создаются по диапазону данных.
+
+	Примечание: строки с пустым значением column не переносятся (такие строки не попадают ни в одну секцию).
+	Первичный ключ и индексы создаются заново (см. upgrade_dwh_schema).
+	"""
+	cursor.execute(f"""ALTER TABLE {table_name} RENAME TO {table_name}_OLD;""")
+	cursor.execute(f"""
+		CREATE TABLE {table_name} (LIKE {table_name}_OLD INCLUDING DEFAULTS) 
+		PARTITION BY RANGE ({column});
+	""")
+	cursor.execute(f"""SELECT MIN({column}), MAX({column}) FROM {table_name}_OLD;""")
+	start_dt, end_dt = cursor.fetchone()
+	if start_dt:
+		add_partitions(connection, cursor, table_name, start_dt, end_dt)
+	cursor.execute(f"""
+		INSERT INTO {table_name}
+		SELECT * 
+		FROM {table_name}_OLD
+		WHERE {column} IS NOT NULL;
+	""")
+	drop_table(connection, cursor, f'{table_name}_OLD')
+
+
+def upgrade_dwh_schema(connection, cursor):
+	"""
+	Секционирование таблиц (DWH_PARTITIONED_TABLES), добавление первичных ключей и индексов 
+	в таблицы хранилища (DWH_PRIMARY_KEYS, DWH_INDEXES), добавление полей с суррогатными ключами 
+	(см. add_key_columns, update_stg_keys), добавление ключей fraud_id (см. add_fraud_ids).
+	Работает как для новых, так и для уже заполненных таблиц: 
+	заполненные таблицы переносятся в секционированные, отсутствующие ключи и индексы создаются, 
+	существующие не изменяются (кроме неиспользуемых индексов DWH_OBSOLETE_INDEXES, которые удаляются).
+	"""
+	for table_name, column in DWH_PARTITIONED_TABLES.items():
+		if not check_if_partitioned_table(cursor, table_name):
+			partition_table(connection, cursor, table_name, column)
+
+	for table_name, columns in DWH_PRIMARY_KEYS.items():
+		add_primary_key(connection, cursor, table_name, columns)
+
+	add_key_columns(connection, cursor)
+	update_stg_keys(connection, cursor)
+
+	for index_name, (table_name, columns) in DWH_INDEXES.items():
+		add_index(connection, cursor, index_name, table_name, columns)
+	for index_name in DWH_OBSOLETE_INDEXES:
+		cursor.execute(f"""DROP INDEX IF EXISTS {index_name};""")
+
+	add_fraud_ids(connection, cursor)
@@ -1,9 +1,55 @@
 from py_scripts.database import *
-from sqlalchemy import create_engine
+from psycopg2.extras import execute_values
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+import numpy as np
+import openpyxl
+import hashlib
+import io
 import os
 import re
 import shutil
+import time
+import uuid
+
+try:
+	# Необязательная зависимость: быстрая запись DataFrame в csv (см. copy_frame_to_table)
+	import pyarrow
+	import pyarrow.csv
+except ImportError:
+	pyarrow = None
+
+
+# Схемы входных файлов по типу данных (info_type): поле файла -> тип поля временной таблицы.
+# Значения приводятся к этим типам при чтении файла (см. convert_types), поэтому временная таблица
+# создается сразу с нужными типами, и при обновлении рабочих таблиц преобразования в SQL не нужны.
+FILE_SCHEMAS = {
+	'transactions': {
+		'transaction_id': 'VARCHAR(128)',
+		'transaction_date': 'TIMESTAMP',
+		'amount': 'DECIMAL(14,2)',
+		'card_num': 'VARCHAR(128)',
+		'oper_type': 'VARCHAR(128)',
+		'oper_result': 'VARCHAR(128)',
+		'terminal': 'VARCHAR(128)'
+	},
+	'terminals': {
+		'terminal_id': 'VARCHAR(128)',
+		'terminal_type': 'VARCHAR(128)',
+		'terminal_city': 'VARCHAR(128)',
+		'terminal_address': 'VARCHAR(128)'
+	},
+	'passport_blacklist': {
+		'date': 'DATE',
+		'passport': 'VARCHAR(128)'
+	}
+}
+
+# Поля с небольшим количеством различных значений, которые хранятся в памяти как pandas.Categorical
+CATEGORICAL_COLUMNS = ('oper_type', 'oper_result')
+
+# Размер порции (в строках), которыми читаются файлы csv/txt, если chunk_rows и chunk_bytes не заданы (см. csv2sql)
+CSV_CHUNK_ROWS = 100000
 
 
 def create_file_processing_log(connection, cursor, replace=False):
@@ -20,59 +66,71 @@ def create_file_processing_log(connection, cursor, replace=False):
 			file_date_computed DATE,
 			create_dt TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
 			processing_dt TIMESTAMP DEFAULT NULL,
-			error VARCHAR(128) DEFAULT NULL
+			error VARCHAR(128) DEFAULT NULL,
+			file_hash VARCHAR(64),
+			file_size BIGINT,
+			rejected_rows INT
 		);
 	""")
-	connection.commit()
+	# Таблица могла быть создана предыдущей версией программы без полей file_hash, file_size, rejected_rows
+	cursor.execute("""
+		ALTER TABLE META_FILE_PROCESSING_LOG 
+			ADD COLUMN IF NOT EXISTS file_hash VARCHAR(64),
+			ADD COLUMN IF NOT EXISTS file_size BIGINT,
+			ADD COLUMN IF NOT EXISTS rejected_rows INT;
+	""")
+	cursor.execute("""
+		CREATE INDEX IF NOT EXISTS IDX_META_FILE_PROCESSING_LOG_FILE_HASH 
+		ON META_FILE_PROCESSING_LOG (file_hash);
+	""")
 
 
 def set_error_unprocessed(connection, cursor):
 	"""
 	Проставление ошибки на записи в таблице META_FILE_PROCESSING_LOG, 
-	которые не были обработаны во время предыдущей итерации.
+	которые не были обработаны во время предыдущей итерации (одним запросом).
 	"""
 	cursor.execute("""
-		SELECT id
-		FROM META_FILE_PROCESSING_LOG 
+		UPDATE META_FILE_PROCESSING_LOG
+		SET error = 'Обработка была прервана во время предыдущей итерации', 
+			processing_dt = %s
 		WHERE processing_dt IS NULL 
 			AND error IS NULL;
-	""")
-	records = cursor.fetchall()
-	if records:
-		for record in records:
-			set_error(connection, cursor, error='Обработка была прервана во время предыдущей итерации', entity_id=record[0])
-
+	""", [datetime.now()])
 
-def add_file_entity(connection, cursor, name_obj, create_dt):
-	"""Добавление информации об новом файле в таблицу META_FILE_PROCESSING_LOG"""
-	cursor.execute("""
-		INSERT INTO META_FILE_PROCESSING_LOG (file_name, info_type, data_format, file_date, create_dt)
-		VALUES (%s, %s, %s, %s, %s)
-		RETURNING id;
-	""", [name_obj.group(0), name_obj.group(1), name_obj.group(3), name_obj.group(2), create_dt])
-	record = cursor.fetchone()
-	connection.commit()
-	return record[0]
 
-
-def set_file_date_computed(connection, cursor, date, entity_id):
-	"""Запись обработанной даты файла (date) в таблицу META_FILE_PROCESSING_LOG по id сущности (entity_id)"""
-	cursor.execute("""
-		UPDATE META_FILE_PROCESSING_LOG
-		SET file_date_computed = %s
-		WHERE id = %s;
-	""", [date, entity_id])
-	connection.commit()
-
-
-def set_processing_dt(connection, cursor, entity_id):
-	"""Запись даты успешной обработки файла (date) в таблицу META_FILE_PROCESSING_LOG по id сущности (entity_id)"""
+def add_file_entities(connection, cursor, file_infos, create_dt):
+	"""
+	Добавление информации о новых файлах (file_infos) в таблицу META_FILE_PROCESSING_LOG одним запросом: 
+	дата файла, хеш и размер содержимого, ошибка (для файлов с ошибкой сразу проставляется processing_dt).
+	"""
+	execute_values(cursor, """
+		INSERT INTO META_FILE_PROCESSING_LOG (
+			file_name, info_type, data_format, file_date, file_date_computed, 
+			create_dt, processing_dt, error, file_hash, file_size
+		)
+		VALUES %s;
+	""", [
+		(
+			file_info['file_name'], file_info['info_type'], file_info['data_format'], 
+			file_info['file_date'], file_info['file_date_computed'], 
+			create_dt, create_dt if file_info['error'] else None, file_info['error'], 
+			file_info['file_hash'], file_info['file_size']
+		) for file_info in file_infos
+	], page_size=1000)
+
+
+def set_processing_dt(connection, cursor, entity_id, rejected_rows=0):
+	"""
+	Запись даты успешной обработки файла (date) и количества отброшенных строк (rejected_rows, см. convert_types) 
+	в таблицу META_FILE_PROCESSING_LOG по id сущности (entity_id)
+	"""
 	cursor.execute("""
 		UPDATE META_FILE_PROCESSING_LOG
-		SET processing_dt = %s
+		SET processing_dt = %s, 
+			rejected_rows = %s
 		WHERE id = %s;
-	""", [datetime.now(), entity_id])
-	connection.commit()
+	""", [datetime.now(), rejected_rows, entity_id])
 
 
 def set_error(connection, cursor, error, entity_id):
@@ -82,7 +140,6 @@ def set_error(connection, cursor, error, entity_id):
 		SET error = %s, processing_dt = %s
 		WHERE id = %s;
 	""", [error, datetime.now(), entity_id])
-	connection.commit()
 
 
 def get_last_terminal_update_dt(cursor):
@@ -92,80 +149,436 @@ def get_last_terminal_update_dt(cursor):
 	return last_update if last_update else datetime(1900, 1, 1)
 
 
-def check_file_date(connection, cursor, file_info):
+def check_file_date(file_info, now, last_terminal_update):
 	"""
-	Проверка корректности даты в названии файла. 
-	Запись даты и/или запись ошибки в случае некорректной даты:
+	Проверка корректности даты в названии файла (без обращения к БД). 
+	Возвращает дату файла (None, если дата некорректна) и текст ошибки (None, если ошибки нет):
 		-- набор цифр, не являющийся датой в установленном формате
 		-- дата из будущего времени
-		-- (для terminals) в таблице уже есть более актуальные данные
+		-- (для terminals) в таблице уже есть более актуальные данные (last_terminal_update)
 	"""
 	try:
 		# Попытка преобразовать число в названии файла в дату
 		date_computed = datetime.strptime(file_info['file_date'], '%d%m%Y')
-		set_file_date_computed(connection, cursor, date=date_computed, entity_id=file_info['id'])
+	except ValueError:
+		return None, 'Неверная дата в названии файла'
 
-		# Проверка на дату из будущего времени
-		if date_computed > datetime.now():
-			set_error(connection, cursor, error='Дата файла из будущего времени', entity_id=file_info['id'])
-			move_to_archive(file_info['file_name'], archive_dir='archive\\error\\')
+	# Проверка даты на актуальность (для таблицы terminals)
+	if file_info['info_type'] == 'terminals' and date_computed <= last_terminal_update:
+		return date_computed, 'В таблице DWH_DIM_TERMINALS_HIST присутствуют более актуальные данные'
 
-		# Проверка даты на актуальность (для таблицы terminals)
-		if file_info['info_type'] == 'terminals':
-			last_update = get_last_terminal_update_dt(cursor)
-			if date_computed <= last_update:
-				set_error(connection, cursor, 
-					error='В таблице DWH_DIM_TERMINALS_HIST присутствуют более актуальные данные', 
-					entity_id=file_info['id']
-					)
-				move_to_archive(file_info['file_name'], archive_dir='archive\\error\\')
+	# Проверка на дату из будущего времени
+	if date_computed > now:
+		return date_computed, 'Дата файла из будущего времени'
 
-	except ValueError as e:
-		set_error(connection, cursor, error='Неверная дата в названии файла', entity_id=file_info['id'])
-		move_to_archive(file_info['file_name'], archive_dir='archive\\error\\')
+	return date_computed, None
 
 
-def get_file_info_from_dir(connection, cursor, mask, path='data'):
+def get_known_file_names(cursor, file_hashes):
+	"""
+	Файлы из META_FILE_PROCESSING_LOG с хешем содержимого из списка file_hashes, 
+	которые уже обработаны или ожидают обработки (без ошибки).
+	Возвращает словарь {(хеш, размер, тип данных): название самого раннего такого файла}.
+	"""
+	cursor.execute("""
+		SELECT DISTINCT ON (file_hash, file_size, info_type) 
+			file_hash, file_size, info_type, file_name
+		FROM META_FILE_PROCESSING_LOG
+		WHERE file_hash = ANY(%s)
+			AND error IS NULL
+		ORDER BY file_hash, file_size, info_type, id;
+	""", [file_hashes])
+	return {(record[0], record[1], record[2]): record[3] for record in cursor.fetchall()}
+
+
+def get_file_info_from_dir(connection, cursor, mask, path='data', file_names=None):
 	"""
 	Запись в таблицу META_FILE_PROCESSING_LOG информации о новых файлах для обработки из директории path.
 	По умолчанию path = папка data
-	Отбор происходит по маске (mask).
-	Если дата в названии файла не соответствует требованиям, 
-	в таблице META_FILE_PROCESSING_LOG фиксируется соответствующая ошибка.
+	Отбор происходит по маске (mask). Если задан список file_names, рассматриваются только эти файлы.
+	Если дата в названии файла не соответствует требованиям или содержимое файла уже было получено 
+	(в том числе под другим именем), в таблице META_FILE_PROCESSING_LOG фиксируется соответствующая ошибка.
+
+	Примечание: папка просматривается один раз (os.scandir), даты проверяются в Python 
+	с одним запросом даты последнего обновления терминалов, все файлы регистрируются одним запросом.
 	"""
-	files = os.listdir(path)
 	create_dt = datetime.now()
+	file_names = None if file_names is None else set(file_names)
+
+	file_infos = []
+	with os.scandir(path) as entries:
+		for entry in sorted(entries, key=lambda entry: entry.name):
+			name_obj = re.fullmatch(mask, entry.name)
+			if name_obj and entry.is_file() and (file_names is None or entry.name in file_names):
+				file_infos.append({
+					'file_name': name_obj.group(0),
+					'info_type': name_obj.group(1),
+					'data_format': name_obj.group(3),
+					'file_date': name_obj.group(2),
+					'file_hash': get_file_hash(entry.path),
+					'file_size': entry.stat().st_size
+				})
+	if not file_infos:
+		return
+
+	last_terminal_update = get_last_terminal_update_dt(cursor)
+	known_file_names = get_known_file_names(cursor, [file_info['file_hash'] for file_info in file_infos])
+
+	for file_info in file_infos:
+		file_info['file_date_computed'], file_info['error'] = check_file_date(file_info, create_dt, last_terminal_update)
+		archive_dir = 'archive\\error\\'
+
+		# Проверка, что содержимое файла уже было получено (среди зарегистрированных ранее и текущих файлов)
+		content_key = (file_info['file_hash'], file_info['file_size'], file_info['info_type'])
+		if content_key in known_file_names:
+			file_info['error'] = f'Дубликат файла {known_file_names[content_key]}'
+			archive_dir = 'archive\\duplicate\\'
+		elif file_info['error'] is None:
+			known_file_names[content_key] = file_info['file_name']
+
+		if file_info['error']:
+			after_commit(connection, lambda file_name=file_info['file_name'], archive_dir=archive_dir: 
+				move_to_archive(file_name, archive_dir=archive_dir))
+
+	add_file_entities(connection, cursor, file_infos, create_dt)
+
+
+def create_tmp_table(connection, cursor, table_name, schema):
+	"""Пересоздание временной таблицы table_name с полями и типами из schema (см. FILE_SCHEMAS)"""
+	drop_table(connection, cursor, table_name)
+	columns_sql = ', '.join(f'"{column}" {sql_type}' for column, sql_type in schema.items())
+	cursor.execute(f"""CREATE TABLE {table_name} ({columns_sql});""")
+
+
+def copy_to_table(connection, cursor, table_name, columns, file, sep=';'):
+	"""
+	Потоковая загрузка данных из файлового объекта file (формат csv с разделителем sep, без заголовка)
+	в таблицу table_name через COPY FROM STDIN.
+	Возвращает количество загруженных строк.
+	"""
+	columns_sql = ', '.join(f'"{column}"' for column in columns)
+	cursor.copy_expert(f"""
+		COPY {table_name} ({columns_sql}) 
+		FROM STDIN WITH (FORMAT csv, DELIMITER '{sep}');
+	""", file)
+	return cursor.rowcount
+
+
+def copy_frame_to_table(connection, cursor, table_name, df):
+	"""
+	Загрузка DataFrame в таблицу table_name через COPY FROM STDIN. Возвращает количество загруженных строк.
+	Если установлен pyarrow, DataFrame записывается в csv средствами pyarrow (в несколько раз быстрее to_csv).
+	"""
+	if pyarrow is not None:
+		buffer = io.BytesIO()
+		pyarrow.csv.write_csv(
+			pyarrow.Table.from_pandas(df, preserve_index=False), buffer, 
+			pyarrow.csv.WriteOptions(include_header=False, delimiter=';', quoting_style='needed')
+		)
+	else:
+		buffer = io.StringIO()
+		df.to_csv(buffer, sep=';', header=False, index=False)
+	buffer.seek(0)
+	return copy_to_table(connection, cursor, table_name, list(df.columns), buffer)
+
+
+def convert_column(values, sql_type):
+	"""
+	Приведение значений Series к типу поля sql_type (VARCHAR(n), DECIMAL(p,s), TIMESTAMP, DATE).
+	Даты и время разбираются в тех же форматах, что и при приведении ::TIMESTAMP в PostgreSQL 
+	(по умолчанию DateStyle = ISO, MDY: месяц перед днем).
+	Значения, которые привести не удалось (в том числе слишком длинные строки и слишком большие числа), 
+	заменяются на пропуски.
+	"""
+	if sql_type in ('TIMESTAMP', 'DATE'):
+		parsed = pd.to_datetime(values, errors='coerce', format='ISO8601')
+		# Прочие форматы, которые принимало приведение ::TIMESTAMP в PostgreSQL (DateStyle ISO, MDY): 
+		# 01.03.2021 00:00:01 (3 января), 2021/03/01, March 1 2021 и т.п. - разбираются только для значений не в ISO 8601
+		is_other = parsed.isna() & values.notna()
+		if is_other.any():
+			other = values[is_other].astype(str)
+			other_parsed = pd.to_datetime(other, errors='coerce', format='mixed', dayfirst=False)
+			# В отличие от PostgreSQL, разбор pandas меняет день и месяц местами, если месяц больше 12 (13.03.2021)
+			month = pd.to_numeric(other.str.extract(r'^\s*(\d{1,2})[./-]\d{1,2}[./-]\d', expand=False))
+			parsed[is_other] = other_parsed.where(~(month > 12))
+		return parsed.dt.normalize() if sql_type == 'DATE' else parsed
+
+	if sql_type.startswith('DECIMAL'):
+		precision, scale = map(int, re.findall(r'\d+', sql_type))
+		if not pd.api.types.is_numeric_dtype(values):
+			# Дробная часть может быть отделена запятой: 1046,40
+			values = pd.to_numeric(values.astype(str).str.replace(',', '.', regex=False), errors='coerce')
+		return values.where(values.abs() < 10 ** (precision - scale))
+
+	length = int(re.search(r'\d+', sql_type).group())
+	if values.isna().all():
+		# Полностью пустое поле pandas читает как float (NaN), строковые операции к нему неприменимы
+		return values.astype(object)
+	if pd.api.types.infer_dtype(values, skipna=True) != 'string':
+		values = values.where(values.isna(), values.astype(str))
+	return values.where(values.str.len() <= length)
+
+
+def convert_types(df, schema):
+	"""
+	Приведение полей DataFrame к типам схемы schema (см. FILE_SCHEMAS, convert_column).
+	Строки, в которых хотя бы одно значение не удалось привести к типу, отбрасываются 
+	(пустые значения остаются пустыми и ошибкой не считаются).
+	Возвращает DataFrame с полями схемы и количество отброшенных строк.
+	"""
+	missing = [column for column in schema if column not in df.columns]
+	if missing:
+		raise ValueError(f'В файле отсутствуют поля: {", ".join(missing)}')
+
+	converted = pd.DataFrame(index=df.index)
+	is_rejected = np.zeros(len(df), dtype=bool)
+	for column, sql_type in schema.items():
+		values = convert_column(df[column], sql_type)
+		is_rejected |= (df[column].notna() & values.isna()).to_numpy()
+		converted[column] = values.astype('category') if column in CATEGORICAL_COLUMNS else values
+	return converted[~is_rejected], int(is_rejected.sum())
+
 
-	for file_name in files:
-		name_obj = re.fullmatch(mask, file_name)
-		if name_obj:
-			file_info = {
-				'id': add_file_entity(connection, cursor, name_obj, create_dt),
-				'file_name': name_obj.group(0),
-				'info_type': name_obj.group(1),
-				'data_format': name_obj.group(3),
-				'file_date': name_obj.group(2)
-			}
-			check_file_date(connection, cursor, file_info)
-
-
-def data2sql(connection, cursor, file_info, config, table_name, schema_name, data_path='data\\'):
-	"""Считывание данных из csv/txt/xlsx и сохранение во временную таблицу"""
+def frame2sql(connection, cursor, df, table_name, schema, transform=None):
+	"""
+	Приведение типов DataFrame (см. convert_types), применение transform (DataFrame -> DataFrame), если задано, 
+	и загрузка во временную таблицу table_name. Возвращает количество загруженных и отброшенных строк.
+	"""
+	df, rejected = convert_types(df, schema)
+	if transform is not None:
+		df = transform(df)
+	return copy_frame_to_table(connection, cursor, table_name, df), rejected
+
+
+def read_chunks(file, chunk_rows=0, chunk_bytes=0):
+	"""
+	Построчное чтение файлового объекта file порциями.
+	Порция завершается, как только в ней набирается chunk_rows строк или chunk_bytes символов 
+	(нулевое значение параметра - без ограничения).
+	"""
+	chunk, chunk_size = [], 0
+	for line in file:
+		chunk.append(line)
+		chunk_size += len(line)
+		if (chunk_rows and len(chunk) >= chunk_rows) or (chunk_bytes and chunk_size >= chunk_bytes):
+			yield ''.join(chunk)
+			chunk, chunk_size = [], 0
+	if chunk:
+		yield ''.join(chunk)
+
+
+def read_csv_text(file, columns, sep=';'):
+	"""
+	Чтение csv (без заголовка, поля columns) в DataFrame со строковыми значениями.
+	Как и COPY FORMAT csv, пропуском считается только пустое значение.
+	"""
+	return pd.read_csv(file, sep=sep, header=None, names=columns, dtype=str, keep_default_na=False, na_values=[''])
+
+
+def read_csv_frames(file_path, schema, sep=';', chunk_rows=0, chunk_bytes=0):
+	"""
+	Чтение csv/txt порциями по chunk_rows строк и/или chunk_bytes символов 
+	(если оба параметра равны 0 - по CSV_CHUNK_ROWS строк) с приведением типов полей к schema.
+	Названия полей берутся из первой строки файла.
+	Генератор возвращает для каждой порции DataFrame и количество отброшенных строк (см. convert_types).
+	"""
+	if not (chunk_rows or chunk_bytes):
+		chunk_rows = CSV_CHUNK_ROWS
+
+	with open(file_path, 'r', encoding='utf-8-sig', newline='') as file:
+		columns = file.readline().strip().lower().split(sep)
+		missing = [column for column in schema if column not in columns]
+		if missing:
+			raise ValueError(f'В файле отсутствуют поля: {", ".join(missing)}')
+		for chunk in read_chunks(file, chunk_rows=chunk_rows, chunk_bytes=chunk_bytes):
+			yield convert_types(read_csv_text(io.StringIO(chunk), columns, sep=sep), schema)
+
+
+def read_ahead(items, first=None):
+	"""
+	Опережающее чтение генератора items: следующий элемент читается в фоновом потоке, 
+	пока обрабатывается текущий. Если задан first (элемент, прочитанный заранее), он возвращается первым.
+	Ошибка чтения возникает при получении соответствующего элемента.
+	"""
+	with ThreadPoolExecutor(max_workers=1) as executor:
+		future = executor.submit(next, items, None)
+		if first is not None:
+			yield first
+		while True:
+			item = future.result()
+			if item is None:
+				return
+			future = executor.submit(next, items, None)
+			yield item
+
+
+def csv2sql(connection, cursor, file_path, table_name, schema, sep=';', on_chunk=None, chunk_rows=0, chunk_bytes=0, transform=None, prefetched=None):
+	"""
+	Загрузка csv/txt во временную таблицу table_name с типами полей из schema.
+	Если задана функция transform (DataFrame -> DataFrame), загружается результат ее применения к каждой порции.
+	Возвращает количество загруженных и отброшенных строк.
+
+	Примечание: 
+		-- файл всегда читается порциями (см. read_csv_frames), поэтому в памяти одновременно 
+		находится не больше двух порций: следующая порция читается и приводится к типам в фоновом потоке, 
+		пока текущая загружается в БД (см. read_ahead);
+		-- если файл уже читается заранее (prefetched - Future с первой порцией и генератором остальных, 
+		см. prefetch_data), чтение продолжается с него;
+		-- если задан on_chunk, перед каждой порцией таблица table_name очищается, 
+		а после загрузки порции вызывается on_chunk(); иначе во временную таблицу загружается весь файл.
+	"""
+	if prefetched is not None:
+		first, frames = prefetched.result()
+	else:
+		first, frames = None, read_csv_frames(file_path, schema, sep=sep, chunk_rows=chunk_rows, chunk_bytes=chunk_bytes)
+	chunks = read_ahead(frames, first=first)
+	try:
+		create_tmp_table(connection, cursor, table_name, schema)
+		rows, rejected = 0, 0
+		for df, chunk_rejected in chunks:
+			if on_chunk:
+				cursor.execute(f"""TRUNCATE {table_name};""")
+			if transform is not None:
+				df = transform(df)
+			rows += copy_frame_to_table(connection, cursor, table_name, df)
+			rejected += chunk_rejected
+			if on_chunk:
+				on_chunk()
+		return rows, rejected
+	finally:
+		# Сначала дожидаемся фонового чтения, затем закрываем файл
+		chunks.close()
+		frames.close()
+
+
+def get_file_hash(file_path, block_size=1024 * 1024):
+	"""Хеш содержимого файла (SHA-256). Файл читается блоками по block_size байт"""
+	file_hash = hashlib.sha256()
+	with open(file_path, 'rb') as file:
+		for block in iter(lambda: file.read(block_size), b''):
+			file_hash.update(block)
+	return file_hash.hexdigest()
+
+
+def read_xlsx(file_path):
+	"""
+	Чтение первого листа xlsx в DataFrame потоковым читателем openpyxl (read_only): 
+	строки читаются по одной, без построения модели всей книги в памяти.
+	Результат совпадает с pd.read_excel: названия полей берутся из первой строки, 
+	пустые строки в конце листа отбрасываются, дробные поля с целыми значениями приводятся к целым.
+	"""
+	workbook = openpyxl.load_workbook(file_path, read_only=True, data_only=True)
+	try:
+		rows = workbook.active.iter_rows(values_only=True)
+		columns = [str(column).lower() for column in next(rows)]
+		df = pd.DataFrame.from_records(rows, columns=columns)
+	finally:
+		workbook.close()
+
+	filled_rows = df.notna().any(axis=1).to_numpy().nonzero()[0]
+	df = df.iloc[:filled_rows[-1] + 1 if len(filled_rows) else 0]
+	for column in df.columns:
+		values = df[column]
+		if values.dtype == 'float64' and values.notna().all() and (values % 1 == 0).all():
+			df[column] = values.astype('int64')
+	return df
+
+
+def read_xlsx_cached(file_path, file_hash=None, cache_dir='cache\\xlsx\\'):
+	"""
+	Чтение xlsx с кешем разобранных файлов.
+	Результат разбора сохраняется в cache_dir в формате Parquet под именем {хеш содержимого}.parquet, 
+	поэтому повторная обработка того же содержимого (в том числе под другим именем) не требует разбора xlsx.
+	Если сохранить кеш не удалось, файл просто обрабатывается без кеша.
+	Если хеш содержимого уже известен (file_hash из META_FILE_PROCESSING_LOG), файл повторно не хешируется.
+	"""
+	cache_path = cache_dir + (file_hash or get_file_hash(file_path)) + '.parquet'
+	if os.path.exists(cache_path):
+		print(f'Файл {file_path} прочитан из кеша {cache_path}')
+		return pd.read_parquet(cache_path)
+
+	df = read_xlsx(file_path)
+	os.makedirs(cache_dir, exist_ok=True)
+	# Запись через временный файл, чтобы параллельные обработчики не прочитали недописанный кеш
+	tmp_path = f'{cache_path}.{uuid.uuid4().hex}.tmp'
+	try:
+		df.to_parquet(tmp_path, index=False)
+		os.replace(tmp_path, cache_path)
+	except Exception:
+		# Кеш не обязателен: например, не установлен pyarrow или в поле смешаны строки и числа
+		print(f'Файл {file_path} не удалось сохранить в кеш')
+		if os.path.exists(tmp_path):
+			os.remove(tmp_path)
+	return df
+
+
+def xlsx2sql(connection, cursor, file_path, table_name, schema, file_hash=None, transform=None, prefetched=None):
+	"""
+	Загрузка xlsx во временную таблицу table_name с типами полей из schema (с кешем разбора, см. read_xlsx_cached).
+	Если задана функция transform (DataFrame -> DataFrame), загружается результат ее применения к данным файла.
+	Если файл уже читается заранее (prefetched - Future с DataFrame, см. prefetch_data), используется его результат.
+	Возвращает количество загруженных и отброшенных строк.
+	"""
+	df = prefetched.result() if prefetched is not None else read_xlsx_cached(file_path, file_hash=file_hash)
+	create_tmp_table(connection, cursor, table_name, schema)
+	return frame2sql(connection, cursor, df, table_name, schema, transform=transform)
+
+
+def prefetch_data(file_info, data_path='data\\', chunk_rows=0, chunk_bytes=0):
+	"""
+	Чтение данных файла заранее, до обработки (см. file_scheduler.process_files_pipelined).
+	Для xlsx возвращается DataFrame (см. read_xlsx_cached). 
+	Для csv/txt читается и приводится к типам только первая порция (см. read_csv_frames), 
+	возвращаются она и генератор остальных порций - их чтение продолжается при загрузке (см. csv2sql).
+	"""
+	file_path = data_path + file_info['file_name']
+	if file_info['data_format'] == 'xlsx':
+		return read_xlsx_cached(file_path, file_hash=file_info.get('file_hash'))
+	if file_info['data_format'] == 'txt' or file_info['data_format'] == 'csv':
+		schema = FILE_SCHEMAS[file_info['info_type']]
+		frames = read_csv_frames(file_path, schema, chunk_rows=chunk_rows, chunk_bytes=chunk_bytes)
+		return next(frames, None), frames
+	return None
+
+
+def data2sql(connection, cursor, file_info, table_name, data_path='data\\', on_chunk=None, chunk_rows=0, chunk_bytes=0, transform=None, prefetched=None):
+	"""
+	Считывание данных из csv/txt/xlsx и сохранение во временную таблицу через COPY FROM STDIN.
+	Значения приводятся к типам схемы FILE_SCHEMAS[info_type] при чтении, строки с некорректными значениями 
+	отбрасываются, их количество записывается в file_info['rejected_rows'].
+	В консоль выводится скорость загрузки (строк в секунду).
+	Возвращает True, если данные загружены; иначе - False.
+
+	Примечание: 
+		-- для csv/txt можно задать загрузку порциями (chunk_rows, chunk_bytes, on_chunk), см. csv2sql;
+		-- можно задать преобразование данных перед загрузкой (transform), см. frame2sql;
+		-- можно передать данные, прочитанные заранее (prefetched), см. prefetch_data;
+		-- при ошибке чтения откатываются только изменения, сделанные при загрузке файла (см. database.savepoint), 
+		а ошибка фиксируется в META_FILE_PROCESSING_LOG (файл перемещается в архив после COMMIT, см. database.after_commit).
+	"""
 	try:
-		connect_str = f"postgresql://{config['user']}:{config['password']}@{config['host']}:{config['port']}/{config['dbname']}"
-		alch_connection = create_engine(connect_str)
-
-		file_path = data_path + file_info['file_name']
-		if file_info['data_format'] == 'xlsx':
-			df = pd.read_excel(file_path)
-		elif file_info['data_format'] == 'txt' or file_info['data_format'] == 'csv':
-			df = pd.read_csv(file_path, sep=';')
-		else:
-			raise Exception
-		df.to_sql(name=table_name, con=alch_connection, schema=schema_name, if_exists="replace", index=False)
+		with savepoint(cursor, 'data2sql'):
+			start = time.perf_counter()
+			file_path = data_path + file_info['file_name']
+			schema = FILE_SCHEMAS[file_info['info_type']]
+			if file_info['data_format'] == 'xlsx':
+				rows, rejected = xlsx2sql(connection, cursor, file_path, table_name, schema, 
+					file_hash=file_info.get('file_hash'), transform=transform, prefetched=prefetched)
+			elif file_info['data_format'] == 'txt' or file_info['data_format'] == 'csv':
+				rows, rejected = csv2sql(connection, cursor, file_path, table_name, schema, 
+					on_chunk=on_chunk, chunk_rows=chunk_rows, chunk_bytes=chunk_bytes, transform=transform, prefetched=prefetched)
+			else:
+				raise Exception
+			duration = time.perf_counter() - start
+			print(f"Файл {file_info['file_name']} загружен в {table_name}: {rows} строк, {rows / max(duration, 1e-6):.0f} строк/сек")
+			if rejected:
+				print(f"Файл {file_info['file_name']}: отброшено строк с некорректными значениями: {rejected}")
+			file_info['rejected_rows'] = rejected
+			return True
 	except Exception:
 		set_error(connection, cursor, error='Не удалось считать данные', entity_id=file_info['id'])
-		move_to_archive(file_path, archive_dir='archive\\error\\')
+		after_commit(connection, lambda: move_to_archive(file_info['file_name'], archive_dir='archive\\error\\'))
+		return False
 
 
 def move_to_archive(file_name, archive_dir='archive\\', data_dir='data\\'):
@@ -187,26 +600,28 @@ def move_to_archive(file_name, archive_dir='archive\\', data_dir='data\\'):
 		print(f'Файл {file_name} не удалось переместить в архив: файл не найден или произошла другая непредвиденная ошибка')
 	
 
-def get_candidate_to_process(cursor):
+def get_candidates_to_process(cursor):
 	"""
-	Получение кандидата для последующей обработки.
-	Выбирается необработанный файл с самой ранней датой, по алфавиту.
+	Получение всех кандидатов для последующей обработки 
+	в порядке обработки: по дате по возрастанию, далее по алфавиту.
 	"""
 	cursor.execute("""
-		SELECT *
+		SELECT id, file_name, info_type, data_format, file_date_computed, file_hash
 		FROM META_FILE_PROCESSING_LOG 
 		WHERE processing_dt IS NULL 
 			AND error IS NULL
 		ORDER BY file_date_computed, file_name;
 	""")
-	record = cursor.fetchone()
-	return {
-		'id': record[0],
-		'file_name': record[1],
-		'info_type': record[2],
-		'data_format': record[3],
-		'file_date': record[5]
-	} if record else None
+	return [
+		{
+			'id': record[0],
+			'file_name': record[1],
+			'info_type': record[2],
+			'data_format': record[3],
+			'file_date': record[4],
+			'file_hash': record[5]
+		} for record in cursor.fetchall()
+	]
 
 
 def show_latest_errors(cursor, start_dt):
@@ -228,16 +643,19 @@ def show_latest_errors(cursor, start_dt):
 		print('Ошибок в процессе обработки файлов не возникло')
 
 
-def find_files_to_process(connection, cursor, file_mask):
+def find_files_to_process(connection, cursor, file_mask, file_names=None):
 	"""
-	Поиск новых файлов для обработки + запись найденной информации в таблицу META_FILE_PROCESSING_LOG
+	Поиск новых файлов для обработки + запись найденной информации в таблицу META_FILE_PROCESSING_LOG.
+	Если задан список file_names, регистрируются только эти файлы (см. get_file_info_from_dir).
 
 	Примечание: 
 		-- если таблицы META_FILE_PROCESSING_LOG не существует, она будет создана;
-		-- если с прошлого выполнения программы остались необработанные файлы, им будет выставлена ошибка.
+		-- если с прошлого выполнения программы остались необработанные файлы, им будет выставлена ошибка;
+		-- все найденные файлы регистрируются одной транзакцией, файлы с ошибками перемещаются в архив после COMMIT.
 	"""
-	create_file_processing_log(connection, cursor, replace=False)
-	set_error_unprocessed(connection, cursor)
+	with unit_of_work(connection):
+		create_file_processing_log(connection, cursor, replace=False)
+		set_error_unprocessed(connection, cursor)
 
-	get_file_info_from_dir(connection, cursor, mask=file_mask)
+		get_file_info_from_dir(connection, cursor, mask=file_mask, file_names=file_names)
 
@@ -0,0 +1,83 @@
+from py_scripts.database import get_connection, close
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+# Типы файлов, которые должны применяться строго по очереди (по дате):
+# 	-- terminals: SCD2-история строится последовательно от среза к срезу;
+# 	-- passport_blacklist: файлы накопительные и содержат одни и те же паспорта.
+SEQUENTIAL_INFO_TYPES = ('terminals', 'passport_blacklist')
+
+
+def build_dependency_graph(candidates):
+	"""
+	Построение графа зависимостей между кандидатами на обработку.
+	Кандидаты должны быть упорядочены так же, как в get_candidates_to_process.
+	Возвращает словарь {id файла: множество id файлов, которые должны быть обработаны раньше}.
+	"""
+	dependencies = {}
+	last_by_type = {}
+	for file_info in candidates:
+		dependencies[file_info['id']] = set()
+		if file_info['info_type'] in SEQUENTIAL_INFO_TYPES:
+			previous_id = last_by_type.get(file_info['info_type'])
+			if previous_id is not None:
+				dependencies[file_info['id']].add(previous_id)
+			last_by_type[file_info['info_type']] = file_info['id']
+	return dependencies
+
+
+def process_file_in_worker(config, schema_name, process, file_info):
+	"""Обработка одного файла в отдельном соединении из общего пула"""
+	connection = get_connection(config, schema_name)
+	cursor = connection.cursor()
+	try:
+		process(connection, cursor, file_info)
+	finally:
+		close(connection, cursor)
+
+
+def process_files_parallel(config, schema_name, candidates, process, workers):
+	"""
+	Параллельная обработка кандидатов (candidates) в пуле из workers потоков.
+	Файл передается в обработку (process(connection, cursor, file_info)), 
+	как только обработаны все файлы, от которых он зависит (см. build_dependency_graph).
+
+	Примечание: размер пула соединений (db_config.json) должен быть не меньше workers + 1.
+	"""
+	dependencies = build_dependency_graph(candidates)
+	waiting = {file_info['id']: file_info for file_info in candidates}
+	done_ids = set()
+	running = {}
+
+	with ThreadPoolExecutor(max_workers=workers) as executor:
+		while waiting or running:
+			for file_id, file_info in list(waiting.items()):
+				if dependencies[file_id] <= done_ids:
+					future = executor.submit(process_file_in_worker, config, schema_name, process, file_info)
+					running[future] = file_id
+					del waiting[file_id]
+
+			finished, _ = wait(running, return_when=FIRST_COMPLETED)
+			for future in finished:
+				future.result()
+				done_ids.add(running.pop(future))
+
+
+def process_files_pipelined(candidates, prefetch, process, depth=2):
+	"""
+	Последовательная обработка кандидатов (candidates) в заданном порядке с опережающим чтением файлов:
+	пока обрабатывается текущий файл, следующие depth файлов читаются в фоновом потоке (prefetch(file_info)).
+	Файл передается в обработку вместе с Future результата чтения: process(file_info, prefetched).
+
+	Примечание: 
+		-- в памяти одновременно находится не больше depth + 1 прочитанных файлов;
+		-- ошибка чтения возвращается из prefetched.result() во время обработки файла, 
+		поэтому обрабатывается так же, как при чтении без опережения.
+	"""
+	prefetched = {}
+	with ThreadPoolExecutor(max_workers=1) as executor:
+		for position, file_info in enumerate(candidates):
+			for next_file_info in candidates[position:position + depth + 1]:
+				if next_file_info['id'] not in prefetched:
+					prefetched[next_file_info['id']] = executor.submit(prefetch, next_file_info)
+			process(file_info, prefetched.pop(file_info['id']))
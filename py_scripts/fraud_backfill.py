@@ -0,0 +1,126 @@
+from py_scripts.database import get_connection, close, close_pool, unit_of_work
+from py_scripts.fraud_search import find_frauds, add_rep_fraud_records, refresh_card_profiles
+from py_scripts.dwh_schema import update_stg_keys
+from py_scripts.fraud_stream import ALL_RULES
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import multiprocessing
+import psycopg2
+import datetime
+import atexit
+import time
+
+
+# Размер промежутка (шарда), на которые делится период пересчета
+SHARD_SIZES = {
+	'day': datetime.timedelta(days=1),
+	'hour': datetime.timedelta(hours=1)
+}
+
+# Коды ошибок PostgreSQL, после которых промежуток пересчитывается повторно: взаимоблокировка и сбой сериализации.
+# Соседние промежутки записывают пересекающиеся факты правил 3 и 4 (см. backfill_shard) в параллельных транзакциях
+RETRY_PGCODES = ('40P01', '40001')
+
+# Количество попыток пересчета одного промежутка
+MAX_SHARD_ATTEMPTS = 3
+
+
+def get_shards(start_dt, end_dt, shard='day'):
+	"""Разбиение периода [start_dt, end_dt) на последовательные промежутки длиной shard ('day' или 'hour')"""
+	step = SHARD_SIZES[shard]
+	shards = []
+	while start_dt < end_dt:
+		shards.append((start_dt, min(start_dt + step, end_dt)))
+		start_dt += step
+	return shards
+
+
+def count_frauds(cursor, start_dt, end_dt):
+	"""Количество фактов мошенничества в DWH_DIM_FRAUD за период [start_dt, end_dt)"""
+	cursor.execute("""
+		SELECT COUNT(*)
+		FROM DWH_DIM_FRAUD
+		WHERE trans_date >= %s::TIMESTAMP
+			AND trans_date < %s::TIMESTAMP;
+	""", [start_dt, end_dt])
+	return cursor.fetchone()[0]
+
+
+def init_worker():
+	"""
+	Инициализация процесса пересчета: общий пул соединений процесса (см. database.get_engine) 
+	создается при обработке первого промежутка, используется всеми промежутками процесса 
+	и закрывается один раз - при завершении процесса (процессы запускаются методом spawn, поэтому atexit выполняется).
+	"""
+	atexit.register(close_pool)
+
+
+def backfill_shard(config, schema_name, start_dt, end_dt, engine='queries'):
+	"""
+	Поиск мошеннических операций и дополнение REP_FRAUD за промежуток [start_dt, end_dt)
+	в отдельном процессе со своим соединением с БД (из пула процесса, см. init_worker).
+	Возвращает количество фактов мошенничества за промежуток и время обработки в секундах.
+
+	Примечание: правила 3 и 4 сами читают транзакции за час / 20 минут до start_dt (как контекст),
+	поэтому результат не зависит от того, как период разбит на промежутки; 
+	эти окна перекрываются с концом предыдущего промежутка, т.е. часть транзакций читается дважды.
+	Повторно найденные факты отбрасываются по первичному ключу DWH_DIM_FRAUD и ключу fraud_id в REP_FRAUD.
+	Поэтому соседние промежутки, обрабатываемые одновременно, вставляют одни и те же строки и ждут друг друга; 
+	если транзакция промежутка прервана взаимоблокировкой или сбоем сериализации (RETRY_PGCODES), 
+	она откатывается и промежуток пересчитывается заново (не больше MAX_SHARD_ATTEMPTS попыток).
+	"""
+	start = time.perf_counter()
+	connection = get_connection(config, schema_name)
+	cursor = connection.cursor()
+	try:
+		for attempt in range(1, MAX_SHARD_ATTEMPTS + 1):
+			try:
+				with unit_of_work(connection):
+					find_frauds(connection, cursor, {fraud_type_id: start_dt for fraud_type_id in ALL_RULES}, end_dt, engine=engine)
+					add_rep_fraud_records(connection, cursor, start_dt, end_dt)
+				break
+			except psycopg2.Error as error:
+				if error.pgcode not in RETRY_PGCODES or attempt == MAX_SHARD_ATTEMPTS:
+					raise
+				print(f'Промежуток {start_dt} - {end_dt}: {type(error).__name__}, попытка {attempt + 1} из {MAX_SHARD_ATTEMPTS}')
+		frauds = count_frauds(cursor, start_dt, end_dt)
+	finally:
+		close(connection, cursor)
+	return frauds, time.perf_counter() - start
+
+
+def backfill_frauds(config, schema_name, start_dt, end_dt, shard='day', processes=4, engine='queries'):
+	"""
+	Пересчет поиска мошеннических операций за период [start_dt, end_dt):
+	период делится на промежутки (см. get_shards), которые обрабатываются параллельно в processes процессах.
+	В консоль выводится прогресс и время обработки каждого промежутка.
+
+	Примечание: процессы запускаются методом spawn (одинаково в Windows и Linux),
+	каждый процесс открывает собственное соединение с БД. Суррогатные ключи в STG_CARDS, STG_ACCOUNTS, STG_CLIENTS
+	и профили карт актуализируются один раз до запуска процессов (см. dwh_schema.update_stg_keys, 
+	fraud_search.refresh_card_profiles).
+	"""
+	shards = get_shards(start_dt, end_dt, shard=shard)
+
+	connection = get_connection(config, schema_name)
+	cursor = connection.cursor()
+	try:
+		with unit_of_work(connection):
+			update_stg_keys(connection, cursor)
+			refresh_card_profiles(connection, cursor)
+	finally:
+		close(connection, cursor)
+	print(f'Пересчет за период {start_dt} - {end_dt}: {len(shards)} промежутков, {processes} процессов')
+
+	start = time.perf_counter()
+	context = multiprocessing.get_context('spawn')
+	with ProcessPoolExecutor(max_workers=processes, mp_context=context, initializer=init_worker) as executor:
+		futures = {
+			executor.submit(backfill_shard, config, schema_name, shard_start_dt, shard_end_dt, engine): (shard_start_dt, shard_end_dt)
+			for shard_start_dt, shard_end_dt in shards
+		}
+		for done, future in enumerate(as_completed(futures), 1):
+			shard_start_dt, shard_end_dt = futures[future]
+			frauds, duration = future.result()
+			print(f'[{done}/{len(shards)}] {shard_start_dt} - {shard_end_dt}: {duration:.1f} сек, фактов мошенничества: {frauds}')
+
+	print(f'Пересчет завершен за {time.perf_counter() - start:.1f} сек')
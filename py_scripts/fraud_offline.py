@@ -0,0 +1,231 @@
+import pandas as pd
+import numpy as np
+import datetime
+import io
+
+
+def read_sql_copy(cursor, query, params=None, **read_csv_kwargs):
+	"""
+	Чтение результата запроса query в DataFrame через COPY TO STDOUT.
+	Для больших выборок это значительно быстрее, чем построчное чтение курсором.
+	"""
+	if params:
+		query = cursor.mogrify(query, params).decode()
+	buffer = io.StringIO()
+	cursor.copy_expert(f"""COPY ({query}) TO STDOUT WITH (FORMAT csv, HEADER true);""", buffer)
+	buffer.seek(0)
+	return pd.read_csv(buffer, **read_csv_kwargs)
+
+
+def load_offline_data(cursor, start_dt, end_dt):
+	"""
+	Загрузка в память данных для поиска мошеннических операций за период [start_dt, end_dt):
+		-- транзакции за период с учетом часа до начала периода (для правила 3);
+		-- карты, счета, клиенты, 'черный список' паспортов;
+		-- история терминалов (SCD2).
+	"""
+	transactions = read_sql_copy(cursor, """
+		SELECT trans_id, trans_date, card_num, oper_type, amt, oper_result, terminal
+		FROM DWH_FACT_TRANSACTIONS
+		WHERE trans_date >= %s::TIMESTAMP - INTERVAL '1 hour'
+			AND trans_date < %s::TIMESTAMP
+	""", [start_dt, end_dt],
+		dtype={'trans_id': str, 'card_num': 'category', 'oper_type': 'category', 'oper_result': 'category', 'terminal': 'category'},
+		parse_dates=['trans_date'], date_format='%Y-%m-%d %H:%M:%S')
+	cards = read_sql_copy(cursor, """SELECT card_num, account FROM STG_CARDS""", dtype=str)
+	accounts = read_sql_copy(cursor, """SELECT account, valid_to, client FROM STG_ACCOUNTS""",
+		dtype={'account': str, 'client': str}, parse_dates=['valid_to'], date_format='%Y-%m-%d')
+	clients = read_sql_copy(cursor, """SELECT client_id, passport_num, passport_valid_to FROM STG_CLIENTS""",
+		dtype={'client_id': str, 'passport_num': str}, parse_dates=['passport_valid_to'], date_format='%Y-%m-%d')
+	blacklist = read_sql_copy(cursor, """SELECT passport_num FROM DWH_FACT_PASSPORT_BLACKLIST""", dtype=str)
+	# Дата '2999-12-31 23:59:59' не помещается в pandas.Timestamp, поэтому effective_to ограничивается сверху
+	terminals = read_sql_copy(cursor, """
+		SELECT 
+			terminal_id, 
+			effective_from, 
+			LEAST(effective_to, '2200-01-01'::TIMESTAMP) effective_to, 
+			terminal_city
+		FROM DWH_DIM_TERMINALS_HIST
+	""", dtype={'terminal_id': str, 'terminal_city': str}, 
+		parse_dates=['effective_from', 'effective_to'], date_format='%Y-%m-%d %H:%M:%S')
+	return transactions, cards, accounts, clients, blacklist, terminals
+
+
+def get_codes(values, categories):
+	"""Целочисленные позиции значений Series values в справочнике categories (-1, если значения нет в справочнике)"""
+	index = pd.Index(categories)
+	if isinstance(values.dtype, pd.CategoricalDtype):
+		codes = values.cat.codes.to_numpy()
+		category_positions = index.get_indexer(values.cat.categories)
+		return np.where(codes >= 0, category_positions[codes], -1)
+	return index.get_indexer(values)
+
+
+def is_same_account(account_codes, periods):
+	"""Признак того, что операция на periods позиций раньше относится к тому же счету"""
+	result = np.zeros(len(account_codes), dtype=bool)
+	result[periods:] = account_codes[periods:] == account_codes[:-periods]
+	return result
+
+
+def shift(values, periods):
+	"""Сдвиг массива values на periods позиций назад (первые periods позиций заполняются исходными значениями)"""
+	result = values.copy()
+	result[periods:] = values[:-periods]
+	return result
+
+
+def get_card_profiles(cards, accounts, clients, blacklist):
+	"""
+	Профиль каждой карты: счет, признаки наличия счета и клиента, 
+	момент окончания действия договора и паспорта, признак паспорта в 'черном списке'.
+	"""
+	profiles = cards.merge(accounts, on='account', how='left', indicator='account_found')
+	profiles = profiles.merge(clients, left_on='client', right_on='client_id', how='left')
+	profiles = profiles.drop_duplicates('card_num')
+	one_day = pd.Timedelta(days=1)
+	return pd.DataFrame({
+		'card_num': profiles['card_num'],
+		'account': profiles['account'],
+		'has_account': (profiles['account_found'] == 'both').to_numpy(),
+		'has_client': profiles['client_id'].notna().to_numpy(),
+		'contract_invalid_from': profiles['valid_to'] + one_day,
+		'passport_invalid_from': profiles['passport_valid_to'] + one_day,
+		'is_blacklisted': profiles['passport_num'].isin(blacklist['passport_num']).to_numpy()
+	})
+
+
+def find_terminal_cities(terminal, trans_seconds, terminals):
+	"""
+	Интервальный поиск по истории терминалов (SCD2): город терминала на момент операции.
+	Для каждой операции строится ключ (код терминала, время в секундах), по которому бинарным поиском
+	находится последняя запись истории с effective_from <= trans_date; затем проверяется trans_date <= effective_to.
+	Возвращает код города для каждой операции и признак того, что действующая запись терминала найдена.
+	Если история терминалов пуста, ни для одной операции запись не находится.
+	"""
+	if len(terminals) == 0:
+		return np.full(len(trans_seconds), -1, dtype=np.int64), np.zeros(len(trans_seconds), dtype=bool)
+
+	history_codes, terminal_ids = pd.factorize(terminals['terminal_id'])
+	city_codes, _ = pd.factorize(terminals['terminal_city'])
+	history_from = terminals['effective_from'].to_numpy().astype('datetime64[s]').astype(np.int64)
+	history_to = terminals['effective_to'].to_numpy().astype('datetime64[s]').astype(np.int64)
+	history_key = history_codes.astype(np.int64) * 2**34 + history_from
+
+	order = np.argsort(history_key, kind='stable')
+	history_key, history_to, history_codes, city_codes = (
+		history_key[order], history_to[order], history_codes[order], city_codes[order])
+
+	terminal_codes = get_codes(terminal, terminal_ids)
+	trans_key = terminal_codes.astype(np.int64) * 2**34 + trans_seconds
+	position = np.searchsorted(history_key, trans_key, side='right') - 1
+	found = (terminal_codes >= 0) & (position >= 0)
+	position = np.clip(position, 0, len(history_key) - 1)
+	found &= (history_codes[position] == terminal_codes) & (trans_seconds <= history_to[position])
+	return np.where(found, city_codes[position], -1), found
+
+
+def evaluate_frauds_offline(transactions, cards, accounts, clients, blacklist, terminals, start_dt):
+	"""
+	Векторизованная проверка всех признаков мошенничества.
+	Операции сортируются по счету и времени один раз, вместо LAG используются сдвинутые массивы.
+	Возвращает DataFrame (trans_id, trans_date, fraud_type_id) без дублей.
+	"""
+	start_dt = pd.Timestamp(start_dt)
+	profiles = get_card_profiles(cards, accounts, clients, blacklist)
+
+	# Соединение с картами (INNER JOIN STG_CARDS)
+	card_index = get_codes(transactions['card_num'], profiles['card_num'])
+	transactions = transactions[card_index >= 0]
+	card_index = card_index[card_index >= 0]
+	account_codes, _ = pd.factorize(profiles['account'].to_numpy()[card_index])
+
+	# Сортировка по счету и времени операции
+	trans_date = transactions['trans_date'].to_numpy()
+	order = np.lexsort((trans_date, account_codes))
+	transactions = transactions.iloc[order]
+	card_index, account_codes, trans_date = card_index[order], account_codes[order], trans_date[order]
+	trans_seconds = trans_date.astype('datetime64[s]').astype(np.int64)
+
+	frauds = []
+
+	# Правила 1 и 2
+	in_period = trans_date >= start_dt.to_datetime64()
+	contract_invalid_from = profiles['contract_invalid_from'].to_numpy()[card_index]
+	passport_invalid_from = profiles['passport_invalid_from'].to_numpy()[card_index]
+	is_passport_fraud = in_period & profiles['has_client'].to_numpy()[card_index] & (
+		(trans_date >= passport_invalid_from) | profiles['is_blacklisted'].to_numpy()[card_index])
+	is_contract_fraud = in_period & profiles['has_account'].to_numpy()[card_index] & (trans_date >= contract_invalid_from)
+	frauds.append((is_passport_fraud, 1))
+	frauds.append((is_contract_fraud, 2))
+
+	# Правило 3: операции в выборке - те, для которых найдена действующая запись терминала
+	city_codes, has_terminal = find_terminal_cities(transactions['terminal'], trans_seconds, terminals)
+	subset = np.flatnonzero(has_terminal)
+	accounts_3, seconds_3, cities_3 = account_codes[subset], trans_seconds[subset], city_codes[subset]
+	is_cities_fraud = np.zeros(len(transactions), dtype=bool)
+	if len(subset) > 1:
+		previous_city = shift(cities_3, 1)
+		is_cities_fraud[subset] = (
+			is_same_account(accounts_3, 1)
+			& (cities_3 >= 0) & (previous_city >= 0) & (cities_3 != previous_city)
+			& (seconds_3 - shift(seconds_3, 1) <= 3600)
+		)
+	frauds.append((is_cities_fraud, 3))
+
+	# Правило 4: операции в выборке - оплата/снятие не раньше чем за 20 минут до начала периода
+	subset = np.flatnonzero(
+		transactions['oper_type'].isin(['PAYMENT', 'WITHDRAW']).to_numpy()
+		& (trans_date >= (start_dt - pd.Timedelta(minutes=20)).to_datetime64())
+	)
+	accounts_4, seconds_4 = account_codes[subset], trans_seconds[subset]
+	amt_4 = transactions['amt'].to_numpy()[subset]
+	is_reject = (transactions['oper_result'] == 'REJECT').to_numpy()[subset]
+	is_success = (transactions['oper_result'] == 'SUCCESS').to_numpy()[subset]
+	is_amt_fraud = np.zeros(len(transactions), dtype=bool)
+	if len(subset) > 2:
+		is_amt_fraud[subset] = (
+			is_same_account(accounts_4, 2)
+			& (seconds_4 - shift(seconds_4, 2) <= 1200)
+			& (shift(amt_4, 2) > shift(amt_4, 1)) & (shift(amt_4, 1) > amt_4)
+			& shift(is_reject, 2) & shift(is_reject, 1) & is_success
+		)
+	frauds.append((is_amt_fraud, 4))
+
+	return pd.concat([
+		transactions.loc[is_fraud, ['trans_id', 'trans_date']].assign(fraud_type_id=fraud_type_id)
+		for is_fraud, fraud_type_id in frauds
+	])
+
+
+def add_fraud_records_bulk(connection, cursor, frauds):
+	"""Запись найденных мошеннических операций в DWH_DIM_FRAUD через COPY во временную таблицу"""
+	cursor.execute("""
+		CREATE TEMP TABLE STG_TMP_FRAUD (
+			trans_id VARCHAR(128),
+			trans_date TIMESTAMP,
+			fraud_type_id INT
+		) ON COMMIT DROP;
+	""")
+	buffer = io.StringIO()
+	frauds[['trans_id', 'trans_date', 'fraud_type_id']].to_csv(buffer, header=False, index=False)
+	buffer.seek(0)
+	cursor.copy_expert("""COPY STG_TMP_FRAUD FROM STDIN WITH (FORMAT csv);""", buffer)
+	cursor.execute("""
+		INSERT INTO DWH_DIM_FRAUD (trans_id, trans_date, fraud_type_id)
+		SELECT t.trans_id, t.trans_date, t.fraud_type_id
+		FROM STG_TMP_FRAUD t
+		ON CONFLICT (trans_id, trans_date, fraud_type_id) DO NOTHING;
+	""")
+
+
+def find_frauds_offline(connection, cursor, start_dt, end_dt):
+	"""
+	Поиск мошеннических операций за период [start_dt, end_dt) в памяти (pandas/NumPy)
+	без оконных запросов к БД. Предназначен для пересчета истории.
+	Результат совпадает с поиском запросами из fraud_search.
+	"""
+	start_dt = datetime.datetime.fromisoformat(str(start_dt))
+	data = load_offline_data(cursor, start_dt, end_dt)
+	frauds = evaluate_frauds_offline(*data, start_dt=start_dt)
+	add_fraud_records_bulk(connection, cursor, frauds)
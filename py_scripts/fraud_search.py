@@ -1,8 +1,21 @@
-from py_scripts.database import drop_table
+from py_scripts.database import get_connection, close, unit_of_work, check_if_empty_table
+from py_scripts.dwh_schema import update_stg_keys
+from py_scripts.fraud_stream import find_frauds_stream, add_fraud_records, ALL_RULES
+from py_scripts.fraud_offline import find_frauds_offline
+from concurrent.futures import ThreadPoolExecutor
 import datetime
 import json
 
 
+# Источники профилей карт (см. refresh_card_profiles): {таблица: дата изменения строки t}
+CARD_PROFILE_SOURCES = {
+	'STG_CARDS': 'COALESCE({t}.update_dt, {t}.create_dt)',
+	'STG_ACCOUNTS': 'COALESCE({t}.update_dt, {t}.create_dt)',
+	'STG_CLIENTS': 'COALESCE({t}.update_dt, {t}.create_dt)',
+	'DWH_FACT_PASSPORT_BLACKLIST': '{t}.entry_dt'
+}
+
+
 def find_passport_expired(connection, cursor, start_dt, end_dt, fraud_type_id=1):
 	"""
 	Поиск операций, совершенных при просроченном паспорте.
@@ -12,15 +25,12 @@ def find_passport_expired(connection, cursor, start_dt, end_dt, fraud_type_id=1)
 		INSERT INTO DWH_DIM_FRAUD (trans_id, trans_date, fraud_type_id)
 		SELECT t1.trans_id, t1.trans_date, %s
 		FROM DWH_FACT_TRANSACTIONS t1
-		INNER JOIN STG_CARDS t2 ON t1.card_num = t2.card_num
-		INNER JOIN STG_ACCOUNTS t3 ON t2.account = t3.account
-		INNER JOIN STG_CLIENTS t4 ON t3.client = t4.client_id
+		INNER JOIN DWH_DIM_CARD_PROFILES t2 ON t1.card_key = t2.card_key
 		WHERE t1.trans_date >= %s::TIMESTAMP 
 			AND t1.trans_date < %s::TIMESTAMP
-			AND t1.trans_date >= t4.passport_valid_to + INTERVAL '1 day'
-			AND t1.trans_id NOT IN (SELECT trans_id FROM DWH_DIM_FRAUD WHERE fraud_type_id = %s);
-	""", [fraud_type_id, start_dt, end_dt, fraud_type_id])
-	connection.commit()
+			AND t1.trans_date >= t2.passport_valid_to + INTERVAL '1 day'
+		ON CONFLICT (trans_id, trans_date, fraud_type_id) DO NOTHING;
+	""", [fraud_type_id, start_dt, end_dt])
 
 
 def find_passport_blocked(connection, cursor, start_dt, end_dt, fraud_type_id=1):
@@ -29,15 +39,12 @@ def find_passport_blocked(connection, cursor, start_dt, end_dt, fraud_type_id=1)
 		INSERT INTO DWH_DIM_FRAUD (trans_id, trans_date, fraud_type_id)
 		SELECT t1.trans_id, t1.trans_date, %s
 		FROM DWH_FACT_TRANSACTIONS t1
-		INNER JOIN STG_CARDS t2 ON t1.card_num = t2.card_num
-		INNER JOIN STG_ACCOUNTS t3 ON t2.account = t3.account
-		INNER JOIN STG_CLIENTS t4 ON t3.client = t4.client_id
-		INNER JOIN DWH_FACT_PASSPORT_BLACKLIST t5 ON t4.passport_num = t5.passport_num
+		INNER JOIN DWH_DIM_CARD_PROFILES t2 ON t1.card_key = t2.card_key
 		WHERE t1.trans_date >= %s::TIMESTAMP 
 			AND t1.trans_date < %s::TIMESTAMP
-			AND t1.trans_id NOT IN (SELECT trans_id FROM DWH_DIM_FRAUD WHERE fraud_type_id = %s);
-	""", [fraud_type_id, start_dt, end_dt, fraud_type_id])
-	connection.commit()
+			AND t2.is_blacklisted
+		ON CONFLICT (trans_id, trans_date, fraud_type_id) DO NOTHING;
+	""", [fraud_type_id, start_dt, end_dt])
 
 
 def find_contract_expired(connection, cursor, start_dt, end_dt, fraud_type_id=2):
@@ -49,14 +56,12 @@ def find_contract_expired(connection, cursor, start_dt, end_dt, fraud_type_id=2)
 		INSERT INTO DWH_DIM_FRAUD (trans_id, trans_date, fraud_type_id)
 		SELECT t1.trans_id, t1.trans_date, %s
 		FROM DWH_FACT_TRANSACTIONS t1
-		INNER JOIN STG_CARDS t2 ON t1.card_num = t2.card_num
-		INNER JOIN STG_ACCOUNTS t3 ON t2.account = t3.account
+		INNER JOIN DWH_DIM_CARD_PROFILES t2 ON t1.card_key = t2.card_key
 		WHERE t1.trans_date >= %s::TIMESTAMP 
 			AND t1.trans_date < %s::TIMESTAMP
-			AND t1.trans_date >= t3.valid_to + INTERVAL '1 day'
-			AND t1.trans_id NOT IN (SELECT trans_id FROM DWH_DIM_FRAUD WHERE fraud_type_id = %s);
-	""", [fraud_type_id, start_dt, end_dt, fraud_type_id])
-	connection.commit()
+			AND t1.trans_date >= t2.valid_to + INTERVAL '1 day'
+		ON CONFLICT (trans_id, trans_date, fraud_type_id) DO NOTHING;
+	""", [fraud_type_id, start_dt, end_dt])
 
 
 def find_different_cities(connection, cursor, start_dt, end_dt, fraud_type_id=3):
@@ -67,24 +72,23 @@ def find_different_cities(connection, cursor, start_dt, end_dt, fraud_type_id=3)
 		FROM (
 			SELECT 
 				t1.trans_id, 
-				t2.account,
+				t2.account_key,
 				t1.trans_date, 
-				LAG(t1.trans_date) OVER (PARTITION BY t2.account ORDER BY t2.account, t1.trans_date) previous_trans_date,
+				LAG(t1.trans_date) OVER (PARTITION BY t2.account_key ORDER BY t2.account_key, t1.trans_date) previous_trans_date,
 				t3.terminal_city, 
-				LAG(t3.terminal_city) OVER (PARTITION BY t2.account ORDER BY t2.account, t1.trans_date) previous_terminal_city	
+				LAG(t3.terminal_city) OVER (PARTITION BY t2.account_key ORDER BY t2.account_key, t1.trans_date) previous_terminal_city	
 			FROM DWH_FACT_TRANSACTIONS t1
-			INNER JOIN STG_CARDS t2 ON t1.card_num = t2.card_num
+			INNER JOIN DWH_DIM_CARD_PROFILES t2 ON t1.card_key = t2.card_key
 			INNER JOIN DWH_DIM_TERMINALS_HIST t3
-				ON t1.terminal = t3.terminal_id 
+				ON t1.terminal_key = t3.terminal_key 
 					AND t1.trans_date BETWEEN t3.effective_from AND t3.effective_to
 			WHERE t1.trans_date >= %s::TIMESTAMP - INTERVAL '1 hour' 
 				AND t1.trans_date < %s::TIMESTAMP
 		) t 
 		WHERE t.terminal_city <> t.previous_terminal_city
 			AND EXTRACT(EPOCH FROM (trans_date - previous_trans_date))/60 <= 60
-			AND t.trans_id NOT IN (SELECT trans_id FROM DWH_DIM_FRAUD WHERE fraud_type_id = %s);
-	""", [fraud_type_id, start_dt, end_dt, fraud_type_id])
-	connection.commit()
+		ON CONFLICT (trans_id, trans_date, fraud_type_id) DO NOTHING;
+	""", [fraud_type_id, start_dt, end_dt])
 
 
 def find_amt_selection(connection, cursor, start_dt, end_dt, fraud_type_id=4):
@@ -95,21 +99,21 @@ def find_amt_selection(connection, cursor, start_dt, end_dt, fraud_type_id=4):
 		FROM (
 			SELECT 
 				t1.trans_id,
-				t2.account,
-				LAG(t1.trans_date, 2) OVER (PARTITION BY t2.account ORDER BY t2.account, t1.trans_date) trans_date_1,
-				LAG(t1.trans_date, 1) OVER (PARTITION BY t2.account ORDER BY t2.account, t1.trans_date) trans_date_2,
+				t2.account_key,
+				LAG(t1.trans_date, 2) OVER (PARTITION BY t2.account_key ORDER BY t2.account_key, t1.trans_date) trans_date_1,
+				LAG(t1.trans_date, 1) OVER (PARTITION BY t2.account_key ORDER BY t2.account_key, t1.trans_date) trans_date_2,
 				t1.trans_date trans_date_3, 
-				LAG(t1.amt, 2) OVER (PARTITION BY t2.account ORDER BY t2.account, t1.trans_date) amt_1,
-				LAG(t1.amt, 1) OVER (PARTITION BY t2.account ORDER BY t2.account, t1.trans_date) amt_2,
+				LAG(t1.amt, 2) OVER (PARTITION BY t2.account_key ORDER BY t2.account_key, t1.trans_date) amt_1,
+				LAG(t1.amt, 1) OVER (PARTITION BY t2.account_key ORDER BY t2.account_key, t1.trans_date) amt_2,
 				t1.amt amt_3, 
-				LAG(t1.oper_type, 2) OVER (PARTITION BY t2.account ORDER BY t2.account, t1.trans_date) oper_type_1,
-				LAG(t1.oper_type, 1) OVER (PARTITION BY t2.account ORDER BY t2.account, t1.trans_date) oper_type_2,
+				LAG(t1.oper_type, 2) OVER (PARTITION BY t2.account_key ORDER BY t2.account_key, t1.trans_date) oper_type_1,
+				LAG(t1.oper_type, 1) OVER (PARTITION BY t2.account_key ORDER BY t2.account_key, t1.trans_date) oper_type_2,
 				t1.oper_type oper_type_3,
-				LAG(t1.oper_result, 2) OVER (PARTITION BY t2.account ORDER BY t2.account, t1.trans_date) oper_result_1,
-				LAG(t1.oper_result, 1) OVER (PARTITION BY t2.account ORDER BY t2.account, t1.trans_date) oper_result_2,
+				LAG(t1.oper_result, 2) OVER (PARTITION BY t2.account_key ORDER BY t2.account_key, t1.trans_date) oper_result_1,
+				LAG(t1.oper_result, 1) OVER (PARTITION BY t2.account_key ORDER BY t2.account_key, t1.trans_date) oper_result_2,
 				t1.oper_result oper_result_3
 			FROM DWH_FACT_TRANSACTIONS t1
-			INNER JOIN STG_CARDS t2 ON t1.card_num = t2.card_num
+			INNER JOIN DWH_DIM_CARD_PROFILES t2 ON t1.card_key = t2.card_key
 			WHERE t1.oper_type IN ('PAYMENT', 'WITHDRAW')
 				AND t1.trans_date >= %s::TIMESTAMP - INTERVAL '20 minutes' 
 				AND t1.trans_date < %s::TIMESTAMP
@@ -117,41 +121,177 @@ def find_amt_selection(connection, cursor, start_dt, end_dt, fraud_type_id=4):
 		WHERE EXTRACT(EPOCH FROM (trans_date_3 - trans_date_1))/60 <= 20
 			AND t.amt_1 > t.amt_2 AND t.amt_2 > t.amt_3
 			AND t.oper_result_1 = 'REJECT' AND t.oper_result_2 = 'REJECT' AND t.oper_result_3 = 'SUCCESS'
-			AND t.trans_id NOT IN (SELECT trans_id FROM DWH_DIM_FRAUD WHERE fraud_type_id = %s);		
-	""", [fraud_type_id, start_dt, end_dt, fraud_type_id])
-	connection.commit()
+		ON CONFLICT (trans_id, trans_date, fraud_type_id) DO NOTHING;
+	""", [fraud_type_id, start_dt, end_dt])
 
 
-def delete_rep_fraud_records(connection, cursor, start_dt, end_dt):
-	"""Удаление записей из таблицы REP_FRAUD за заданный период"""
-	cursor.execute("""
-		DELETE FROM REP_FRAUD
-		WHERE event_dt >= %s::TIMESTAMP
-			AND event_dt < %s::TIMESTAMP;
-	""", [start_dt, end_dt])
-	connection.commit()
+def get_frauds_single_pass_query():
+	"""
+	Текст запроса, который возвращает (trans_id, trans_date, fraud_type_id) по всем признакам 
+	мошенничества за один проход по DWH_FACT_TRANSACTIONS (см. find_frauds_single_pass).
+	Параметры запроса: start_dt, end_dt - период; shards, shard - проверяются только счета, 
+	для которых mod(coalesce(account_key, 0), shards) = shard (shards = 1, shard = 0 - все счета; 
+	карты без счета попадают в шард 0).
+	"""
+	return """
+	WITH trans AS (
+		SELECT 
+			t1.trans_id, 
+			t1.trans_date, 
+			t1.amt, 
+			t1.oper_result, 
+			t2.account_key,
+			t2.valid_to,
+			t2.passport_valid_to,
+			t2.is_blacklisted,
+			t3.terminal_city,
+			t3.terminal_key IS NOT NULL cities_group,
+			t1.oper_type IN ('PAYMENT', 'WITHDRAW') 
+				AND t1.trans_date >= %(start_dt)s::TIMESTAMP - INTERVAL '20 minutes' amt_group
+		FROM DWH_FACT_TRANSACTIONS t1
+		INNER JOIN DWH_DIM_CARD_PROFILES t2 ON t1.card_key = t2.card_key
+		LEFT JOIN DWH_DIM_TERMINALS_HIST t3
+			ON t1.terminal_key = t3.terminal_key 
+				AND t1.trans_date BETWEEN t3.effective_from AND t3.effective_to
+		WHERE t1.trans_date >= %(start_dt)s::TIMESTAMP - INTERVAL '1 hour' 
+			AND t1.trans_date < %(end_dt)s::TIMESTAMP
+			AND (%(shards)s = 1 OR mod(coalesce(t2.account_key, 0), %(shards)s) = %(shard)s)
+	), 
+	trans_lag AS (
+		SELECT 
+			t.*,
+			LAG(t.trans_date) OVER w_cities previous_trans_date,
+			LAG(t.terminal_city) OVER w_cities previous_terminal_city,
+			LAG(t.trans_date, 2) OVER w_amt trans_date_1,
+			LAG(t.amt, 2) OVER w_amt amt_1,
+			LAG(t.amt, 1) OVER w_amt amt_2,
+			LAG(t.oper_result, 2) OVER w_amt oper_result_1,
+			LAG(t.oper_result, 1) OVER w_amt oper_result_2
+		FROM trans t
+		WINDOW 
+			w_cities AS (PARTITION BY t.account_key, t.cities_group ORDER BY t.trans_date),
+			w_amt AS (PARTITION BY t.account_key, t.amt_group ORDER BY t.trans_date)
+	), 
+	trans_flags AS (
+		SELECT 
+			t.trans_id,
+			t.trans_date,
+			t.trans_date >= %(start_dt)s::TIMESTAMP 
+				AND (
+					t.trans_date >= t.passport_valid_to + INTERVAL '1 day'
+					OR t.is_blacklisted
+				) is_passport_fraud,
+			t.trans_date >= %(start_dt)s::TIMESTAMP 
+				AND t.trans_date >= t.valid_to + INTERVAL '1 day' is_contract_fraud,
+			t.cities_group
+				AND t.terminal_city <> t.previous_terminal_city
+				AND EXTRACT(EPOCH FROM (t.trans_date - t.previous_trans_date))/60 <= 60 is_cities_fraud,
+			t.amt_group
+				AND EXTRACT(EPOCH FROM (t.trans_date - t.trans_date_1))/60 <= 20
+				AND t.amt_1 > t.amt_2 AND t.amt_2 > t.amt
+				AND t.oper_result_1 = 'REJECT' AND t.oper_result_2 = 'REJECT' AND t.oper_result = 'SUCCESS' is_amt_fraud
+		FROM trans_lag t
+	)
+	SELECT t.trans_id, t.trans_date, f.fraud_type_id
+	FROM trans_flags t
+	CROSS JOIN LATERAL (
+		VALUES 
+			(1, t.is_passport_fraud), 
+			(2, t.is_contract_fraud), 
+			(3, t.is_cities_fraud), 
+			(4, t.is_amt_fraud)
+	) f (fraud_type_id, is_fraud)
+	WHERE f.is_fraud
+	"""
+
+
+def find_frauds_single_pass(connection, cursor, start_dt, end_dt):
+	"""
+	Поиск мошеннических операций по всем признакам за один проход по DWH_FACT_TRANSACTIONS.
+	Результат совпадает с последовательным выполнением функций find_passport_expired, find_passport_blocked,
+	find_contract_expired, find_different_cities и find_amt_selection:
+		-- соединения с профилями карт (DWH_DIM_CARD_PROFILES) и терминалами выполняются один раз;
+		-- оконные функции считаются за один проход по общей выборке. Чтобы LAG видел только те операции, 
+		которые участвуют в соответствующем признаке, в PARTITION BY кроме account_key добавлен признак 
+		попадания операции в выборку правила (cities_group, amt_group);
+		-- каждая строка выборки порождает по строке на каждый сработавший признак (fraud_type_id 1-4).
+	"""
+	cursor.execute(f"""
+		INSERT INTO DWH_DIM_FRAUD (trans_id, trans_date, fraud_type_id)
+		{get_frauds_single_pass_query()}
+		ON CONFLICT (trans_id, trans_date, fraud_type_id) DO NOTHING;
+	""", {'start_dt': start_dt, 'end_dt': end_dt, 'shards': 1, 'shard': 0})
+
+
+def select_frauds_shard(start_dt, end_dt, shard, shards):
+	"""
+	Поиск мошеннических операций по счетам шарда shard из shards в отдельном соединении из общего пула.
+	Возвращает список (trans_id, trans_date, fraud_type_id).
+	"""
+	connection = get_connection()
+	cursor = connection.cursor()
+	try:
+		cursor.execute(get_frauds_single_pass_query(), 
+			{'start_dt': start_dt, 'end_dt': end_dt, 'shards': shards, 'shard': shard})
+		return cursor.fetchall()
+	finally:
+		connection.rollback()
+		close(connection, cursor)
+
+
+def find_frauds_sharded(connection, cursor, start_dt, end_dt, shards=4):
+	"""
+	Поиск мошеннических операций запросом из find_frauds_single_pass, разделенным на shards шардов по счетам.
+	Все правила проверяют операции в пределах одного счета (оконные функции - PARTITION BY account_key), 
+	поэтому шарды не зависят друг от друга и выполняются параллельно, каждый - в своем соединении 
+	(и в своем процессе БД). Найденные операции всех шардов записываются в DWH_DIM_FRAUD 
+	в текущей транзакции соединения connection.
+
+	Примечание: размер пула соединений (db_config.json) должен быть не меньше shards + 1.
+	"""
+	with ThreadPoolExecutor(max_workers=shards) as executor:
+		results = executor.map(lambda shard: select_frauds_shard(start_dt, end_dt, shard, shards), range(shards))
+		frauds = [fraud for result in results for fraud in result]
+	add_fraud_records(connection, cursor, frauds)
 
 
 def add_rep_fraud_records(connection, cursor, start_dt, end_dt):
-	"""Добавление новых записей в таблицу REP_FRAUD из таблицы DWH_DIM_FRAUD"""
+	"""
+	Добавление в таблицу REP_FRAUD новых записей из таблицы DWH_DIM_FRAUD за заданный период.
+	Новыми считаются факты мошенничества, fraud_id которых еще нет в REP_FRAUD, 
+	поэтому с остальными таблицами соединяются только они.
+	Паспорт, ФИО и телефон берутся из профиля карты (DWH_DIM_CARD_PROFILES), 
+	в отчет попадают операции по картам, клиент которых найден.
+	"""
 	cursor.execute("""
-		INSERT INTO REP_FRAUD (event_dt, passport, fio, phone, event_type)
+		WITH new_frauds AS MATERIALIZED (
+			SELECT t0.fraud_id, t0.trans_id, t0.trans_date, t0.fraud_type_id
+			FROM DWH_DIM_FRAUD t0
+			WHERE t0.trans_date >= %s::TIMESTAMP 
+				AND t0.trans_date < %s::TIMESTAMP
+				AND NOT EXISTS (
+					SELECT 1 
+					FROM REP_FRAUD r 
+					WHERE r.fraud_id = t0.fraud_id
+				)
+		)
+		INSERT INTO REP_FRAUD (event_dt, passport, fio, phone, event_type, fraud_id)
 		SELECT 
 			t1.trans_date, 
-			t4.passport_num,
-			CONCAT_WS(' ', t4.last_name, t4.first_name, t4.patronymic), 
-			t4.phone,
-			t5.fraud_type
-		FROM DWH_DIM_FRAUD t0
-		INNER JOIN DWH_FACT_TRANSACTIONS t1 ON t0.trans_id = t1.trans_id 
-		INNER JOIN STG_CARDS t2 ON t1.card_num = t2.card_num
-		INNER JOIN STG_ACCOUNTS t3 ON t2.account = t3.account
-		INNER JOIN STG_CLIENTS t4 ON t3.client = t4.client_id
-		INNER JOIN META_FRAUD_TYPES t5 ON t0.fraud_type_id = t5.fraud_type_id
-		WHERE t0.trans_date >= %s::TIMESTAMP 
-			AND t0.trans_date < %s::TIMESTAMP;
-	""", [start_dt, end_dt])
-	connection.commit()
+			t2.passport_num,
+			t2.fio, 
+			t2.phone,
+			t3.fraud_type,
+			t0.fraud_id
+		FROM new_frauds t0
+		INNER JOIN DWH_FACT_TRANSACTIONS t1 ON t0.trans_id = t1.trans_id AND t0.trans_date = t1.trans_date
+		INNER JOIN DWH_DIM_CARD_PROFILES t2 ON t1.card_key = t2.card_key
+		INNER JOIN META_FRAUD_TYPES t3 ON t0.fraud_type_id = t3.fraud_type_id
+		WHERE t1.trans_date >= %s::TIMESTAMP 
+			AND t1.trans_date < %s::TIMESTAMP
+			AND t2.client_key IS NOT NULL
+		ON CONFLICT (fraud_id) DO NOTHING;
+	""", [start_dt, end_dt, start_dt, end_dt])
 
 
 def get_last_transaction_update_dt(cursor):
@@ -192,18 +332,274 @@ def get_rep_fraud_time_period(cursor, path='date_settings.json'):
 			print(f'Задан временной период: {start_dt} - {end_dt}')
 			
 
-def update_rep_fraud(connection, cursor):
-	"""Поиск мошеннических операций и обновление таблицы REP_FRAUD за заданный промежуток времени"""
-	time_period = get_rep_fraud_time_period(cursor)
+def get_fraud_watermarks(cursor):
+	"""Границы инкрементального поиска из META_FRAUD_WATERMARK: {fraud_type_id: scored_to}"""
+	cursor.execute("""SELECT fraud_type_id, scored_to FROM META_FRAUD_WATERMARK;""")
+	return dict(cursor.fetchall())
+
+
+def set_fraud_watermarks(connection, cursor, scored_to, fraud_type_ids=ALL_RULES):
+	"""Запись границы инкрементального поиска scored_to для признаков fraud_type_ids"""
+	cursor.executemany("""
+		INSERT INTO META_FRAUD_WATERMARK (fraud_type_id, scored_to, update_dt)
+		VALUES (%s, %s, CURRENT_TIMESTAMP)
+		ON CONFLICT (fraud_type_id) DO UPDATE 
+		SET scored_to = EXCLUDED.scored_to, 
+			update_dt = EXCLUDED.update_dt;
+	""", [[fraud_type_id, scored_to] for fraud_type_id in sorted(fraud_type_ids)])
+
+
+def lower_fraud_watermarks(connection, cursor, trans_dt):
+	"""
+	Сдвиг границ инкрементального поиска назад до trans_dt, если они позже trans_dt.
+	Вызывается при загрузке транзакций: загруженные с опозданием операции (и операции после них, 
+	для которых они попадают в окно правил 3 и 4) будут проверены при следующем поиске.
+	"""
+	cursor.execute("""
+		UPDATE META_FRAUD_WATERMARK
+		SET scored_to = %s, 
+			update_dt = CURRENT_TIMESTAMP
+		WHERE scored_to > %s;
+	""", [trans_dt, trans_dt])
+
+
+def get_card_profile_watermarks(cursor):
+	"""Границы инкрементального обновления профилей карт из META_CARD_PROFILE_WATERMARK: {source_table: refreshed_to}"""
+	cursor.execute("""SELECT source_table, refreshed_to FROM META_CARD_PROFILE_WATERMARK;""")
+	return dict(cursor.fetchall())
+
+
+def lower_card_profile_watermark(connection, cursor, source_table, changed_dt):
+	"""
+	Сдвиг границы обновления профилей карт по таблице source_table назад до changed_dt, если она позже changed_dt.
+	Вызывается при загрузке 'черного списка': паспорта с датой внесения раньше границы 
+	будут учтены при следующем обновлении профилей.
+	"""
+	cursor.execute("""
+		UPDATE META_CARD_PROFILE_WATERMARK
+		SET refreshed_to = %s, 
+			update_dt = CURRENT_TIMESTAMP
+		WHERE source_table = %s
+			AND refreshed_to > %s;
+	""", [changed_dt, source_table, changed_dt])
+
+
+def refresh_card_profiles(connection, cursor, full=False):
+	"""
+	Инкрементальное обновление профилей карт DWH_DIM_CARD_PROFILES.
+	Пересчитываются профили только тех карт, которых касаются строки источников (CARD_PROFILE_SOURCES)
+	с датой изменения не раньше границы из META_CARD_PROFILE_WATERMARK. После обновления границей становится 
+	текущая дата: изменения, внесенные в тот же день после обновления, будут учтены при следующем обновлении.
+	Профили карт, которых больше нет в STG_CARDS, удаляются; карты без профиля (например, добавленные 
+	в STG_CARDS с давней датой create_dt) получают профиль независимо от даты изменения.
+
+	Примечание: 
+		-- если границ еще нет, таблица профилей пуста или full = True, пересчитываются все профили;
+		-- строки источников без даты изменения проверяются при каждом обновлении;
+		-- удаление строк из STG_ACCOUNTS и STG_CLIENTS по датам не отслеживается 
+		и учитывается только при полном пересчете (full = True).
+	"""
+	watermarks = {} if full or check_if_empty_table(cursor, 'DWH_DIM_CARD_PROFILES') else get_card_profile_watermarks(cursor)
+
+	def is_changed(source_table, alias):
+		"""Условие отбора строк источника source_table (псевдоним alias), измененных после границы"""
+		if watermarks.get(source_table) is None:
+			return 'TRUE'
+		changed_dt = CARD_PROFILE_SOURCES[source_table].format(t=alias)
+		return f'({changed_dt} >= %({source_table})s OR {changed_dt} IS NULL)'
+
+	cursor.execute(f"""
+		WITH changed_cards AS (
+			SELECT t1.card_key
+			FROM STG_CARDS t1
+			WHERE {is_changed('STG_CARDS', 't1')}
+			UNION
+			SELECT t1.card_key
+			FROM STG_CARDS t1
+			WHERE t1.card_key IS NOT NULL
+				AND NOT EXISTS (
+					SELECT 1 
+					FROM DWH_DIM_CARD_PROFILES p 
+					WHERE p.card_key = t1.card_key
+				)
+			UNION
+			SELECT t1.card_key
+			FROM STG_CARDS t1
+			INNER JOIN STG_ACCOUNTS t2 ON t1.account_key = t2.account_key
+			WHERE {is_changed('STG_ACCOUNTS', 't2')}
+			UNION
+			SELECT t1.card_key
+			FROM STG_CARDS t1
+			INNER JOIN STG_ACCOUNTS t2 ON t1.account_key = t2.account_key
+			INNER JOIN STG_CLIENTS t3 ON t2.client_key = t3.client_key
+			WHERE {is_changed('STG_CLIENTS', 't3')}
+			UNION
+			SELECT t1.card_key
+			FROM STG_CARDS t1
+			INNER JOIN STG_ACCOUNTS t2 ON t1.account_key = t2.account_key
+			INNER JOIN STG_CLIENTS t3 ON t2.client_key = t3.client_key
+			INNER JOIN DWH_FACT_PASSPORT_BLACKLIST t4 ON t3.passport_num = t4.passport_num
+			WHERE {is_changed('DWH_FACT_PASSPORT_BLACKLIST', 't4')}
+		)
+		INSERT INTO DWH_DIM_CARD_PROFILES (
+			card_key, 
+			card_num, 
+			account_key, 
+			account, 
+			valid_to, 
+			client_key, 
+			passport_num, 
+			passport_valid_to, 
+			is_blacklisted, 
+			blacklisted_dt, 
+			fio, 
+			phone, 
+			update_dt)
+		SELECT DISTINCT ON (t1.card_key)
+			t1.card_key, 
+			t1.card_num, 
+			t1.account_key, 
+			t1.account, 
+			t2.valid_to, 
+			t3.client_key, 
+			t3.passport_num, 
+			t3.passport_valid_to, 
+			t4.passport_num IS NOT NULL, 
+			t4.entry_dt, 
+			CONCAT_WS(' ', t3.last_name, t3.first_name, t3.patronymic), 
+			t3.phone, 
+			CURRENT_TIMESTAMP
+		FROM changed_cards c
+		INNER JOIN STG_CARDS t1 ON c.card_key = t1.card_key
+		LEFT JOIN STG_ACCOUNTS t2 ON t1.account_key = t2.account_key
+		LEFT JOIN STG_CLIENTS t3 ON t2.client_key = t3.client_key
+		LEFT JOIN DWH_FACT_PASSPORT_BLACKLIST t4 ON t3.passport_num = t4.passport_num
+		ORDER BY t1.card_key
+		ON CONFLICT (card_key) DO UPDATE 
+		SET card_num = EXCLUDED.card_num, 
+			account_key = EXCLUDED.account_key, 
+			account = EXCLUDED.account, 
+			valid_to = EXCLUDED.valid_to, 
+			client_key = EXCLUDED.client_key, 
+			passport_num = EXCLUDED.passport_num, 
+			passport_valid_to = EXCLUDED.passport_valid_to, 
+			is_blacklisted = EXCLUDED.is_blacklisted, 
+			blacklisted_dt = EXCLUDED.blacklisted_dt, 
+			fio = EXCLUDED.fio, 
+			phone = EXCLUDED.phone, 
+			update_dt = EXCLUDED.update_dt;
+	""", watermarks)
+	refreshed = cursor.rowcount
+
+	cursor.execute("""
+		DELETE FROM DWH_DIM_CARD_PROFILES t
+		WHERE NOT EXISTS (
+			SELECT 1 
+			FROM STG_CARDS c 
+			WHERE c.card_key = t.card_key
+		);
+	""")
+
+	cursor.executemany("""
+		INSERT INTO META_CARD_PROFILE_WATERMARK (source_table, refreshed_to, update_dt)
+		VALUES (%s, CURRENT_DATE, CURRENT_TIMESTAMP)
+		ON CONFLICT (source_table) DO UPDATE 
+		SET refreshed_to = EXCLUDED.refreshed_to, 
+			update_dt = EXCLUDED.update_dt;
+	""", [[source_table] for source_table in CARD_PROFILE_SOURCES])
+	print(f'Профили карт обновлены: {refreshed}')
+
+
+def get_incremental_time_period(cursor):
+	"""
+	Выбор промежутка времени для инкрементального поиска:
+		-- начало - своя граница для каждого признака мошенничества из META_FRAUD_WATERMARK
+		(если границы еще нет, используется начало периода из get_rep_fraud_time_period);
+		-- конец - момент сразу после последней загруженной транзакции.
+	Возвращает [{fraud_type_id: start_dt}, end_dt] или [-1], если данных о транзакциях нет.
+	"""
+	cursor.execute("""SELECT MAX(trans_date) + INTERVAL '1 microsecond' FROM DWH_FACT_TRANSACTIONS;""")
+	end_dt = cursor.fetchone()[0]
+	if not end_dt:
+		print('Данные о транзакциях отсутствуют, отчет построен не будет')
+		return [-1]
+
+	watermarks = get_fraud_watermarks(cursor)
+	if any(fraud_type_id not in watermarks for fraud_type_id in ALL_RULES):
+		default_start_dt = get_rep_fraud_time_period(cursor)[0]
+		for fraud_type_id in ALL_RULES:
+			watermarks.setdefault(fraud_type_id, default_start_dt)
+
+	print(f'Инкрементальный поиск: {min(watermarks.values())} - {end_dt}')
+	return [{fraud_type_id: watermarks[fraud_type_id] for fraud_type_id in ALL_RULES}, end_dt]
+
+
+def find_frauds(connection, cursor, start_dts, end_dt, engine='queries', shards=1):
+	"""
+	Поиск мошеннических операций до end_dt способом engine (см. update_rep_fraud).
+	Если shards > 1, способ 'single_pass' выполняется параллельно по шардам счетов (см. find_frauds_sharded).
+	start_dts - начало периода для каждого признака мошенничества: {fraud_type_id: start_dt}.
+	Способы, проверяющие все признаки за один проход, начинают с самой ранней из границ 
+	(уже найденные факты отбрасываются по первичному ключу DWH_DIM_FRAUD).
+	"""
+	start_dt = min(start_dts.values())
+	if engine == 'single_pass' and shards > 1:
+		find_frauds_sharded(connection, cursor, start_dt, end_dt, shards=shards)
+	elif engine == 'single_pass':
+		find_frauds_single_pass(connection, cursor, start_dt, end_dt)
+	elif engine == 'stream':
+		find_frauds_stream(connection, cursor, start_dt, end_dt)
+	elif engine == 'vectorized':
+		find_frauds_offline(connection, cursor, start_dt, end_dt)
+	else:
+		find_passport_expired(connection, cursor, start_dts[1], end_dt)
+		find_passport_blocked(connection, cursor, start_dts[1], end_dt)
+		find_contract_expired(connection, cursor, start_dts[2], end_dt)
+		find_different_cities(connection, cursor, start_dts[3], end_dt)
+		find_amt_selection(connection, cursor, start_dts[4], end_dt)
+
+
+def update_rep_fraud(connection, cursor, engine='queries', mode='period', shards=1):
+	"""
+	Поиск мошеннических операций и обновление таблицы REP_FRAUD за заданный промежуток времени.
+	Способ поиска (engine):
+		-- 'queries': отдельный запрос на каждый признак мошенничества;
+		-- 'single_pass': все признаки за один проход по таблице транзакций (см. find_frauds_single_pass);
+		если shards > 1, проход выполняется параллельно по шардам счетов (см. find_frauds_sharded);
+		-- 'stream': потоковый детектор в памяти Python (см. fraud_stream.StreamFraudDetector);
+		-- 'vectorized': векторизованная проверка в pandas/NumPy для пересчета истории (см. fraud_offline).
+	Промежуток времени (mode):
+		-- 'period': из файла date_settings.json или последние сутки (см. get_rep_fraud_time_period);
+		-- 'incremental': только транзакции, загруженные после предыдущего поиска (см. get_incremental_time_period);
+		границы поиска по каждому признаку сохраняются в META_FRAUD_WATERMARK.
+
+	Примечание: 
+		-- правила и отчет соединяют транзакции с профилями карт (DWH_DIM_CARD_PROFILES) и терминалами 
+		по целочисленным суррогатным ключам (card_key, terminal_key); перед поиском ключи в STG_CARDS, 
+		STG_ACCOUNTS, STG_CLIENTS и профили карт актуализируются отдельной транзакцией 
+		(см. dwh_schema.update_stg_keys, refresh_card_profiles), чтобы их видели и параллельные шарды;
+		-- поиск и обновление отчета за период выполняются одной транзакцией (см. database.unit_of_work);
+		-- отчет строится накоплением: в REP_FRAUD добавляются только новые факты мошенничества 
+		(с новым report_dt), ранее добавленные записи не изменяются.
+	"""
+	if mode == 'incremental':
+		time_period = get_incremental_time_period(cursor)
+	else:
+		time_period = get_rep_fraud_time_period(cursor)
 
 	if time_period[0] != -1:
-		start_dt, end_dt = time_period
-		find_passport_expired(connection, cursor, start_dt, end_dt)
-		find_passport_blocked(connection, cursor, start_dt, end_dt)
-		find_contract_expired(connection, cursor, start_dt, end_dt)
-		find_different_cities(connection, cursor, start_dt, end_dt)
-		find_amt_selection(connection, cursor, start_dt, end_dt)
+		start_dts, end_dt = time_period
+		if mode != 'incremental':
+			start_dts = {fraud_type_id: start_dts for fraud_type_id in ALL_RULES}
+		start_dt = min(start_dts.values())
+
+		with unit_of_work(connection):
+			update_stg_keys(connection, cursor)
+			refresh_card_profiles(connection, cursor)
 
-		delete_rep_fraud_records(connection, cursor, start_dt, end_dt)
-		add_rep_fraud_records(connection, cursor, start_dt, end_dt)
+		with unit_of_work(connection):
+			find_frauds(connection, cursor, start_dts, end_dt, engine=engine, shards=shards)
+			if mode == 'incremental':
+				set_fraud_watermarks(connection, cursor, scored_to=end_dt)
 
+			add_rep_fraud_records(connection, cursor, start_dt, end_dt)
@@ -0,0 +1,262 @@
+from psycopg2.extras import execute_values
+from bisect import bisect_right
+from collections import deque
+from decimal import Decimal
+import datetime
+import csv
+import time
+
+
+# Правила, которые проверяются для операции (см. StreamFraudDetector.process)
+ALL_RULES = frozenset((1, 2, 3, 4))
+
+
+class StreamFraudDetector:
+	"""
+	Потоковый поиск мошеннических операций.
+	Операции подаются по одной в порядке времени (process), для каждой сразу возвращается список
+	сработавших признаков мошенничества (fraud_type_id). Признаки совпадают с правилами из fraud_search:
+		1 -- паспорт просрочен или в 'черном списке';
+		2 -- договор (счет) недействителен;
+		3 -- предыдущая операция по счету в течение часа совершена в другом городе;
+		4 -- подбор суммы: две отклоненные операции с убывающей суммой и успешная операция
+		с еще меньшей суммой в течение 20 минут.
+
+	Состояние детектора:
+		-- справочник карт: карта -> счет, дата окончания договора, паспорт, срок действия паспорта;
+		-- 'черный список' паспортов;
+		-- история терминалов (SCD2) для определения города на момент операции;
+		-- по каждому счету: время и город последней операции (правило 3)
+		и две последние операции оплаты/снятия (правило 4).
+	"""
+
+	def __init__(self, cards, accounts, clients, blacklist, terminals):
+		"""
+		cards: {card_num: account}
+		accounts: {account: (valid_to, client_id)}
+		clients: {client_id: (passport_num, passport_valid_to)}
+		blacklist: множество номеров паспортов
+		terminals: {terminal_id: [(effective_from, effective_to, terminal_city), ...]}
+		"""
+		self.card_profiles = {}
+		for card_num, account in cards.items():
+			valid_to, client_id = accounts.get(account, (None, None))
+			passport_num, passport_valid_to = clients.get(client_id, (None, None))
+			self.card_profiles[card_num] = (
+				account,
+				account in accounts,
+				client_id in clients,
+				self.get_invalid_from(valid_to),
+				passport_num,
+				self.get_invalid_from(passport_valid_to)
+			)
+		self.blacklist = set(blacklist)
+
+		self.terminals = {}
+		for terminal_id, history in terminals.items():
+			history = sorted(history)
+			self.terminals[terminal_id] = ([record[0] for record in history], history)
+
+		self.last_city = {}
+		self.last_amt = {}
+
+	@staticmethod
+	def get_invalid_from(valid_to):
+		"""Момент, начиная с которого документ недействителен (документ действует весь день valid_to)"""
+		if valid_to is None:
+			return None
+		return datetime.datetime.combine(valid_to, datetime.time()) + datetime.timedelta(days=1)
+
+	def get_terminal_record(self, terminal_id, trans_date):
+		"""
+		Запись истории терминала terminal_id, действующая на момент trans_date: 
+		(effective_from, effective_to, terminal_city) или None, если такой записи нет.
+		"""
+		terminal = self.terminals.get(terminal_id)
+		if terminal is None:
+			return None
+		effective_from, history = terminal
+		position = bisect_right(effective_from, trans_date) - 1
+		if position < 0 or trans_date > history[position][1]:
+			return None
+		return history[position]
+
+	def add_blacklisted(self, passport_num):
+		"""Добавление паспорта в 'черный список'"""
+		self.blacklist.add(passport_num)
+
+	def process(self, trans_date, card_num, oper_type, amt, oper_result, terminal, rules=ALL_RULES):
+		"""
+		Обработка одной операции. Возвращает список сработавших признаков мошенничества.
+		Проверяются и учитываются в состоянии только правила из rules.
+		"""
+		profile = self.card_profiles.get(card_num)
+		if profile is None:
+			return []
+		account, has_account, has_client, contract_invalid_from, passport_num, passport_invalid_from = profile
+		frauds = []
+
+		if 1 in rules and has_client and (
+				(passport_invalid_from is not None and trans_date >= passport_invalid_from)
+				or passport_num in self.blacklist):
+			frauds.append(1)
+
+		if 2 in rules and has_account and contract_invalid_from is not None and trans_date >= contract_invalid_from:
+			frauds.append(2)
+
+		if 3 in rules:
+			terminal_record = self.get_terminal_record(terminal, trans_date)
+			if terminal_record is not None:
+				terminal_city = terminal_record[2]
+				previous = self.last_city.get(account)
+				if (previous and previous[1] is not None and terminal_city is not None 
+						and previous[1] != terminal_city 
+						and (trans_date - previous[0]).total_seconds() <= 3600):
+					frauds.append(3)
+				self.last_city[account] = (trans_date, terminal_city)
+
+		if 4 in rules and oper_type in ('PAYMENT', 'WITHDRAW'):
+			previous = self.last_amt.get(account)
+			if previous is None:
+				previous = self.last_amt[account] = deque(maxlen=2)
+			if len(previous) == 2:
+				(trans_date_1, amt_1, oper_result_1), (_, amt_2, oper_result_2) = previous
+				if ((trans_date - trans_date_1).total_seconds() <= 1200
+						and amt_1 > amt_2 > amt
+						and oper_result_1 == 'REJECT' and oper_result_2 == 'REJECT' and oper_result == 'SUCCESS'):
+					frauds.append(4)
+			previous.append((trans_date, amt, oper_result))
+
+		return frauds
+
+
+def load_stream_fraud_detector(cursor):
+	"""Создание StreamFraudDetector по данным о картах, счетах, клиентах, 'черном списке' и терминалах из БД"""
+	cursor.execute("""SELECT card_num, account FROM STG_CARDS;""")
+	cards = dict(cursor.fetchall())
+
+	cursor.execute("""SELECT account, valid_to, client FROM STG_ACCOUNTS;""")
+	accounts = {record[0]: (record[1], record[2]) for record in cursor.fetchall()}
+
+	cursor.execute("""SELECT client_id, passport_num, passport_valid_to FROM STG_CLIENTS;""")
+	clients = {record[0]: (record[1], record[2]) for record in cursor.fetchall()}
+
+	cursor.execute("""SELECT passport_num FROM DWH_FACT_PASSPORT_BLACKLIST;""")
+	blacklist = {record[0] for record in cursor.fetchall()}
+
+	cursor.execute("""
+		SELECT terminal_id, effective_from, effective_to, terminal_city
+		FROM DWH_DIM_TERMINALS_HIST;
+	""")
+	terminals = {}
+	for terminal_id, effective_from, effective_to, terminal_city in cursor.fetchall():
+		terminals.setdefault(terminal_id, []).append((effective_from, effective_to, terminal_city))
+
+	return StreamFraudDetector(cards, accounts, clients, blacklist, terminals)
+
+
+def read_transactions_file(path, sep=';'):
+	"""
+	Построчное чтение файла с транзакциями (формат transactions_DDMMYYYY.txt).
+	Возвращает кортежи (trans_id, trans_date, card_num, oper_type, amt, oper_result, terminal).
+	"""
+	with open(path, 'r', encoding='utf-8-sig', newline='') as file:
+		reader = csv.reader(file, delimiter=sep)
+		columns = [column.lower() for column in next(reader)]
+		index = [columns.index(column) for column in (
+			'transaction_id', 'transaction_date', 'card_num', 'oper_type', 'amount', 'oper_result', 'terminal')]
+		for row in reader:
+			trans_id, trans_date, card_num, oper_type, amt, oper_result, terminal = (row[i] for i in index)
+			yield (
+				trans_id,
+				datetime.datetime.fromisoformat(trans_date),
+				card_num,
+				oper_type,
+				Decimal(amt.replace(',', '.')),
+				oper_result,
+				terminal
+			)
+
+
+def read_transactions_db(connection, start_dt, end_dt, itersize=10000):
+	"""
+	Чтение транзакций за период [start_dt, end_dt) из DWH_FACT_TRANSACTIONS в порядке времени.
+	Используется серверный курсор, поэтому в памяти одновременно находится не больше itersize строк.
+	"""
+	with connection.cursor(name='stream_transactions') as cursor:
+		cursor.itersize = itersize
+		cursor.execute("""
+			SELECT trans_id, trans_date, card_num, oper_type, amt, oper_result, terminal
+			FROM DWH_FACT_TRANSACTIONS
+			WHERE trans_date >= %s::TIMESTAMP
+				AND trans_date < %s::TIMESTAMP
+			ORDER BY trans_date, trans_id;
+		""", [start_dt, end_dt])
+		for record in cursor:
+			yield record
+
+
+def replay_transactions(detector, transactions, start_dt=None):
+	"""
+	Прогон потока транзакций через детектор. Возвращает список (trans_id, trans_date, fraud_type_id).
+	В консоль выводится скорость обработки (транзакций в секунду).
+
+	Примечание: если задан start_dt, поиск воспроизводит границы периода из fraud_search:
+		-- операции раньше start_dt - 1 час пропускаются;
+		-- операции из [start_dt - 1 час, start_dt - 20 минут) учитываются только правилом 3;
+		-- операции из [start_dt - 20 минут, start_dt) учитываются только правилами 3 и 4.
+	"""
+	if start_dt is not None:
+		start_dt = datetime.datetime.fromisoformat(str(start_dt))
+		cities_from = start_dt - datetime.timedelta(hours=1)
+		amt_from = start_dt - datetime.timedelta(minutes=20)
+
+	frauds = []
+	count = 0
+	start = time.perf_counter()
+	for trans_id, trans_date, card_num, oper_type, amt, oper_result, terminal in transactions:
+		rules = ALL_RULES
+		if start_dt is not None and trans_date < start_dt:
+			if trans_date < cities_from:
+				continue
+			rules = (3, 4) if trans_date >= amt_from else (3,)
+		count += 1
+		for fraud_type_id in detector.process(trans_date, card_num, oper_type, amt, oper_result, terminal, rules):
+			frauds.append((trans_id, trans_date, fraud_type_id))
+
+	duration = time.perf_counter() - start
+	print(f'Обработано {count} транзакций, {count / max(duration, 1e-6):.0f} транзакций/сек')
+	return frauds
+
+
+def replay_transactions_file(detector, path):
+	"""
+	Прогон файла с транзакциями через детектор (например, для оценки скорости обработки).
+	Состояние детектора сохраняется между файлами, поэтому файлы нужно подавать по порядку дат.
+	"""
+	return replay_transactions(detector, read_transactions_file(path))
+
+
+def add_fraud_records(connection, cursor, frauds):
+	"""Запись найденных мошеннических операций (trans_id, trans_date, fraud_type_id) в DWH_DIM_FRAUD"""
+	execute_values(cursor, """
+		INSERT INTO DWH_DIM_FRAUD (trans_id, trans_date, fraud_type_id)
+		SELECT t.trans_id, t.trans_date::TIMESTAMP, t.fraud_type_id
+		FROM (VALUES %s) t (trans_id, trans_date, fraud_type_id)
+		ON CONFLICT (trans_id, trans_date, fraud_type_id) DO NOTHING;
+	""", frauds, page_size=10000)
+
+
+def find_frauds_stream(connection, cursor, start_dt, end_dt):
+	"""
+	Поиск мошеннических операций за период [start_dt, end_dt) потоковым детектором.
+	Результат совпадает с поиском запросами из fraud_search.
+	"""
+	detector = load_stream_fraud_detector(cursor)
+	transactions = read_transactions_db(
+		connection,
+		start_dt=datetime.datetime.fromisoformat(str(start_dt)) - datetime.timedelta(hours=1),
+		end_dt=end_dt
+	)
+	frauds = replay_transactions(detector, transactions, start_dt=start_dt)
+	add_fraud_records(connection, cursor, frauds)
@@ -0,0 +1,201 @@
+from py_scripts.database import get_connection, close, close_pool, unit_of_work
+from py_scripts.test_data import recreate_test_data
+from py_scripts.dwh_data_update import update_from_files, FILE_MASK
+from py_scripts.file_processing import show_latest_errors, move_to_archive, create_file_processing_log
+from py_scripts.fraud_search import update_rep_fraud
+from datetime import datetime
+import threading
+import time
+import os
+import re
+
+try:
+	# Уведомления файловой системы (inotify в Linux, ReadDirectoryChangesW в Windows); без watchdog папка просматривается периодически
+	from watchdog.observers import Observer
+except ImportError:
+	Observer = None
+
+
+# Если папка отслеживается через watchdog, она все равно просматривается не реже чем раз в IDLE_RESCAN_INTERVAL секунд
+IDLE_RESCAN_INTERVAL = 60
+
+
+class WakeupHandler:
+	"""Обработчик событий watchdog: любое изменение в папке пробуждает цикл службы (см. run_service)"""
+
+	def __init__(self, wakeup):
+		self.wakeup = wakeup
+
+	def dispatch(self, event):
+		self.wakeup.set()
+
+
+def start_watcher(path, wakeup):
+	"""
+	Запуск отслеживания изменений в папке path: при любом событии устанавливается wakeup (threading.Event).
+	Если watchdog не установлен или отслеживание запустить не удалось, возвращается None -
+	в этом случае папка просматривается периодически (poll_interval).
+	"""
+	if Observer is None:
+		return None
+	observer = Observer()
+	try:
+		observer.schedule(WakeupHandler(wakeup), path, recursive=False)
+		observer.start()
+	except Exception:
+		return None
+	return observer
+
+
+def get_ready_files(path, file_mask, seen, settle_interval):
+	"""
+	Список файлов в папке path, подходящих под маску file_mask и полностью записанных:
+	размер и время изменения файла не менялись последние settle_interval секунд.
+	seen - состояние между вызовами {название файла: ((размер, время изменения), момент последнего изменения)},
+	обновляется на месте.
+	"""
+	now = time.monotonic()
+	current = {}
+	ready = []
+	with os.scandir(path) as entries:
+		for entry in entries:
+			if not entry.is_file() or not re.fullmatch(file_mask, entry.name):
+				continue
+			stat = entry.stat()
+			state = (stat.st_size, stat.st_mtime_ns)
+			previous = seen.get(entry.name)
+			changed_at = previous[1] if previous and previous[0] == state else now
+			current[entry.name] = (state, changed_at)
+			if now - changed_at >= settle_interval:
+				ready.append(entry.name)
+	seen.clear()
+	seen.update(current)
+	return ready
+
+
+def get_file_order(file_name):
+	"""Ключ сортировки файлов в порядке обработки: по дате из названия (см. FILE_MASK), далее по названию"""
+	file_date = re.fullmatch(FILE_MASK, file_name).group(2)
+	return file_date[4:] + file_date[2:4] + file_date[:2], file_name
+
+
+def register_batch_failure(connection, cursor, file_names, failures, max_retries, data_dir='data\\'):
+	"""
+	Учет неудачной обработки пачки файлов file_names.
+	failures - количество неудачных попыток подряд {название файла: количество}, обновляется на месте.
+	Файл, который не удалось обработать max_retries раз подряд, перемещается в папку archive\\error\\, 
+	а его незавершенная запись в META_FILE_PROCESSING_LOG помечается ошибкой - 
+	так служба не повторяет обработку бесконечно и не регистрирует файл заново при каждой попытке.
+	"""
+	quarantined = []
+	for file_name in file_names:
+		failures[file_name] = failures.get(file_name, 0) + 1
+		if failures[file_name] >= max_retries:
+			quarantined.append(file_name)
+			del failures[file_name]
+	if not quarantined:
+		return
+
+	with unit_of_work(connection):
+		create_file_processing_log(connection, cursor, replace=False)
+		cursor.execute("""
+			UPDATE META_FILE_PROCESSING_LOG
+			SET error = %s, 
+				processing_dt = %s
+			WHERE file_name = ANY(%s)
+				AND processing_dt IS NULL 
+				AND error IS NULL;
+		""", [f'Не удалось обработать файл за {max_retries} попыток', datetime.now(), quarantined])
+	for file_name in quarantined:
+		print(f'Файл {file_name} не удалось обработать {max_retries} раз подряд, файл перенесен в карантин')
+		move_to_archive(file_name, archive_dir='archive\\error\\', data_dir=data_dir)
+
+
+def process_batch(connection, cursor, config, schema_name, settings, file_names):
+	"""
+	Обработка пачки полностью записанных файлов file_names и инкрементальный поиск мошеннических операций
+	(см. fraud_search.update_rep_fraud, mode='incremental'): проверяются только новые транзакции.
+	"""
+	start_dt = datetime.now()
+	start = time.perf_counter()
+	print(f'>>> ОБРАБОТКА ФАЙЛОВ: {", ".join(sorted(file_names))}')
+	update_from_files(connection, cursor, config, schema_name, settings, file_names=file_names)
+	show_latest_errors(cursor, start_dt=start_dt)
+	update_rep_fraud(connection, cursor,
+		engine=settings['fraud_engine'], mode='incremental', shards=int(settings['fraud_shards']))
+	print(f'Данные REP_FRAUD обновлены, пачка из {len(file_names)} файлов обработана за {time.perf_counter() - start:.1f} сек')
+
+
+def run_service(config, schema_name, settings, data_dir='data\\'):
+	"""
+	Режим службы: постоянное отслеживание папки data_dir и обработка новых файлов по мере поступления.
+	Соединение с БД (и пул соединений) открывается один раз при запуске.
+	Файлы, подходящие под FILE_MASK, обрабатываются пачками: в пачку попадают все полностью записанные файлы
+	(см. get_ready_files), после обработки пачки выполняется инкрементальный поиск мошеннических операций.
+	Служба останавливается по Ctrl+C.
+
+	Примечание:
+		-- если установлен пакет watchdog, служба просыпается по уведомлению об изменении папки,
+		иначе папка просматривается каждые poll_interval секунд;
+		-- файл считается записанным, если его размер и время изменения не менялись settle_interval секунд;
+		-- ошибка при обработке пачки не останавливает службу: изменения пачки откатываются,
+		файлы остаются в папке data_dir и обрабатываются повторно (уже по одному), но не больше 
+		max_batch_retries раз подряд - затем файл переносится в карантин (см. register_batch_failure).
+	"""
+	poll_interval = float(settings['poll_interval'])
+	settle_interval = float(settings['settle_interval'])
+	max_retries = int(settings['max_batch_retries'])
+
+	connection = get_connection(config, schema_name)
+	cursor = connection.cursor()
+	recreate_test_data(connection, cursor, schema_name, replace=False)
+
+	wakeup = threading.Event()
+	observer = start_watcher(data_dir, wakeup)
+	if observer:
+		print(f'Служба запущена: отслеживание папки {data_dir} (watchdog)')
+	else:
+		reason = 'пакет watchdog не установлен' if Observer is None else 'не удалось запустить отслеживание watchdog'
+		print(f'Служба запущена: {reason}, вместо уведомлений папка {data_dir} просматривается каждые {poll_interval} сек')
+
+	seen = {}
+	failures = {}
+	try:
+		while True:
+			wakeup.clear()
+			ready = get_ready_files(data_dir, FILE_MASK, seen, settle_interval)
+			# Счетчики попыток файлов, которых больше нет в папке, не нужны
+			failures = {file_name: count for file_name, count in failures.items() if file_name in seen}
+			if ready:
+				# После неудачной попытки файлы обрабатываются по одному, чтобы ошибка в одном файле 
+				# не приводила к повторам (и карантину) остальных файлов пачки
+				if any(file_name in failures for file_name in ready):
+					batches = [[file_name] for file_name in sorted(ready, key=get_file_order)]
+				else:
+					batches = [ready]
+				for batch in batches:
+					try:
+						process_batch(connection, cursor, config, schema_name, settings, batch)
+					except Exception as error:
+						attempt = max(failures.get(file_name, 0) for file_name in batch) + 1
+						print(f'Не удалось обработать пачку файлов {", ".join(sorted(batch))} '
+							f'(попытка {attempt} из {max_retries}): {type(error).__name__}: {error}')
+						close(connection, cursor)
+						connection = get_connection(config, schema_name)
+						cursor = connection.cursor()
+						register_batch_failure(connection, cursor, batch, failures, max_retries, data_dir=data_dir)
+					else:
+						for file_name in batch:
+							failures.pop(file_name, None)
+					print()
+
+			# Пока в папке есть не до конца записанные файлы, она просматривается каждые poll_interval секунд
+			wakeup.wait(poll_interval if observer is None or seen else IDLE_RESCAN_INTERVAL)
+	except KeyboardInterrupt:
+		print('Служба остановлена')
+	finally:
+		if observer:
+			observer.stop()
+			observer.join()
+		close(connection, cursor)
+		close_pool()
@@ -1,5 +1,6 @@
 import io
 from py_scripts.database import *
+from py_scripts.dwh_schema import upgrade_dwh_schema, DWH_KEY_MAPS
 
 
 def read_sql(path):
@@ -13,11 +14,10 @@ def execute_from_file(connection, cursor, path):
 	"""Выполнить sql-запрос из файла"""
 	text = read_sql(path)
 	cursor.execute(text)
-	connection.commit()
 
 
 def create_transactions(connection, cursor, replace=False):
-	"""Создание таблицы с информацией о транзакциях"""
+	"""Создание таблицы с информацией о транзакциях (секционирована по месяцам по trans_date)"""
 	if replace:
 		drop_table(connection, cursor, 'DWH_FACT_TRANSACTIONS')
 	cursor.execute("""
@@ -28,10 +28,11 @@ def create_transactions(connection, cursor, replace=False):
 			oper_type VARCHAR(128),
 			amt DECIMAL(14,2),
 			oper_result VARCHAR(128),
-			terminal VARCHAR(128)
-		);
+			terminal VARCHAR(128),
+			card_key INT,
+			terminal_key INT
+		) PARTITION BY RANGE (trans_date);
 	""")
-	connection.commit()
 
 
 def create_passport_blacklist(connection, cursor, replace=False):
@@ -44,7 +45,6 @@ def create_passport_blacklist(connection, cursor, replace=False):
 			entry_dt DATE
 		);
 	""")
-	connection.commit()
 
 
 def create_terminals(connection, cursor, replace=False):
@@ -59,10 +59,10 @@ def create_terminals(connection, cursor, replace=False):
 			terminal_address VARCHAR(128),
 			effective_from TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
 			effective_to TIMESTAMP DEFAULT '2999-12-31 23:59:59',
-			deleted_flg NUMERIC(1) DEFAULT 0
+			deleted_flg NUMERIC(1) DEFAULT 0,
+			terminal_key INT
 		);
 	""")
-	connection.commit()
 
 
 def create_cards(connection, cursor, replace=False):
@@ -74,10 +74,11 @@ def create_cards(connection, cursor, replace=False):
 			card_num VARCHAR(128), 
 			account VARCHAR(128), 
 			create_dt DATE,
-			update_dt DATE
+			update_dt DATE,
+			card_key INT,
+			account_key INT
 		);
 	""")
-	connection.commit()
 
 
 def create_accounts(connection, cursor, replace=False):
@@ -90,10 +91,11 @@ def create_accounts(connection, cursor, replace=False):
 			valid_to DATE, 
 			client VARCHAR(128),
 			create_dt DATE, 
-			update_dt DATE
+			update_dt DATE,
+			account_key INT,
+			client_key INT
 		);
 	""")
-	connection.commit()
 
 
 def create_clients(connection, cursor, replace=False):
@@ -111,10 +113,70 @@ def create_clients(connection, cursor, replace=False):
 			passport_valid_to DATE, 
 			phone VARCHAR(128),
 			create_dt DATE, 
-			update_dt DATE
+			update_dt DATE,
+			client_key INT
+		);
+	""")
+
+
+def create_key_maps(connection, cursor, replace=False):
+	"""
+	Создание справочников целочисленных суррогатных ключей карт, счетов, клиентов и терминалов (см. dwh_schema.DWH_KEY_MAPS).
+	Правила поиска мошеннических операций и отчет соединяют таблицы по этим ключам, а не по строковым полям.
+	"""
+	for key_map, (key_column, value_column) in DWH_KEY_MAPS.items():
+		if replace:
+			drop_table(connection, cursor, key_map)
+		cursor.execute(f"""
+			CREATE TABLE IF NOT EXISTS {key_map} (
+				{key_column} SERIAL PRIMARY KEY,
+				{value_column} VARCHAR(128) NOT NULL UNIQUE
+			);
+		""")
+
+
+def create_card_profiles(connection, cursor, replace=False):
+	"""
+	Создание таблицы профилей карт (SCD1): для каждой карты из STG_CARDS - счет, срок действия договора,
+	клиент, паспорт, срок действия паспорта, признак и дата внесения паспорта в 'черный список', ФИО и телефон.
+	Таблица обновляется инкрементально перед поиском мошеннических операций (см. fraud_search.refresh_card_profiles).
+	"""
+	if replace:
+		drop_table(connection, cursor, 'DWH_DIM_CARD_PROFILES')
+	cursor.execute("""
+		CREATE TABLE IF NOT EXISTS DWH_DIM_CARD_PROFILES (
+			card_key INT PRIMARY KEY,
+			card_num VARCHAR(128),
+			account_key INT,
+			account VARCHAR(128),
+			valid_to DATE,
+			client_key INT,
+			passport_num VARCHAR(128),
+			passport_valid_to DATE,
+			is_blacklisted BOOLEAN,
+			blacklisted_dt DATE,
+			fio VARCHAR(384),
+			phone VARCHAR(128),
+			update_dt TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+		);
+	""")
+
+
+def create_card_profile_watermark(connection, cursor, replace=False):
+	"""
+	Создание таблицы с границами инкрементального обновления профилей карт:
+	для каждой таблицы-источника (source_table) строки с датой изменения раньше refreshed_to 
+	уже учтены в DWH_DIM_CARD_PROFILES.
+	"""
+	if replace:
+		drop_table(connection, cursor, 'META_CARD_PROFILE_WATERMARK')
+	cursor.execute("""
+		CREATE TABLE IF NOT EXISTS META_CARD_PROFILE_WATERMARK (
+			source_table VARCHAR(128) PRIMARY KEY,
+			refreshed_to DATE,
+			update_dt TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 		);
 	""")
-	connection.commit()
 
 
 def create_rep_fraud(connection, cursor, replace=False):
@@ -128,10 +190,10 @@ def create_rep_fraud(connection, cursor, replace=False):
 			fio VARCHAR(128),
 			phone VARCHAR(128),
 			event_type VARCHAR(128),
-			report_dt TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+			report_dt TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+			fraud_id BIGINT
 		);
 	""")
-	connection.commit()
 
 
 def create_fraud_types(connection, cursor, replace=False):
@@ -144,11 +206,10 @@ def create_fraud_types(connection, cursor, replace=False):
 			fraud_type VARCHAR(128)
 		);
 	""")
-	connection.commit()
 
 
 def create_fraud_hist(connection, cursor, replace=False):
-	"""Создание таблицы с историей найденных мошеннических транзакций"""
+	"""Создание таблицы с историей найденных мошеннических транзакций (секционирована по месяцам по trans_date)"""
 	if replace:
 		drop_table(connection, cursor, 'DWH_DIM_FRAUD')
 	cursor.execute("""
@@ -157,10 +218,26 @@ def create_fraud_hist(connection, cursor, replace=False):
 			trans_date TIMESTAMP,
 			fraud_type_id INT,
 			create_dt DATE DEFAULT CURRENT_TIMESTAMP, 
-			update_dt DATE
+			update_dt DATE,
+			fraud_id BIGSERIAL
+		) PARTITION BY RANGE (trans_date);
+	""")
+
+
+def create_fraud_watermark(connection, cursor, replace=False):
+	"""
+	Создание таблицы с границами инкрементального поиска мошеннических транзакций:
+	для каждого признака мошенничества (fraud_type_id) все транзакции с trans_date < scored_to уже проверены.
+	"""
+	if replace:
+		drop_table(connection, cursor, 'META_FRAUD_WATERMARK')
+	cursor.execute("""
+		CREATE TABLE IF NOT EXISTS META_FRAUD_WATERMARK (
+			fraud_type_id INT PRIMARY KEY,
+			scored_to TIMESTAMP,
+			update_dt TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 		);
 	""")
-	connection.commit()
 
 
 def recreate_test_data(connection, cursor, schema_name, replace=False):
@@ -175,29 +252,40 @@ def recreate_test_data(connection, cursor, schema_name, replace=False):
 			DWH_FACT_PASSPORT_BLACKLIST
 			DWH_DIM_TERMINALS_HIST
 			REP_FRAUD
+	+ справочники суррогатных ключей карт, счетов, клиентов и терминалов (DWH_DIM_*_KEYS)
+	+ секции, первичные ключи и индексы таблиц хранилища, суррогатные ключи, ключи fraud_id (см. dwh_schema.upgrade_dwh_schema)
 	+ типы мошенничества META_FRAUD_TYPES
 	+ история поиска мошеннических транзакций DWH_DIM_FRAUD
+	+ границы инкрементального поиска мошеннических транзакций META_FRAUD_WATERMARK
+	+ профили карт DWH_DIM_CARD_PROFILES и границы их обновления META_CARD_PROFILE_WATERMARK
+
+	Примечание: все изменения выполняются одной транзакцией (см. database.unit_of_work).
 	"""
-	create_and_set_schema(connection, cursor, schema_name, replace=replace)
-
-	create_clients(connection, cursor, replace=replace)
-	create_cards(connection, cursor, replace=replace)
-	create_accounts(connection, cursor, replace=replace)
-
-	if check_if_empty_table(cursor, 'STG_CARDS'):
-		execute_from_file(connection, cursor, path='sql_scripts\\insert_cards.sql')
-	if check_if_empty_table(cursor, 'STG_ACCOUNTS'):
-		execute_from_file(connection, cursor, path='sql_scripts\\insert_accounts.sql')
-	if check_if_empty_table(cursor, 'STG_CLIENTS'):
-		execute_from_file(connection, cursor, path='sql_scripts\\insert_clients.sql')
-	
-	create_transactions(connection, cursor, replace=replace)
-	create_passport_blacklist(connection, cursor, replace=replace)
-	create_terminals(connection, cursor, replace=replace)
-
-	create_fraud_hist(connection, cursor, replace=replace)
-	create_rep_fraud(connection, cursor, replace=replace)
-	create_fraud_types(connection, cursor, replace=replace)
-	if check_if_empty_table(cursor, 'META_FRAUD_TYPES'):
-		execute_from_file(connection, cursor, path='sql_scripts\\insert_fraud_types.sql')
-	
+	with unit_of_work(connection):
+		create_and_set_schema(connection, cursor, schema_name, replace=replace)
+
+		create_clients(connection, cursor, replace=replace)
+		create_cards(connection, cursor, replace=replace)
+		create_accounts(connection, cursor, replace=replace)
+
+		if check_if_empty_table(cursor, 'STG_CARDS'):
+			execute_from_file(connection, cursor, path='sql_scripts\\insert_cards.sql')
+		if check_if_empty_table(cursor, 'STG_ACCOUNTS'):
+			execute_from_file(connection, cursor, path='sql_scripts\\insert_accounts.sql')
+		if check_if_empty_table(cursor, 'STG_CLIENTS'):
+			execute_from_file(connection, cursor, path='sql_scripts\\insert_clients.sql')
+
+		create_transactions(connection, cursor, replace=replace)
+		create_passport_blacklist(connection, cursor, replace=replace)
+		create_terminals(connection, cursor, replace=replace)
+
+		create_fraud_hist(connection, cursor, replace=replace)
+		create_rep_fraud(connection, cursor, replace=replace)
+		create_key_maps(connection, cursor, replace=replace)
+		upgrade_dwh_schema(connection, cursor)
+		create_fraud_types(connection, cursor, replace=replace)
+		create_fraud_watermark(connection, cursor, replace=replace)
+		create_card_profiles(connection, cursor, replace=replace)
+		create_card_profile_watermark(connection, cursor, replace=replace)
+		if check_if_empty_table(cursor, 'META_FRAUD_TYPES'):
+			execute_from_file(connection, cursor, path='sql_scripts\\insert_fraud_types.sql')
@@ -0,0 +1,34 @@
+from py_scripts.database import get_config, get_connection, close, close_pool
+from py_scripts.fraud_stream import load_stream_fraud_detector, replay_transactions_file
+from collections import Counter
+import argparse
+import os
+import re
+
+
+def get_file_order(path):
+	"""Ключ сортировки файлов по дате в названии (transactions_DDMMYYYY), файлы без даты - в конце"""
+	name_obj = re.search(r'(\d{2})(\d{2})(\d{4})', os.path.basename(path))
+	return (0, name_obj.group(3) + name_obj.group(2) + name_obj.group(1)) if name_obj else (1, '')
+
+
+# Прогон файлов с транзакциями через потоковый детектор (fraud_engine = stream) без записи в БД, например:
+# python replay.py archive\transactions_01032021.txt.backup archive\transactions_02032021.txt.backup
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Прогон файлов с транзакциями через потоковый детектор мошенничества')
+	parser.add_argument('files', nargs='+', help='файлы с транзакциями (обрабатываются по порядку дат в названии)')
+	args = parser.parse_args()
+
+	connection = get_connection(get_config(), 'bank')
+	cursor = connection.cursor()
+	try:
+		detector = load_stream_fraud_detector(cursor)
+	finally:
+		close(connection, cursor)
+		close_pool()
+
+	for path in sorted(args.files, key=get_file_order):
+		frauds = replay_transactions_file(detector, path)
+		counts = Counter(fraud_type_id for _, _, fraud_type_id in frauds)
+		by_type = ', '.join(f'признак {fraud_type_id}: {counts[fraud_type_id]}' for fraud_type_id in sorted(counts))
+		print(f'Файл {path}: фактов мошенничества {len(frauds)}' + (f' ({by_type})' if by_type else ''))
@@ -0,0 +1,8 @@
+from py_scripts.database import get_config, get_etl_settings
+from py_scripts.ingest_service import run_service
+
+
+# Режим службы: новые файлы из папки data обрабатываются по мере поступления, например:
+# python service.py
+if __name__ == '__main__':
+	run_service(get_config(), 'bank', get_etl_settings())
@@ -0,0 +1,140 @@
+from py_scripts.file_processing import FILE_SCHEMAS, read_ahead, convert_column, convert_types, read_csv_frames
+import numpy as np
+import pandas as pd
+import threading
+import pytest
+
+
+def test_read_ahead_returns_items_in_order():
+	assert list(read_ahead(iter([1, 2, 3]))) == [1, 2, 3]
+	assert list(read_ahead(iter([2, 3]), first=1)) == [1, 2, 3]
+	assert list(read_ahead(iter([]))) == []
+
+
+def test_read_ahead_reads_next_item_in_background():
+	"""Следующий элемент читается, пока обрабатывается текущий"""
+	second_requested = threading.Event()
+
+	def items():
+		yield 1
+		second_requested.set()
+		yield 2
+
+	reader = read_ahead(items())
+	assert next(reader) == 1
+	assert second_requested.wait(timeout=5)
+	assert list(reader) == [2]
+
+
+def test_read_ahead_raises_read_error_on_its_item():
+	def items():
+		yield 1
+		raise ValueError('bad chunk')
+
+	reader = read_ahead(items())
+	assert next(reader) == 1
+	with pytest.raises(ValueError):
+		next(reader)
+
+
+def test_convert_column_varchar():
+	values = convert_column(pd.Series(['P5456', None, 'x' * 129]), 'VARCHAR(128)')
+	assert values.tolist()[:1] == ['P5456'] and values[1:].isna().all()
+
+
+def test_convert_column_varchar_from_numbers():
+	"""Числа из xlsx (например, номера терминалов без букв) становятся строками"""
+	values = convert_column(pd.Series([1001, 1002]), 'VARCHAR(128)')
+	assert values.tolist() == ['1001', '1002']
+
+
+def test_convert_column_varchar_all_empty():
+	"""Полностью пустое поле pandas читает как float (NaN) - это не ошибка, все значения остаются пустыми"""
+	values = convert_column(pd.Series([np.nan, np.nan]), 'VARCHAR(128)')
+	assert values.dtype == object and values.isna().all()
+
+
+def test_convert_column_decimal():
+	values = convert_column(pd.Series(['1046,40', '7000.00', 'abc', '1' * 13, None]), 'DECIMAL(14,2)')
+	assert values[:2].tolist() == [1046.4, 7000.0]
+	assert values[2:].isna().all()
+
+
+def test_convert_column_decimal_numeric():
+	values = convert_column(pd.Series([1046.4, 1e13]), 'DECIMAL(14,2)')
+	assert values[0] == 1046.4 and pd.isna(values[1])
+
+
+@pytest.mark.parametrize('value, expected', [
+	('2021-03-01 00:00:01', '2021-03-01 00:00:01'),
+	('2021-03-01T00:00:01', '2021-03-01 00:00:01'),
+	('2021-03-01', '2021-03-01 00:00:00'),
+	# как и ::TIMESTAMP в PostgreSQL (DateStyle ISO, MDY): месяц перед днем
+	('01.03.2021 00:00:01', '2021-01-03 00:00:01'),
+	('03/01/2021', '2021-03-01 00:00:00'),
+	('2021/03/01 10:15:00', '2021-03-01 10:15:00'),
+	('March 1 2021', '2021-03-01 00:00:00')
+])
+def test_convert_column_timestamp_formats(value, expected):
+	assert convert_column(pd.Series([value]), 'TIMESTAMP')[0] == pd.Timestamp(expected)
+
+
+@pytest.mark.parametrize('value', ['13.03.2021', '2021-02-30 00:00:00', 'not a date'])
+def test_convert_column_timestamp_invalid(value):
+	assert convert_column(pd.Series([value]), 'TIMESTAMP').isna().all()
+
+
+def test_convert_column_date():
+	values = convert_column(pd.Series([pd.Timestamp('2021-03-01 10:00:00'), '2021-03-02', None]), 'DATE')
+	assert values[:2].tolist() == [pd.Timestamp('2021-03-01'), pd.Timestamp('2021-03-02')]
+	assert pd.isna(values[2])
+
+
+def test_convert_types_rejects_rows_with_invalid_values():
+	df = pd.DataFrame({
+		'transaction_id': ['1', '2', '3', '4'],
+		'transaction_date': ['2021-03-01 00:00:01', 'bad', '2021-03-01 00:00:03', '2021-03-01 00:00:04'],
+		'amount': ['10,50', '20', 'bad', None],
+		'card_num': ['card', 'card', 'card', 'card'],
+		'oper_type': ['PAYMENT', 'PAYMENT', 'PAYMENT', 'DEPOSIT'],
+		'oper_result': ['SUCCESS', 'SUCCESS', 'SUCCESS', 'REJECT'],
+		'terminal': ['P1', 'P1', 'P1', None],
+		'extra': ['a', 'b', 'c', 'd']
+	})
+	converted, rejected = convert_types(df, FILE_SCHEMAS['transactions'])
+	assert rejected == 2
+	assert converted['transaction_id'].tolist() == ['1', '4']
+	assert list(converted.columns) == list(FILE_SCHEMAS['transactions'])
+	assert converted['amount'].iloc[0] == 10.5 and pd.isna(converted['amount'].iloc[1])
+	assert isinstance(converted['oper_type'].dtype, pd.CategoricalDtype)
+
+
+def test_convert_types_empty_varchar_column():
+	"""Файл с полностью пустым строковым полем загружается без отброшенных строк"""
+	df = pd.DataFrame({
+		'terminal_id': ['P1', 'P2'],
+		'terminal_type': ['POS', 'POS'],
+		'terminal_city': ['Москва', 'Казань'],
+		'terminal_address': [np.nan, np.nan]
+	})
+	converted, rejected = convert_types(df, FILE_SCHEMAS['terminals'])
+	assert rejected == 0 and len(converted) == 2
+	assert converted['terminal_address'].isna().all()
+
+
+def test_convert_types_missing_column():
+	with pytest.raises(ValueError):
+		convert_types(pd.DataFrame({'passport': ['1234 567890']}), FILE_SCHEMAS['passport_blacklist'])
+
+
+def test_read_csv_frames_in_chunks(tmp_path):
+	path = tmp_path / 'transactions_01032021.txt'
+	path.write_text(
+		'transaction_id;transaction_date;amount;card_num;oper_type;oper_result;terminal\n'
+		'1;2021-03-01 00:00:01;1046,40;card;PAYMENT;SUCCESS;P1\n'
+		'2;bad;10,00;card;PAYMENT;SUCCESS;P1\n'
+		'3;2021-03-01 00:00:03;;card;DEPOSIT;SUCCESS;\n', encoding='utf-8')
+	frames = list(read_csv_frames(path, FILE_SCHEMAS['transactions'], chunk_rows=2))
+	assert [(len(df), rejected) for df, rejected in frames] == [(1, 1), (1, 0)]
+	assert frames[0][0]['amount'].iloc[0] == 1046.4
+	assert frames[1][0]['transaction_id'].iloc[0] == '3' and pd.isna(frames[1][0]['terminal'].iloc[0])
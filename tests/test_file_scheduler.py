@@ -0,0 +1,82 @@
+from py_scripts.file_scheduler import build_dependency_graph, process_files_pipelined
+import threading
+
+
+def get_candidate(file_id, info_type):
+	return {'id': file_id, 'info_type': info_type, 'file_name': f'{info_type}_{file_id}'}
+
+
+def test_build_dependency_graph_chains_sequential_types():
+	"""terminals и passport_blacklist зависят от предыдущего файла своего типа, transactions - ни от чего"""
+	candidates = [
+		get_candidate(1, 'passport_blacklist'),
+		get_candidate(2, 'terminals'),
+		get_candidate(3, 'transactions'),
+		get_candidate(4, 'passport_blacklist'),
+		get_candidate(5, 'terminals'),
+		get_candidate(6, 'transactions'),
+		get_candidate(7, 'terminals')
+	]
+	assert build_dependency_graph(candidates) == {
+		1: set(),
+		2: set(),
+		3: set(),
+		4: {1},
+		5: {2},
+		6: set(),
+		7: {5}
+	}
+
+
+def test_build_dependency_graph_keeps_candidates_order():
+	"""Порядок внутри типа берется из порядка кандидатов, а не из id"""
+	candidates = [get_candidate(9, 'terminals'), get_candidate(3, 'terminals'), get_candidate(5, 'terminals')]
+	assert build_dependency_graph(candidates) == {9: set(), 3: {9}, 5: {3}}
+
+
+def test_build_dependency_graph_empty():
+	assert build_dependency_graph([]) == {}
+
+
+def test_process_files_pipelined_keeps_order_and_reads_ahead():
+	"""Файлы обрабатываются по порядку, каждый - со своими данными; вперед читается не больше depth файлов"""
+	candidates = [get_candidate(file_id, 'transactions') for file_id in (4, 2, 7, 1, 5)]
+	lock = threading.Lock()
+	prefetched_ids = []
+	processed = []
+
+	def prefetch(file_info):
+		with lock:
+			prefetched_ids.append(file_info['id'])
+		return f"data {file_info['id']}"
+
+	def process(file_info, prefetched):
+		assert prefetched.result() == f"data {file_info['id']}"
+		allowed_ids = {next_file_info['id'] for next_file_info in candidates[:len(processed) + 3]}
+		with lock:
+			assert set(prefetched_ids) <= allowed_ids
+		processed.append(file_info['id'])
+
+	process_files_pipelined(candidates, prefetch, process, depth=2)
+	assert processed == [4, 2, 7, 1, 5]
+	assert prefetched_ids == [4, 2, 7, 1, 5]
+
+
+def test_process_files_pipelined_reports_read_error_with_its_file():
+	"""Ошибка чтения файла возникает при обработке этого файла и не мешает обработке остальных"""
+	candidates = [get_candidate(file_id, 'transactions') for file_id in (1, 2, 3)]
+	results = []
+
+	def prefetch(file_info):
+		if file_info['id'] == 2:
+			raise ValueError('bad file')
+		return file_info['id']
+
+	def process(file_info, prefetched):
+		try:
+			results.append(prefetched.result())
+		except ValueError:
+			results.append('error')
+
+	process_files_pipelined(candidates, prefetch, process)
+	assert results == [1, 'error', 3]
@@ -0,0 +1,42 @@
+from py_scripts.fraud_backfill import get_shards
+import datetime
+import pytest
+
+
+def test_get_shards_by_day():
+	start_dt = datetime.datetime(2021, 3, 1)
+	assert get_shards(start_dt, datetime.datetime(2021, 3, 4)) == [
+		(datetime.datetime(2021, 3, 1), datetime.datetime(2021, 3, 2)),
+		(datetime.datetime(2021, 3, 2), datetime.datetime(2021, 3, 3)),
+		(datetime.datetime(2021, 3, 3), datetime.datetime(2021, 3, 4))
+	]
+
+
+def test_get_shards_last_shard_is_cut_at_end_dt():
+	start_dt = datetime.datetime(2021, 3, 1, 22, 30)
+	end_dt = datetime.datetime(2021, 3, 2, 1, 15)
+	assert get_shards(start_dt, end_dt, shard='hour') == [
+		(datetime.datetime(2021, 3, 1, 22, 30), datetime.datetime(2021, 3, 1, 23, 30)),
+		(datetime.datetime(2021, 3, 1, 23, 30), datetime.datetime(2021, 3, 2, 0, 30)),
+		(datetime.datetime(2021, 3, 2, 0, 30), datetime.datetime(2021, 3, 2, 1, 15))
+	]
+
+
+def test_get_shards_cover_period_without_gaps():
+	start_dt = datetime.datetime(2021, 3, 1)
+	end_dt = datetime.datetime(2021, 3, 4, 5, 30)
+	shards = get_shards(start_dt, end_dt, shard='hour')
+	assert len(shards) == 78
+	assert shards[0][0] == start_dt and shards[-1][1] == end_dt
+	assert all(previous[1] == current[0] for previous, current in zip(shards, shards[1:]))
+
+
+def test_get_shards_empty_period():
+	start_dt = datetime.datetime(2021, 3, 1)
+	assert get_shards(start_dt, start_dt) == []
+	assert get_shards(start_dt, start_dt - datetime.timedelta(days=1)) == []
+
+
+def test_get_shards_unknown_size():
+	with pytest.raises(KeyError):
+		get_shards(datetime.datetime(2021, 3, 1), datetime.datetime(2021, 3, 2), shard='week')
@@ -0,0 +1,138 @@
+from py_scripts.database import get_config, get_connection_params, get_connection, close, close_pool, unit_of_work, drop_schema, drop_table
+from py_scripts.test_data import recreate_test_data
+from py_scripts.dwh_data_update import FILE_MASK, update_passport_blacklist, update_transactions, update_terminals, get_blacklist_delta
+from py_scripts.file_processing import data2sql, read_xlsx
+from py_scripts.fraud_search import update_rep_fraud
+from concurrent.futures import Future
+import datetime
+import psycopg2
+import pytest
+import os
+import re
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DATA_DIR = os.path.join(ROOT, 'data')
+SCHEMA_NAME = 'test_fraud_engines'
+
+# Количество записей REP_FRAUD по файлам из папки data за период из date_settings.json
+EXPECTED_REP_FRAUD_ROWS = 2166
+
+SCENARIOS = [
+	('queries', 'period', 1),
+	('queries', 'incremental', 1),
+	('single_pass', 'period', 1),
+	('single_pass', 'incremental', 1),
+	('single_pass', 'period', 4),
+	('single_pass', 'incremental', 4),
+	('stream', 'period', 1),
+	('stream', 'incremental', 1),
+	('vectorized', 'period', 1),
+	('vectorized', 'incremental', 1)
+]
+
+
+def get_sample_files():
+	"""Файлы из папки data в порядке обработки (по дате, далее по названию) с датой из названия"""
+	files = []
+	for file_name in os.listdir(DATA_DIR):
+		name_obj = re.fullmatch(FILE_MASK, file_name)
+		if name_obj:
+			file_date = datetime.datetime.strptime(name_obj.group(2), '%d%m%Y')
+			files.append((file_date, file_name, name_obj.group(1), name_obj.group(3)))
+	return sorted(files)
+
+
+def load_sample_files(connection, cursor, table_name='stg_tmp_loaded'):
+	"""
+	Загрузка файлов из папки data так же, как в dwh_data_update.process_file, но без журнала обработки
+	и перемещения файлов в архив (файлы остаются в папке data, xlsx читаются без кеша).
+	"""
+	for file_id, (file_date, file_name, info_type, data_format) in enumerate(get_sample_files(), start=1):
+		file_info = {'id': file_id, 'file_name': file_name, 'info_type': info_type, 'data_format': data_format, 'file_date': file_date}
+		prefetched = None
+		if data_format == 'xlsx':
+			prefetched = Future()
+			prefetched.set_result(read_xlsx(os.path.join(DATA_DIR, file_name)))
+		transform = (lambda df: get_blacklist_delta(cursor, df)) if info_type == 'passport_blacklist' else None
+
+		with unit_of_work(connection):
+			assert data2sql(connection, cursor, file_info, table_name,
+				data_path=DATA_DIR + os.sep, transform=transform, prefetched=prefetched)
+			if info_type == 'passport_blacklist':
+				update_passport_blacklist(connection, cursor, table_name)
+			elif info_type == 'transactions':
+				update_transactions(connection, cursor, table_name)
+			else:
+				update_terminals(connection, cursor, file_date=file_date, table_name=table_name)
+			drop_table(connection, cursor, table_name)
+
+
+def get_rep_fraud(cursor):
+	cursor.execute("""
+		SELECT event_dt, passport, fio, phone, event_type
+		FROM REP_FRAUD
+		ORDER BY event_dt, passport, event_type, fio, phone;
+	""")
+	return cursor.fetchall()
+
+
+@pytest.fixture(scope='module')
+def sample_db():
+	"""
+	Схема SCHEMA_NAME с данными из папки data.
+	Если БД из db_config.json недоступна, тесты пропускаются.
+	"""
+	config_path = os.path.join(ROOT, 'db_config.json')
+	if not os.path.exists(config_path):
+		pytest.skip('Нет файла db_config.json')
+	config = get_config(config_path)
+	try:
+		psycopg2.connect(connect_timeout=3, **get_connection_params(config)).close()
+	except psycopg2.OperationalError:
+		pytest.skip('БД из db_config.json недоступна')
+
+	# date_settings.json читается из текущей папки (см. fraud_search.get_rep_fraud_time_period)
+	cwd = os.getcwd()
+	os.chdir(ROOT)
+	if not os.path.exists('sql_scripts\\insert_cards.sql'):
+		os.chdir(cwd)
+		pytest.skip('Пути к файлам проекта (sql_scripts\\, data\\) заданы в формате Windows')
+	close_pool()
+	connection = get_connection(config, SCHEMA_NAME)
+	cursor = connection.cursor()
+	try:
+		recreate_test_data(connection, cursor, SCHEMA_NAME, replace=True)
+		load_sample_files(connection, cursor)
+		yield connection, cursor
+	finally:
+		connection.rollback()
+		with unit_of_work(connection):
+			drop_schema(connection, cursor, SCHEMA_NAME)
+		close(connection, cursor)
+		close_pool()
+		os.chdir(cwd)
+
+
+def find_rep_fraud(connection, cursor, engine, mode, shards):
+	"""REP_FRAUD, построенный с нуля способом engine в режиме mode"""
+	with unit_of_work(connection):
+		cursor.execute("""TRUNCATE DWH_DIM_FRAUD, REP_FRAUD, META_FRAUD_WATERMARK;""")
+	update_rep_fraud(connection, cursor, engine=engine, mode=mode, shards=shards)
+	return get_rep_fraud(cursor)
+
+
+@pytest.fixture(scope='module')
+def expected_rep_fraud(sample_db):
+	"""REP_FRAUD способа по умолчанию (отдельные запросы по признакам, период из date_settings.json)"""
+	return find_rep_fraud(*sample_db, engine='queries', mode='period', shards=1)
+
+
+def test_rep_fraud_rows(expected_rep_fraud):
+	assert len(expected_rep_fraud) == EXPECTED_REP_FRAUD_ROWS
+
+
+@pytest.mark.parametrize('engine, mode, shards', SCENARIOS)
+def test_engines_build_same_rep_fraud(sample_db, expected_rep_fraud, engine, mode, shards):
+	"""Все способы поиска и режимы (в том числе шарды по счетам) строят один и тот же REP_FRAUD"""
+	assert find_rep_fraud(*sample_db, engine=engine, mode=mode, shards=shards) == expected_rep_fraud
@@ -0,0 +1,126 @@
+from py_scripts.fraud_stream import StreamFraudDetector, replay_transactions
+from py_scripts.fraud_offline import evaluate_frauds_offline
+from decimal import Decimal
+import datetime
+import pandas as pd
+
+
+START_DT = datetime.datetime(2021, 3, 1)
+
+CARDS = {
+	'card_1': 'account_1',
+	'card_2': 'account_2',
+	'card_3': 'account_3',
+	'card_4': 'account_missing',
+	'card_5': 'account_5'
+}
+
+ACCOUNTS = {
+	'account_1': (datetime.date(2021, 12, 31), 'client_1'),
+	'account_2': (datetime.date(2021, 2, 28), 'client_2'),
+	'account_3': (datetime.date(2021, 12, 31), 'client_3'),
+	'account_5': (datetime.date(2021, 12, 31), 'client_5')
+}
+
+CLIENTS = {
+	'client_1': ('1111 111111', datetime.date(2030, 1, 1)),
+	'client_2': ('2222 222222', datetime.date(2030, 1, 1)),
+	'client_3': ('3333 333333', datetime.date(2021, 3, 1)),
+	'client_5': ('5555 555555', datetime.date(2030, 1, 1))
+}
+
+BLACKLIST = {'5555 555555'}
+
+TERMINALS = {
+	'T1': [(datetime.datetime(2021, 1, 1), datetime.datetime(2999, 12, 31, 23, 59, 59), 'Москва')],
+	'T2': [(datetime.datetime(2021, 1, 1), datetime.datetime(2999, 12, 31, 23, 59, 59), 'Казань')],
+	'T3': [
+		(datetime.datetime(2021, 1, 1), datetime.datetime(2021, 3, 1, 23, 59, 59), 'Москва'),
+		(datetime.datetime(2021, 3, 2), datetime.datetime(2999, 12, 31, 23, 59, 59), 'Пермь')
+	]
+}
+
+# (trans_id, trans_date, card_num, oper_type, amt, oper_result, terminal) в порядке времени
+TRANSACTIONS = [
+	# до начала периода: договор уже недействителен, но операция не проверяется
+	('0', '2021-02-28 23:00:00', 'card_2', 'PAYMENT', '50.00', 'SUCCESS', 'T1'),
+	# до начала периода: учитывается только как предыдущая операция для правила 3
+	('1', '2021-02-28 23:30:00', 'card_1', 'PAYMENT', '100.00', 'SUCCESS', 'T1'),
+	# правило 3: другой город через 40 минут
+	('2', '2021-03-01 00:10:00', 'card_1', 'PAYMENT', '100.00', 'SUCCESS', 'T2'),
+	# правило 2: договор действовал по 2021-02-28
+	('3', '2021-03-01 10:00:00', 'card_2', 'PAYMENT', '50.00', 'SUCCESS', 'T1'),
+	# паспорт действует весь день 2021-03-01
+	('4', '2021-03-01 12:00:00', 'card_3', 'PAYMENT', '50.00', 'SUCCESS', 'T1'),
+	# правило 1: паспорт в 'черном списке'
+	('5', '2021-03-01 13:00:00', 'card_5', 'WITHDRAW', '3000.00', 'REJECT', 'T1'),
+	# карта без счета и неизвестная карта не проверяются
+	('6', '2021-03-01 14:00:00', 'card_4', 'PAYMENT', '10.00', 'SUCCESS', 'T2'),
+	('7', '2021-03-01 14:01:00', 'card_9', 'PAYMENT', '10.00', 'SUCCESS', 'T2'),
+	# правило 4: две отклоненные операции с убывающей суммой и успешная в течение 20 минут
+	('8', '2021-03-01 15:00:00', 'card_1', 'PAYMENT', '3000.00', 'REJECT', 'T2'),
+	('9', '2021-03-01 15:05:00', 'card_1', 'WITHDRAW', '2000.00', 'REJECT', 'T2'),
+	('10', '2021-03-01 15:19:00', 'card_1', 'PAYMENT', '1000.00', 'SUCCESS', 'T2'),
+	# подбор суммы дольше 20 минут не считается
+	('11', '2021-03-01 16:00:00', 'card_3', 'PAYMENT', '3000.00', 'REJECT', 'T1'),
+	('12', '2021-03-01 16:10:00', 'card_3', 'PAYMENT', '2000.00', 'REJECT', 'T1'),
+	('13', '2021-03-01 16:21:00', 'card_3', 'PAYMENT', '1000.00', 'SUCCESS', 'T1'),
+	# правило 3 по истории терминала: T3 сменил город в полночь
+	('14', '2021-03-01 23:50:00', 'card_1', 'PAYMENT', '100.00', 'SUCCESS', 'T3'),
+	('15', '2021-03-02 00:20:00', 'card_1', 'PAYMENT', '100.00', 'SUCCESS', 'T3'),
+	# правило 1: срок действия паспорта истек
+	('16', '2021-03-02 09:00:00', 'card_3', 'PAYMENT', '50.00', 'SUCCESS', 'T1')
+]
+
+EXPECTED_FRAUDS = {('2', 3), ('3', 2), ('5', 1), ('10', 4), ('15', 3), ('16', 1)}
+
+
+def get_stream_transactions():
+	return [
+		(trans_id, datetime.datetime.fromisoformat(trans_date), card_num, oper_type, Decimal(amt), oper_result, terminal)
+		for trans_id, trans_date, card_num, oper_type, amt, oper_result, terminal in TRANSACTIONS
+	]
+
+
+def find_frauds_offline_fixture():
+	"""Поиск по тем же данным векторизованной проверкой (в формате fraud_offline.load_offline_data)"""
+	transactions = pd.DataFrame(TRANSACTIONS, 
+		columns=['trans_id', 'trans_date', 'card_num', 'oper_type', 'amt', 'oper_result', 'terminal'])
+	transactions['trans_date'] = pd.to_datetime(transactions['trans_date'])
+	transactions['amt'] = transactions['amt'].astype(float)
+	cards = pd.DataFrame(list(CARDS.items()), columns=['card_num', 'account'])
+	accounts = pd.DataFrame(
+		[(account, pd.Timestamp(valid_to), client) for account, (valid_to, client) in ACCOUNTS.items()], 
+		columns=['account', 'valid_to', 'client'])
+	clients = pd.DataFrame(
+		[(client_id, passport_num, pd.Timestamp(valid_to)) for client_id, (passport_num, valid_to) in CLIENTS.items()], 
+		columns=['client_id', 'passport_num', 'passport_valid_to'])
+	blacklist = pd.DataFrame(sorted(BLACKLIST), columns=['passport_num'])
+	terminals = pd.DataFrame(
+		[(terminal_id, effective_from, min(effective_to, datetime.datetime(2200, 1, 1)), terminal_city) 
+			for terminal_id, history in TERMINALS.items() 
+			for effective_from, effective_to, terminal_city in history], 
+		columns=['terminal_id', 'effective_from', 'effective_to', 'terminal_city'])
+	frauds = evaluate_frauds_offline(transactions, cards, accounts, clients, blacklist, terminals, START_DT)
+	return set(zip(frauds['trans_id'], frauds['fraud_type_id']))
+
+
+def test_stream_detector_finds_expected_frauds():
+	detector = StreamFraudDetector(CARDS, ACCOUNTS, CLIENTS, BLACKLIST, TERMINALS)
+	frauds = replay_transactions(detector, get_stream_transactions(), start_dt=START_DT)
+	assert {(trans_id, fraud_type_id) for trans_id, _, fraud_type_id in frauds} == EXPECTED_FRAUDS
+
+
+def test_stream_detector_matches_offline_evaluation():
+	detector = StreamFraudDetector(CARDS, ACCOUNTS, CLIENTS, BLACKLIST, TERMINALS)
+	frauds = replay_transactions(detector, get_stream_transactions(), start_dt=START_DT)
+	assert {(trans_id, fraud_type_id) for trans_id, _, fraud_type_id in frauds} == find_frauds_offline_fixture()
+
+
+def test_stream_detector_blacklist_update():
+	"""Паспорт, добавленный в 'черный список' после создания детектора, учитывается со следующей операции"""
+	detector = StreamFraudDetector(CARDS, ACCOUNTS, CLIENTS, set(), TERMINALS)
+	trans_date = datetime.datetime(2021, 3, 1, 12)
+	assert detector.process(trans_date, 'card_1', 'PAYMENT', Decimal('10'), 'SUCCESS', 'T1') == []
+	detector.add_blacklisted('1111 111111')
+	assert detector.process(trans_date, 'card_1', 'PAYMENT', Decimal('10'), 'SUCCESS', 'T1') == [1]
@@ -0,0 +1,77 @@
+from py_scripts import ingest_service
+from py_scripts.ingest_service import get_ready_files, get_file_order
+from py_scripts.dwh_data_update import FILE_MASK
+import pytest
+
+
+@pytest.fixture
+def clock(monkeypatch):
+	"""Управляемое время для get_ready_files: clock[0] - текущий момент в секундах"""
+	clock = [1000.0]
+	monkeypatch.setattr(ingest_service.time, 'monotonic', lambda: clock[0])
+	return clock
+
+
+def test_get_ready_files_skips_other_names_and_directories(tmp_path):
+	(tmp_path / 'transactions_01032021.txt').write_text('data')
+	(tmp_path / 'transactions_01032021.txt.part').write_text('data')
+	(tmp_path / 'notes.txt').write_text('data')
+	(tmp_path / 'terminals_01032021.xlsx').mkdir()
+	assert get_ready_files(tmp_path, FILE_MASK, {}, settle_interval=0) == ['transactions_01032021.txt']
+
+
+def test_get_ready_files_waits_for_settle_interval(tmp_path, clock):
+	(tmp_path / 'transactions_01032021.txt').write_text('data')
+	seen = {}
+	assert get_ready_files(tmp_path, FILE_MASK, seen, settle_interval=2) == []
+	assert 'transactions_01032021.txt' in seen
+
+	clock[0] += 1
+	assert get_ready_files(tmp_path, FILE_MASK, seen, settle_interval=2) == []
+
+	clock[0] += 1
+	assert get_ready_files(tmp_path, FILE_MASK, seen, settle_interval=2) == ['transactions_01032021.txt']
+
+
+def test_get_ready_files_restarts_wait_when_file_changes(tmp_path, clock):
+	path = tmp_path / 'transactions_01032021.txt'
+	path.write_text('data')
+	seen = {}
+	get_ready_files(tmp_path, FILE_MASK, seen, settle_interval=2)
+
+	clock[0] += 1.5
+	path.write_text('more data')
+	assert get_ready_files(tmp_path, FILE_MASK, seen, settle_interval=2) == []
+
+	clock[0] += 1.5
+	assert get_ready_files(tmp_path, FILE_MASK, seen, settle_interval=2) == []
+
+	clock[0] += 0.5
+	assert get_ready_files(tmp_path, FILE_MASK, seen, settle_interval=2) == ['transactions_01032021.txt']
+
+
+def test_get_ready_files_forgets_removed_files(tmp_path):
+	path = tmp_path / 'transactions_01032021.txt'
+	path.write_text('data')
+	seen = {}
+	get_ready_files(tmp_path, FILE_MASK, seen, settle_interval=0)
+	path.unlink()
+	assert get_ready_files(tmp_path, FILE_MASK, seen, settle_interval=0) == []
+	assert seen == {}
+
+
+def test_get_file_order_by_date_then_name():
+	file_names = [
+		'transactions_01042021.txt',
+		'transactions_02032021.txt',
+		'terminals_02032021.xlsx',
+		'passport_blacklist_02032021.xlsx',
+		'transactions_31032021.txt'
+	]
+	assert sorted(file_names, key=get_file_order) == [
+		'passport_blacklist_02032021.xlsx',
+		'terminals_02032021.xlsx',
+		'transactions_02032021.txt',
+		'transactions_31032021.txt',
+		'transactions_01042021.txt'
+	]